@@ -0,0 +1,138 @@
+# amadeus_cache.py
+import json
+import os
+import threading
+from concurrent.futures import Future
+import metrics
+from cache import SQLiteCache
+from geocache import normalize_query
+from config import (
+    amadeus,
+    AMADEUS_CACHE_PATH,
+    IATA_CACHE_TTL_SECONDS,
+    IATA_NEGATIVE_TTL_SECONDS,
+    FLIGHT_OFFER_TTL_SECONDS
+)
+
+IATA_DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'iata_cities.json')
+
+with open(IATA_DATASET_PATH) as f:
+    # Bundled city name -> [IATA city/airport code, country] index; covers the common cases offline.
+    _bundled = json.load(f)
+_bundled_iata = _bundled["cities"]
+_country_aliases = _bundled["country_aliases"]
+
+_iata_store = SQLiteCache(AMADEUS_CACHE_PATH, "iata")
+_offer_store = SQLiteCache(AMADEUS_CACHE_PATH, "flight_offers")
+
+# Round-trips to Amadeus, split by endpoint.
+upstream_calls = {"locations": 0, "flight_offers": 0}
+_lock = threading.Lock()
+
+# Lookups currently going out to Amadeus, by cache key, so concurrent misses share one call.
+_iata_inflight = {}
+_offer_inflight = {}
+
+
+def _bundled_code(key):
+    """Looks up "kochi" or "kochi, kerala, india" in the bundled index.
+
+    A qualified name is only answered when its last part is the country of the
+    bundled city, so "hyderabad, pakistan" is not taken for Hyderabad in India;
+    anything else is left to the cache and the API.
+    """
+    parts = key.split(", ")
+    entry = _bundled_iata.get(parts[0])
+    if not entry:
+        return None
+    code, country = entry
+    if len(parts) == 1 or _country_aliases.get(parts[-1], parts[-1]) == country:
+        return code
+    return None
+
+
+def _count_call(endpoint):
+    with _lock:
+        upstream_calls[endpoint] += 1
+
+
+def _coalesced(inflight, key, fetch):
+    """Runs fetch() once for concurrent callers with the same key; the others wait for its result."""
+    with _lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = inflight[key] = Future()
+    if leader:
+        try:
+            future.set_result(fetch())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _lock:
+                del inflight[key]
+    return future.result()
+
+
+@metrics.timed("iata_lookup")
+def resolve_iata(city):
+    """Turns a city name into an IATA code, or None if Amadeus knows no match.
+
+    The bundled index is consulted first, then the on-disk cache of earlier
+    Amadeus answers; only names seen for the first time hit the API.
+    """
+    key = normalize_query(city)
+    code = _bundled_code(key)
+    if code:
+        return code
+    return _coalesced(_iata_inflight, key, lambda: _fetch_iata(city, key))
+
+
+def _fetch_iata(city, key):
+    found, code = _iata_store.get(key)
+    if found:
+        return code
+
+    _count_call("locations")
+    airports = amadeus.reference_data.locations.get(keyword=city, subType='CITY,AIRPORT').data
+    code = airports[0]['iataCode'] if airports else None
+    _iata_store.set(key, code, IATA_CACHE_TTL_SECONDS if code else IATA_NEGATIVE_TTL_SECONDS)
+    return code
+
+
+@metrics.timed("flight_search")
+def search_flight_offers(origin_iata, dest_iata, travel_date, adults=1):
+    """Cheapest flight offer search, cached for a few minutes per (origin, dest, date, adults)."""
+    key = f"{origin_iata}|{dest_iata}|{travel_date}|{adults}"
+    return _coalesced(_offer_inflight, key, lambda: _fetch_flight_offers(key, origin_iata, dest_iata, travel_date, adults))
+
+
+def _fetch_flight_offers(key, origin_iata, dest_iata, travel_date, adults):
+    found, offers = _offer_store.get(key)
+    if found:
+        return offers
+
+    _count_call("flight_offers")
+    response = amadeus.shopping.flight_offers_search.get(
+        originLocationCode=origin_iata,
+        destinationLocationCode=dest_iata,
+        departureDate=travel_date,
+        adults=adults,
+        max=1 # We only need the cheapest option for comparison
+    )
+    _offer_store.set(key, response.data, FLIGHT_OFFER_TTL_SECONDS)
+    return response.data
+
+
+def stats():
+    return {
+        "iata": _iata_store.stats(),
+        "flight_offers": _offer_store.stats(),
+        "bundled_iata_entries": len(_bundled_iata),
+        "upstream_calls": _upstream_calls()
+    }
+
+
+def _upstream_calls():
+    with _lock:
+        return dict(upstream_calls)
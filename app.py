@@ -1,13 +1,16 @@
-from flask import Flask, send_from_directory
+from flask import Flask, Response, g, request, send_from_directory
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask_cors import CORS
 from routes import api
+from config import SERVER_TIMING
+import metrics
 import os
 
 app = Flask(__name__, static_folder='frontend')
 
 # CORS Configuration - Allow all routes for simplicity during development
-CORS(app)
+# Pagination and caching headers must be exposed for browsers to read them
+CORS(app, expose_headers=['X-Next-Cursor', 'Link', 'ETag'])
 
 # Swagger UI Setup
 SWAGGER_URL = '/api/docs'
@@ -22,6 +25,28 @@ app.register_blueprint(swaggerui_blueprint)
 # Register API routes
 app.register_blueprint(api)
 
+# Request metrics, served to Prometheus on /metrics
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing(started)
+    method = request.method
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # Counted once the body is sent, so streamed trips report their full duration.
+    response.call_on_close(lambda: metrics.finish_request(method, route, response.status_code, started))
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # Serve Swagger spec
 @app.route('/swagger.yaml')
 def swagger():
@@ -0,0 +1,486 @@
+# asgi.py
+# Async serving mode: `uvicorn asgi:app --port 5000`
+#
+# Serves the same /api/v1 contract as routes.py with native async handlers, so
+# a trip generation waiting on Gemini or Supabase holds no thread. Everything
+# else (Swagger UI, swagger.yaml, the frontend) is the Flask app, mounted as is.
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.middleware.wsgi import WSGIMiddleware
+from config import async_outbound, ASGI_BLOCKING_THREADS, SERVER_TIMING
+from db import async_user_db, service_db, user_db, async_auth_client
+import geocache
+import plancache
+import amadeus_cache
+import weathercache
+import promptplan
+import metrics
+from jobs import trip_jobs, QueueFull, InvalidCallback
+from auth import authenticate
+from services import get_flight_options, simulate_train_options
+from services_async import generate_itinerary_with_coords, generate_itineraries_with_coords, stream_itinerary_with_coords
+from routes import (
+    build_trip_record,
+    generate_and_save_trip,
+    generate_and_save_trips,
+    batch_trips,
+    batch_records,
+    batch_result,
+    batch_status,
+    REQUIRED_TRIP_FIELDS,
+    job_token_error,
+    trip_dates_error,
+    sse_event,
+    encode_cursor,
+    decode_cursor,
+    TRIP_SUMMARY_FIELDS,
+    TRIP_FIELDS,
+    TRIPS_PAGE_DEFAULT,
+    TRIPS_PAGE_MAX
+)
+from app import app as flask_app
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # asyncio.to_thread uses the loop's default executor; size it for the
+    # blocking SDK calls of many concurrent trips rather than CPU count.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASGI_BLOCKING_THREADS))
+    yield
+    await async_outbound.aclose()
+
+
+api = APIRouter(prefix='/api/v1')
+
+
+def bearer_token(request):
+    """Returns the JWT from the Authorization header, or None."""
+    token = request.headers.get('Authorization')
+    if not token or len(token.split(" ")) < 2:
+        return None
+    return token.split(" ")[1]
+
+
+async def get_user_from_token(request):
+    token = bearer_token(request)
+    if not token:
+        return None, {"msg": "Missing or invalid Authorization header"}
+    try:
+        # Usually a cache hit; a remote check against Supabase Auth blocks, so run it off the loop.
+        user = await asyncio.to_thread(authenticate, token)
+        return user, None
+    except Exception as e:
+        return None, {"msg": f"Invalid token: {e}"}
+
+
+def int_arg(request, name, default):
+    """Same as Flask's request.args.get(name, default, type=int)."""
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+# --- Authentication Routes ---
+@api.post('/auth/register')
+async def register(request: Request):
+    data = await request.json()
+    try:
+        auth_response = await async_auth_client().sign_up({
+            "email": data['email'],
+            "password": data['password']
+        })
+        if auth_response.user:
+            profile_data = {
+                'id': auth_response.user.id,
+                'email': auth_response.user.email,
+                'name': data.get('name', data['email'].split('@')[0]),
+                'preferences': data.get('preferences', {})
+            }
+            if auth_response.session:
+                await async_user_db(auth_response.session.access_token).table('profiles').insert(profile_data).execute()
+            else:
+                await asyncio.to_thread(service_db.table('profiles').insert(profile_data).execute)
+        return JSONResponse({"msg": "User created successfully. Please check your email to confirm if email verification is enabled."}, status_code=201)
+    except Exception as e:
+        return JSONResponse({"msg": f"Registration failed: {e}"}, status_code=500)
+
+
+@api.post('/auth/login')
+async def login(request: Request):
+    data = await request.json()
+    try:
+        user_response = await async_auth_client().sign_in_with_password({
+            "email": data['email'],
+            "password": data['password']
+        })
+        if user_response and user_response.session:
+            return JSONResponse({
+                "msg": "Logged in successfully",
+                "access_token": user_response.session.access_token,
+                "user": user_response.user.model_dump(mode='json')
+            })
+        return JSONResponse({"msg": "Login failed: Invalid credentials or user not found"}, status_code=401)
+    except Exception as e:
+        return JSONResponse({"msg": f"Login failed: {e}"}, status_code=401)
+
+
+@api.post('/auth/logout')
+async def logout(request: Request):
+    token = bearer_token(request)
+    if not token:
+        return JSONResponse({"msg": "Missing or invalid Authorization header"}, status_code=401)
+    try:
+        await async_auth_client().admin.sign_out(token)
+        return JSONResponse({"msg": "Logged out successfully"}, status_code=200)
+    except Exception as e:
+        return JSONResponse({"msg": f"Logout failed: {e}"}, status_code=500)
+
+
+# --- Trip Management Routes ---
+def wants_async(request):
+    """Job mode is requested with ?async=true or an RFC 7240 'Prefer: respond-async' header."""
+    if request.query_params.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+@api.post('/trips')
+async def create_trip(request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    data = await request.json()
+    if not all(k in data for k in REQUIRED_TRIP_FIELDS):
+        return JSONResponse({"msg": f"Missing required fields. Required: {REQUIRED_TRIP_FIELDS}"}, status_code=400)
+    dates_error = trip_dates_error(data)
+    if dates_error:
+        return JSONResponse({"msg": dates_error}, status_code=400)
+
+    user_id = user.user.id
+    token = bearer_token(request)
+    if wants_async(request):
+        # Jobs outlive the request, so they run on the shared job workers like in the Flask app.
+        error = job_token_error(token)
+        if error: return JSONResponse(error, status_code=401)
+        db = user_db(token)
+        try:
+            job = trip_jobs.submit(user_id, lambda: generate_and_save_trip(db, user_id, data), data.get('callback_url'))
+        except InvalidCallback as e:
+            return JSONResponse({"msg": str(e)}, status_code=400)
+        except QueueFull as e:
+            return JSONResponse({"msg": str(e)}, status_code=503, headers={'Retry-After': '30'})
+        status_url = api.url_path_for('get_job', job_id=job.id)
+        return JSONResponse({
+            "msg": "Trip generation queued",
+            "job_id": job.id,
+            "status_url": status_url
+        }, status_code=202, headers={'Location': status_url})
+
+    try:
+        plan = await generate_itinerary_with_coords(
+            data['destination'],
+            data['start_date'],
+            data['end_date'],
+            data.get('budget'),
+            data.get('interests', []),
+            data['current_location']
+        )
+        trip_data = build_trip_record(user_id, data, plan)
+        print(f"Attempting to insert trip with user_id: {user_id} and name: '{trip_data['name']}'")
+        response = await async_user_db(token).table('trips').insert(trip_data).execute()
+        return JSONResponse({
+            "msg": "Trip created successfully",
+            "trip_id": response.data[0]['id'],
+            "plan": plan
+        }, status_code=201)
+    except Exception as e:
+        print(f"Error creating trip: {e}")
+        return JSONResponse({"msg": f"Failed to create trip: {str(e)}"}, status_code=500)
+
+
+@api.post('/trips/batch')
+async def create_trip_batch(request: Request):
+    """Creates many trips at once, sharing geocoding, weather and flight searches between them."""
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    data = await request.json()
+    trips, error = batch_trips(data)
+    if error: return JSONResponse({"msg": error}, status_code=400)
+
+    user_id = user.user.id
+    token = bearer_token(request)
+    if wants_async(request):
+        error = job_token_error(token)
+        if error: return JSONResponse(error, status_code=401)
+        db = user_db(token)
+        try:
+            job = trip_jobs.submit(user_id, lambda: generate_and_save_trips(db, user_id, trips), data.get('callback_url'))
+        except InvalidCallback as e:
+            return JSONResponse({"msg": str(e)}, status_code=400)
+        except QueueFull as e:
+            return JSONResponse({"msg": str(e)}, status_code=503, headers={'Retry-After': '30'})
+        status_url = api.url_path_for('get_job', job_id=job.id)
+        return JSONResponse({
+            "msg": "Trip batch generation queued",
+            "job_id": job.id,
+            "status_url": status_url
+        }, status_code=202, headers={'Location': status_url})
+
+    results = await generate_itineraries_with_coords(trips)
+    generated, records = batch_records(user_id, trips, results)
+    inserted = []
+    if records:
+        print(f"Attempting to insert {len(records)} trips with user_id: {user_id}")
+        try:
+            inserted = (await async_user_db(token).table('trips').insert(records).execute()).data
+        except Exception as e:
+            print(f"Error saving trip batch: {e}")
+            inserted = e
+    result = batch_result(results, generated, inserted)
+    return JSONResponse(result, status_code=batch_status(result))
+
+
+@api.post('/trips/stream')
+async def create_trip_stream(request: Request):
+    """Same as POST /trips, but streams the plan day by day as Server-Sent Events."""
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    data = await request.json()
+    if not all(k in data for k in REQUIRED_TRIP_FIELDS):
+        return JSONResponse({"msg": f"Missing required fields. Required: {REQUIRED_TRIP_FIELDS}"}, status_code=400)
+    dates_error = trip_dates_error(data)
+    if dates_error:
+        return JSONResponse({"msg": dates_error}, status_code=400)
+    user_id = user.user.id
+    db = async_user_db(bearer_token(request))
+
+    async def events():
+        try:
+            plan = None
+            async for event, payload in stream_itinerary_with_coords(
+                data['destination'],
+                data['start_date'],
+                data['end_date'],
+                data.get('budget'),
+                data.get('interests', []),
+                data['current_location']
+            ):
+                if event == 'plan':
+                    plan = payload
+                else:
+                    yield sse_event(event, payload)
+
+            trip_data = build_trip_record(user_id, data, plan)
+            response = await db.table('trips').insert(trip_data).execute()
+            yield sse_event('done', {"msg": "Trip created successfully", "trip_id": response.data[0]['id']})
+        except Exception as e:
+            print(f"Error streaming trip: {e}")
+            yield sse_event('error', {"msg": f"Failed to create trip: {str(e)}"})
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@api.get('/jobs/{job_id}')
+async def get_job(job_id: str, request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+
+    job = await asyncio.to_thread(trip_jobs.get, job_id, user.user.id)
+    if not job:
+        return JSONResponse({"msg": "Job not found or not authorized"}, status_code=404)
+    return JSONResponse(job.to_dict(), status_code=200)
+
+
+def etag_matches(request, etag):
+    """If-None-Match check as done by Flask's make_conditional (weak comparison)."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix('W/').strip('"') for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+@api.get('/trips')
+async def get_trips(request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+
+    limit = min(max(int_arg(request, 'limit', TRIPS_PAGE_DEFAULT), 1), TRIPS_PAGE_MAX)
+    fields = TRIP_SUMMARY_FIELDS
+    if request.query_params.get('fields'):
+        fields = [field.strip() for field in request.query_params['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in TRIP_FIELDS]
+        if unknown:
+            return JSONResponse({"msg": f"Unknown fields: {unknown}. Allowed: {TRIP_FIELDS}"}, status_code=400)
+        if 'id' not in fields:
+            fields = ['id'] + fields # The cursor is built from the id
+    cursor = request.query_params.get('cursor')
+    try:
+        cursor_id = decode_cursor(cursor) if cursor else None
+    except (ValueError, KeyError, TypeError):
+        return JSONResponse({"msg": "Invalid cursor"}, status_code=400)
+
+    try:
+        query = async_user_db(bearer_token(request)).table('trips').select(','.join(fields)).order('id', desc=True).limit(limit + 1)
+        if cursor_id is not None:
+            query = query.lt('id', cursor_id)
+        response = await query.execute()
+    except Exception as e:
+        return JSONResponse({"msg": f"Failed to retrieve trips: {e}"}, status_code=500)
+
+    trips = response.data[:limit]
+    result = JSONResponse(trips)
+    if len(response.data) > limit:
+        next_cursor = encode_cursor(trips[-1]['id'])
+        next_args = {**dict(request.query_params), 'cursor': next_cursor}
+        result.headers['X-Next-Cursor'] = next_cursor
+        result.headers['Link'] = f'<{request.url.path}?{urlencode(next_args)}>; rel="next"'
+    etag = hashlib.sha256(result.body).hexdigest()[:32]
+    result.headers['ETag'] = f'"{etag}"'
+    result.headers['Cache-Control'] = 'private, no-cache'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={
+            name: result.headers[name] for name in ('ETag', 'Cache-Control', 'X-Next-Cursor', 'Link')
+            if name in result.headers
+        })
+    return result
+
+
+@api.get('/trips/{trip_id}')
+async def get_trip(trip_id: int, request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+
+    try:
+        response = await async_user_db(bearer_token(request)).table('trips').select('*').eq('id', trip_id).execute()
+        if not response.data:
+            return JSONResponse({"msg": "Trip not found or not authorized"}, status_code=404)
+        return JSONResponse(response.data[0], status_code=200)
+    except Exception as e:
+        return JSONResponse({"msg": f"Failed to retrieve trip: {e}"}, status_code=500)
+
+
+@api.put('/trips/{trip_id}')
+async def update_trip(trip_id: int, request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    data = await request.json()
+
+    try:
+        if 'name' in data and not data['name']:
+            data['name'] = "Untitled Trip" # Prevent setting name to empty string if it's NOT NULL
+
+        response = await async_user_db(bearer_token(request)).table('trips').update(data).eq('id', trip_id).eq('user_id', user.user.id).execute()
+        if not response.data:
+            return JSONResponse({"msg": "Trip not found or not authorized"}, status_code=404)
+        return JSONResponse({"msg": "Trip updated successfully", "trip": response.data[0]}, status_code=200)
+    except Exception as e:
+        return JSONResponse({"msg": f"Failed to update trip: {e}"}, status_code=500)
+
+
+@api.delete('/trips/{trip_id}')
+async def delete_trip(trip_id: int, request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+
+    try:
+        response = await async_user_db(bearer_token(request)).table('trips').delete().eq('id', trip_id).eq('user_id', user.user.id).execute()
+        if not response.data:
+            return JSONResponse({"msg": "Trip not found or not authorized"}, status_code=404)
+        return JSONResponse({"msg": "Trip deleted successfully"}, status_code=200)
+    except Exception as e:
+        return JSONResponse({"msg": f"Failed to delete trip: {e}"}, status_code=500)
+
+
+# --- Standalone Transport Routes ---
+@api.get('/transport/flights')
+async def get_flights_standalone(request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    origin = request.query_params.get('origin')
+    destination = request.query_params.get('destination')
+    date = request.query_params.get('date')
+    if not all([origin, destination, date]):
+        return JSONResponse({"msg": "Missing required query parameters: origin, destination, date"}, status_code=400)
+    adults = int_arg(request, 'adults', 1)
+    # The Amadeus SDK is synchronous.
+    flight_options = await asyncio.to_thread(get_flight_options, origin, destination, date, adults)
+    return JSONResponse(flight_options)
+
+
+@api.get('/transport/trains')
+async def get_trains_standalone(request: Request):
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    origin = request.query_params.get('origin')
+    destination = request.query_params.get('destination')
+    date = request.query_params.get('date')
+    if not all([origin, destination, date]):
+        return JSONResponse({"msg": "Missing required query parameters: origin, destination, date"}, status_code=400)
+    return JSONResponse(simulate_train_options(origin, destination, date))
+
+
+# --- Operational Routes ---
+@api.get('/cache/stats')
+async def get_cache_stats(request: Request):
+    """Hit/miss counters of the local caches, used to tune TTLs and bucketing."""
+    user, error = await get_user_from_token(request)
+    if error: return JSONResponse(error, status_code=401)
+    def collect_stats():
+        return {
+            "geocode": geocache.stats(),
+            "plan": plancache.stats(),
+            "amadeus": amadeus_cache.stats(),
+            "weather": weathercache.stats(),
+            "generation": promptplan.stats()
+        }
+    return JSONResponse(await asyncio.to_thread(collect_stats), status_code=200)
+
+
+class RequestMetrics:
+    """Times the async API routes and adds their Server-Timing header.
+
+    Everything else is served by the mounted Flask app, whose own request
+    hooks time it (and serve /metrics).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(api.prefix + "/"):
+            return await self.app(scope, receive, send)
+        started = metrics.start_request()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    timing = (b"server-timing", metrics.server_timing(started).encode())
+                    message = {**message, "headers": [*message.get("headers", []), timing]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # The router stores the matched route in the scope; its path is the template, e.g. /api/v1/trips/{trip_id}.
+            route = scope.get("route")
+            metrics.finish_request(scope["method"], route.path if route else "unmatched", status, started)
+
+
+# The API contract is documented in swagger.yaml, served by the Flask app below.
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['X-Next-Cursor', 'Link', 'ETag'])
+app.add_middleware(RequestMetrics)
+app.include_router(api)
+app.mount('/', WSGIMiddleware(flask_app))
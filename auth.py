@@ -0,0 +1,167 @@
+# auth.py
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+import jwt
+import metrics
+from db import auth_client
+from config import (
+    SUPABASE_URL,
+    SUPABASE_JWT_SECRET,
+    JWT_AUDIENCE,
+    JWKS_CACHE_SECONDS,
+    AUTH_CACHE_SIZE
+)
+
+# Asymmetric Supabase projects publish their signing keys here. PyJWKClient
+# caches the key set and refetches it after `lifespan` or on an unknown kid.
+_jwks_client = jwt.PyJWKClient(
+    f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json",
+    cache_keys=True,
+    lifespan=JWKS_CACHE_SECONDS
+) if SUPABASE_URL else None
+
+# Token errors that mean "this token is bad", as opposed to "we could not check it here".
+_REJECTED = (
+    jwt.ExpiredSignatureError,
+    jwt.InvalidSignatureError,
+    jwt.InvalidAudienceError,
+    jwt.ImmatureSignatureError,
+    jwt.InvalidIssuerError,
+    jwt.MissingRequiredClaimError,
+    jwt.DecodeError
+)
+
+# Tokens are only ever checked with these; the token's own header does not get a say.
+_JWKS_ALGORITHMS = ('RS256', 'ES256')
+_ISSUER = f"{SUPABASE_URL}/auth/v1" if SUPABASE_URL else None
+
+stats = {"cache_hits": 0, "local_verifications": 0, "remote_verifications": 0}
+_stats_lock = threading.Lock()
+metrics.describe("travel_auth_verifications_total", "counter", "Access token checks by how they were answered.", ["method"])
+
+
+def _count(key):
+    with _stats_lock:
+        stats[key] += 1
+
+
+def _metric_samples():
+    with _stats_lock:
+        return [
+            ("travel_auth_verifications_total", (method,), stats[key])
+            for method, key in (("cache", "cache_hits"), ("local", "local_verifications"), ("remote", "remote_verifications"))
+        ]
+
+
+metrics.register_collector(_metric_samples)
+
+
+class CannotVerifyLocally(Exception):
+    pass
+
+
+class _VerifiedClaimsCache:
+    """Small LRU of verified users keyed by token hash; entries die with the token."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def put(self, key, user, expires_at):
+        with self._lock:
+            self._entries[key] = (user, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+_verified = _VerifiedClaimsCache(AUTH_CACHE_SIZE)
+
+
+def user_from_claims(claims):
+    """Builds an object shaped like supabase's UserResponse (user.user.id) from JWT claims."""
+    return SimpleNamespace(user=SimpleNamespace(
+        id=claims['sub'],
+        email=claims.get('email'),
+        role=claims.get('role'),
+        app_metadata=claims.get('app_metadata', {}),
+        user_metadata=claims.get('user_metadata', {})
+    ), claims=claims)
+
+
+def _verify_locally(token):
+    options = {"require": ["exp", "sub", "iss"] if _ISSUER else ["exp", "sub"]}
+    # The unverified header only picks the key source; the algorithm checked is
+    # fixed for the shared secret and taken from the JWK for published keys.
+    if jwt.get_unverified_header(token).get('alg') == 'HS256':
+        if not SUPABASE_JWT_SECRET:
+            raise CannotVerifyLocally("SUPABASE_JWT_SECRET is not configured")
+        return jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=['HS256'],
+                          audience=JWT_AUDIENCE, issuer=_ISSUER, options=options)
+    if _jwks_client is None:
+        raise CannotVerifyLocally("No JWKS endpoint configured")
+    try:
+        signing_key = _jwks_client.get_signing_key_from_jwt(token)
+    except (jwt.PyJWKClientError, jwt.exceptions.PyJWKError) as e:
+        # Includes a missing `cryptography` package for RS256/ES256 keys.
+        raise CannotVerifyLocally(str(e))
+    if signing_key.algorithm_name not in _JWKS_ALGORITHMS:
+        raise CannotVerifyLocally(f"Unsupported JWKS key algorithm {signing_key.algorithm_name}")
+    return jwt.decode(token, signing_key.key, algorithms=[signing_key.algorithm_name],
+                      audience=JWT_AUDIENCE, issuer=_ISSUER, options=options)
+
+
+def token_seconds_left(token):
+    """Seconds until an already authenticated token expires."""
+    return jwt.decode(token, options={"verify_signature": False}).get('exp', 0) - time.time()
+
+
+def authenticate(token):
+    """Returns the user for a Supabase access token, or raises if it is invalid.
+
+    Tokens are verified locally against the project's JWT secret or JWKS and
+    the result is cached until the token expires, so most requests never
+    leave the process. Supabase Auth is only called when the token cannot be
+    checked locally. As with any stateless JWT check, a session revoked
+    server-side stays usable locally until its access token expires.
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    user = _verified.get(key)
+    if user is not None:
+        _count("cache_hits")
+        return user
+
+    try:
+        claims = _verify_locally(token)
+        _count("local_verifications")
+        user = user_from_claims(claims)
+        _verified.put(key, user, claims['exp'])
+        return user
+    except _REJECTED:
+        raise
+    except (CannotVerifyLocally, jwt.InvalidAlgorithmError) as e:
+        print(f"Falling back to remote token check: {e}")
+
+    _count("remote_verifications")
+    user = auth_client().get_user(token)
+    if not user or not user.user:
+        raise Exception("Token was not accepted by Supabase Auth")
+    expires_at = jwt.decode(token, options={"verify_signature": False}).get('exp', time.time())
+    _verified.put(key, user, expires_at)
+    return user
@@ -0,0 +1,400 @@
+# bench/run.py
+"""Offline benchmark of the trip API against recorded upstreams.
+
+    python -m bench.run --requests 200 --concurrency 16
+    python -m bench.run --target asgi --upstream gemini.error_rate=0.05
+    python -m bench.run --env PLAN_CACHE_ENABLED=false --latency-scale 0.1 --output before.json
+
+Every upstream (Gemini, Nominatim, Open-Meteo, Amadeus, Supabase) is answered
+by bench/upstreams.py from bench/fixtures/, with configurable latency and
+error injection, while the app's own HTTP layers, SDKs and caches run as in
+production. Reports p50/p95/p99 latency and throughput per endpoint, per
+pipeline stage and per upstream.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import httpx  # noqa: E402
+import jwt  # noqa: E402
+import numpy as np  # noqa: E402
+from bench.upstreams import Upstreams, ReplayTransport, AsyncReplayTransport, load_fixture, DEFAULT_PROFILES  # noqa: E402
+
+BENCH_SUPABASE_URL = "https://bench.supabase.co"
+BENCH_JWT_SECRET = "bench-jwt-secret"
+
+# (module, function, stage) pairs timed during a run. Names imported into
+# services_async are wrapped there too, for the asgi target.
+STAGES = [
+    ("plancache", "lookup", "plan cache lookup"),
+    ("services", "geocode", "destination geocode"),
+    ("services", "get_weather_forecast", "weather"),
+    ("services", "get_transport_recommendation", "transport"),
+    ("services", "generate_days", "generation"),
+    ("services", "stream_gemini_text", "generation (stream)"),
+    ("services", "regenerate_day", "day regeneration"),
+    ("services", "attach_weather_and_locations", "POI geocoding + weather"),
+    ("services_async", "geocode", "destination geocode"),
+    ("services_async", "get_weather_forecast", "weather"),
+    ("services_async", "get_transport_recommendation", "transport"),
+    ("services_async", "generate_days", "generation"),
+    ("services_async", "stream_gemini_text", "generation (stream)"),
+    ("services_async", "regenerate_day", "day regeneration"),
+    ("services_async", "attach_weather_and_locations", "POI geocoding + weather")
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the trip API against recorded upstreams.")
+    parser.add_argument("--target", choices=["flask", "asgi", "services"], default="flask",
+                        help="Drive the Flask app, the ASGI app, or services.generate_itinerary_with_coords directly")
+    parser.add_argument("--requests", type=int, default=100, help="Number of requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--workload", default=os.path.join(BENCH_DIR, "workload.json"), help="Request mix")
+    parser.add_argument("--fixtures", default=os.path.join(BENCH_DIR, "fixtures"), help="Recorded upstream responses")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the request mix, latencies and injected errors")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies every upstream delay")
+    parser.add_argument("--upstream", action="append", default=[], metavar="NAME.FIELD=VALUE",
+                        help=f"Override an upstream profile, e.g. gemini.per_day=0.8 (upstreams: {', '.join(DEFAULT_PROFILES)})")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Set a config.py environment variable for the run, e.g. GENERATION_CHUNK_DAYS=5")
+    parser.add_argument("--cache-dir", help="Directory for the SQLite caches (default: a fresh temporary one, i.e. cold caches)")
+    parser.add_argument("--output", help="Also write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own log output")
+    return parser.parse_args()
+
+
+def parse_assignments(items):
+    assignments = {}
+    for item in items:
+        key, separator, value = item.partition("=")
+        if not separator:
+            raise SystemExit(f"Expected KEY=VALUE, got '{item}'")
+        assignments[key.strip()] = value.strip()
+    return assignments
+
+
+def upstream_profiles(items):
+    profiles = defaultdict(dict)
+    for key, value in parse_assignments(items).items():
+        name, _, field = key.partition(".")
+        if name not in DEFAULT_PROFILES or field not in DEFAULT_PROFILES[name]:
+            raise SystemExit(f"Unknown upstream setting '{key}'. Profiles: {json.dumps(DEFAULT_PROFILES)}")
+        profiles[name][field] = float(value)
+    return profiles
+
+
+def configure_environment(cache_dir, overrides):
+    """Points config.py at the stand-ins and at `cache_dir`. Must run before the app is imported."""
+    os.environ.update({
+        "SUPABASE_URL": BENCH_SUPABASE_URL,
+        "SUPABASE_KEY": "bench-anon-key",
+        "SUPABASE_JWT_SECRET": BENCH_JWT_SECRET,
+        "GEMINI_API_KEY": "bench-gemini-key",
+        "AMADEUS_API_KEY": "bench-amadeus-key",
+        "AMADEUS_API_SECRET": "bench-amadeus-secret",
+        "NOMINATIM_SELF_HOSTED_DOMAIN": "",
+        "GAZETTEER_PATH": "",
+        "GEOCODE_CACHE_PATH": os.path.join(cache_dir, "geocode.sqlite"),
+        "GEOCODE_BUCKET_PATH": os.path.join(cache_dir, "geocode.sqlite"),
+        "AMADEUS_CACHE_PATH": os.path.join(cache_dir, "amadeus.sqlite"),
+        "WEATHER_CACHE_PATH": os.path.join(cache_dir, "weather.sqlite"),
+        "PLAN_CACHE_PATH": os.path.join(cache_dir, "plan.sqlite"),
+        "JOB_STORE_PATH": os.path.join(cache_dir, "jobs.sqlite"),
+        **overrides
+    })
+
+
+# --- Measurements ---
+class Samples:
+    """Latencies and failures per name, safe to add to from any thread."""
+
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, ok=True):
+        with self._lock:
+            self.seconds[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def summary(self, wall_seconds):
+        rows = {}
+        for name, values in self.seconds.items():
+            values = np.asarray(values) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            rows[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "rps": round(len(values) / wall_seconds, 2),
+                "mean_ms": round(float(values.mean()), 1),
+                "p50_ms": round(float(p50), 1),
+                "p95_ms": round(float(p95), 1),
+                "p99_ms": round(float(p99), 1),
+                "max_ms": round(float(values.max()), 1)
+            }
+        return rows
+
+
+def timed(fn, stage, samples):
+    """Wraps fn (plain, generator, coroutine or async generator function) to record its duration."""
+    if inspect.isasyncgenfunction(fn):
+        async def wrapper(*args, **kwargs):
+            started, ok = time.perf_counter(), False
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+                ok = True
+            finally:
+                samples.add(stage, time.perf_counter() - started, ok)
+    elif inspect.iscoroutinefunction(fn):
+        async def wrapper(*args, **kwargs):
+            started, ok = time.perf_counter(), False
+            try:
+                value = await fn(*args, **kwargs)
+                ok = True
+                return value
+            finally:
+                samples.add(stage, time.perf_counter() - started, ok)
+    elif inspect.isgeneratorfunction(fn):
+        def wrapper(*args, **kwargs):
+            started, ok = time.perf_counter(), False
+            try:
+                yield from fn(*args, **kwargs)
+                ok = True
+            finally:
+                samples.add(stage, time.perf_counter() - started, ok)
+    else:
+        def wrapper(*args, **kwargs):
+            started, ok = time.perf_counter(), False
+            try:
+                value = fn(*args, **kwargs)
+                ok = True
+                return value
+            finally:
+                samples.add(stage, time.perf_counter() - started, ok)
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+
+def instrument_stages(samples, module_names):
+    for module_name, function_name, stage in STAGES:
+        if module_name in module_names:
+            module = sys.modules[module_name]
+            setattr(module, function_name, timed(getattr(module, function_name), stage, samples))
+
+
+# --- Workload ---
+def build_plan(workload, count, seed, trip_ids):
+    """Draws `count` concrete requests from the weighted mix in the workload file."""
+    rng = random.Random(seed)
+    entries = workload["requests"]
+    plan = []
+    for entry in rng.choices(entries, weights=[entry.get("weight", 1) for entry in entries], k=count):
+        start_date = (date.today() + timedelta(days=entry.get("starts_in", entry.get("trip", {}).get("starts_in", 7))))
+        body = None
+        if "trip" in entry:
+            trip = entry["trip"]
+            body = {
+                "destination": trip["destination"],
+                "current_location": trip["current_location"],
+                "start_date": start_date.isoformat(),
+                "end_date": (start_date + timedelta(days=trip["days"] - 1)).isoformat(),
+                "budget": trip.get("budget"),
+                "interests": trip.get("interests", [])
+            }
+        path = entry["path"].format(trip_id=rng.choice(trip_ids) if trip_ids else 1, start_date=start_date.isoformat())
+        plan.append({"name": entry["name"], "method": entry["method"], "path": path, "json": body})
+    return plan
+
+
+def seed_trips(upstreams, user, count, fixtures_dir):
+    days = load_fixture("gemini", fixtures_dir)["days"]
+    rows = []
+    for i in range(count):
+        start_date = date.today() + timedelta(days=30 + i)
+        rows.append({
+            "user_id": user["id"],
+            "name": f"Trip {i + 1}",
+            "destination": "Goa",
+            "start_date": start_date.isoformat(),
+            "end_date": (start_date + timedelta(days=len(days) - 1)).isoformat(),
+            "budget": {"min": 15000, "max": 40000, "currency": "INR"},
+            "interests": ["beaches", "food"],
+            "itinerary": days,
+            "transport_recommendation": None
+        })
+    return [row["id"] for row in upstreams.seed("trips", rows)]
+
+
+def access_token(user):
+    return jwt.encode({
+        "sub": user["id"], "email": user["email"], "role": "authenticated", "aud": "authenticated",
+        "iss": f"{BENCH_SUPABASE_URL}/auth/v1", "exp": int(time.time()) + 24 * 3600
+    }, BENCH_JWT_SECRET, algorithm="HS256")
+
+
+def succeeded(status, body):
+    # Streams always answer 200; a failure is reported as an `error` event.
+    return status < 400 and b"event: error" not in body
+
+
+# --- Targets ---
+def run_flask(plan, concurrency, headers, endpoints):
+    from app import app
+    local = threading.local()
+
+    def send(item):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        response = local.client.open(item["path"], method=item["method"], json=item["json"], headers=headers, buffered=False)
+        chunks = []
+        first_day = None
+        for chunk in response.iter_encoded():
+            if first_day is None and b"event: day" in chunk:
+                first_day = time.perf_counter() - started
+            chunks.append(chunk)
+        response.close()
+        ok = succeeded(response.status_code, b"".join(chunks))
+        endpoints.add(item["name"], time.perf_counter() - started, ok)
+        if first_day is not None:
+            endpoints.add(f"{item['name']} first day", first_day, ok)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(send, item) for item in plan]:
+            future.result()
+
+
+def run_asgi(plan, concurrency, headers, endpoints):
+    import asgi
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        # ASGITransport hands over whole responses, so streams report only their total time.
+        async with asgi.lifespan(asgi.app), httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=asgi.app), base_url="http://bench", timeout=None
+        ) as client:
+            async def send(item):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.request(item["method"], item["path"], json=item["json"], headers=headers)
+                    endpoints.add(item["name"], time.perf_counter() - started, succeeded(response.status_code, response.content))
+            await asyncio.gather(*[send(item) for item in plan])
+
+    asyncio.run(main())
+
+
+def run_services(plan, concurrency, headers, endpoints):
+    import services
+
+    def send(item):
+        body = item["json"]
+        started, ok = time.perf_counter(), False
+        try:
+            services.generate_itinerary_with_coords(body["destination"], body["start_date"], body["end_date"],
+                                                    body.get("budget"), body.get("interests", []), body["current_location"])
+            ok = True
+        except Exception as e:
+            print(f"Trip generation failed: {e}")
+        endpoints.add(item["name"], time.perf_counter() - started, ok)
+
+    # Only trip requests map onto the service; the rest of the mix is skipped.
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(send, item) for item in plan if item["json"]]:
+            future.result()
+
+
+TARGETS = {"flask": run_flask, "asgi": run_asgi, "services": run_services}
+
+
+# --- Report ---
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"  {'':<38}{'n':>6}{'err':>6}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in sorted(rows.items()):
+        print(f"  {name:<38}{row['count']:>6}{row['errors']:>6}{row['rps']:>8}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+
+def main():
+    args = parse_args()
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="travel-bench-")
+    os.makedirs(cache_dir, exist_ok=True)
+    configure_environment(cache_dir, parse_assignments(args.env))
+    with open(args.workload) as f:
+        workload = json.load(f)
+
+    upstreams = Upstreams(BENCH_SUPABASE_URL, upstream_profiles(args.upstream), args.latency_scale, args.seed, args.fixtures)
+    import config
+    config.outbound.transport = ReplayTransport(upstreams)
+    config.async_outbound.transport = AsyncReplayTransport(upstreams)
+    import services
+    modules = {"plancache", "services"}
+    if args.target == "asgi":
+        import services_async  # noqa: F401
+        modules.add("services_async")
+    stages = Samples()
+    instrument_stages(stages, modules)
+
+    user = workload["user"]
+    trip_ids = seed_trips(upstreams, user, workload.get("seed_trips", 0), args.fixtures)
+    plan = build_plan(workload, args.requests, args.seed, trip_ids)
+    headers = {"Authorization": f"Bearer {access_token(user)}"}
+    endpoints = Samples()
+
+    print(f"Running {len(plan)} requests against {args.target} at concurrency {args.concurrency} (caches in {cache_dir})")
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        TARGETS[args.target](plan, args.concurrency, headers, endpoints)
+    wall_seconds = time.perf_counter() - started
+
+    import geocache, plancache, amadeus_cache, weathercache, promptplan
+    results = {
+        "target": args.target,
+        "requests": sum(len(values) for name, values in endpoints.seconds.items() if not name.endswith(" first day")),
+        "concurrency": args.concurrency,
+        "wall_seconds": round(wall_seconds, 3),
+        "endpoints": endpoints.summary(wall_seconds),
+        "stages": stages.summary(wall_seconds),
+        "upstreams": {name: {**calls, "seconds": round(calls["seconds"], 3)} for name, calls in upstreams.calls.items()},
+        "caches": {
+            "geocode": geocache.stats(),
+            "plan": plancache.stats(),
+            "amadeus": amadeus_cache.stats(),
+            "weather": weathercache.stats(),
+            "generation": {key: value for key, value in promptplan.stats().items() if key != "recent"}
+        }
+    }
+    results["throughput_rps"] = round(results["requests"] / wall_seconds, 2)
+
+    print(f"{results['requests']} requests in {results['wall_seconds']}s ({results['throughput_rps']} req/s)")
+    print_table("Endpoints", results["endpoints"])
+    print_table("Stages", results["stages"])
+    print("\nUpstreams")
+    for name, calls in results["upstreams"].items():
+        print(f"  {name:<38}{calls['calls']:>6} calls{calls['errors']:>6} injected errors{calls['seconds']:>10}s simulated")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
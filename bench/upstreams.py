@@ -0,0 +1,406 @@
+# bench/upstreams.py
+# Stand-ins for every upstream the API calls, served from the recorded
+# responses in bench/fixtures/ through an httpx transport, so the real
+# OutboundHTTP / AsyncOutboundHTTP layers, SDKs and caches run unchanged
+# with no network. Each upstream gets its own latency and error profile.
+import asyncio
+import copy
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import date
+import flatbuffers
+import httpx
+import jwt
+import numpy as np
+from openmeteo_sdk.Aggregation import Aggregation
+from openmeteo_sdk.Variable import Variable
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Median latency in seconds, lognormal spread and share of requests answered
+# with a 503. Gemini also takes `per_day` seconds for every day it writes, and
+# returns a day without its afternoon for `invalid_day_rate` of the days.
+DEFAULT_PROFILES = {
+    "gemini": {"latency": 1.5, "per_day": 1.2, "jitter": 0.25, "error_rate": 0.0, "invalid_day_rate": 0.0},
+    "nominatim": {"latency": 0.3, "jitter": 0.3, "error_rate": 0.0},
+    "open_meteo": {"latency": 0.15, "jitter": 0.3, "error_rate": 0.0},
+    "amadeus": {"latency": 0.6, "jitter": 0.4, "error_rate": 0.0},
+    "supabase": {"latency": 0.04, "jitter": 0.3, "error_rate": 0.0}
+}
+
+HOSTS = {
+    "generativelanguage.googleapis.com": "gemini",
+    "nominatim.openstreetmap.org": "nominatim",
+    "api.open-meteo.com": "open_meteo",
+    "test.api.amadeus.com": "amadeus",
+    "api.amadeus.com": "amadeus"
+}
+
+# PostgREST query parameters that are not row filters.
+REST_RESERVED_PARAMS = {"select", "order", "limit", "offset", "columns", "on_conflict"}
+REST_OPERATORS = {
+    "eq": lambda a, b: a == b, "neq": lambda a, b: a != b,
+    "lt": lambda a, b: a < b, "lte": lambda a, b: a <= b,
+    "gt": lambda a, b: a > b, "gte": lambda a, b: a >= b
+}
+
+
+def load_fixture(name, fixtures_dir=FIXTURES_DIR):
+    with open(os.path.join(fixtures_dir, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+class Reply:
+    """An upstream answer: status, headers and body parts, each sent after its own delay."""
+
+    def __init__(self, upstream, status, headers, parts):
+        self.upstream = upstream
+        self.status = status
+        self.headers = headers
+        self.parts = parts
+
+
+def _json_reply(upstream, status, payload, delay, content_type="application/json"):
+    return Reply(upstream, status, {"Content-Type": content_type}, [(delay, json.dumps(payload).encode())])
+
+
+def forecast_message(lat, lon, start_date, end_date, daily, utc_offset_seconds):
+    """One length-prefixed WeatherApiResponse FlatBuffer, as Open-Meteo sends for format=flatbuffers.
+
+    The recorded daily series is repeated by calendar day, so any date range
+    gets stable values.
+    """
+    first = date.fromisoformat(start_date)
+    days = (date.fromisoformat(end_date) - first).days + 1
+    cycle = len(daily["weather_code"])
+    index = [(first.toordinal() + i) % cycle for i in range(days)]
+
+    builder = flatbuffers.Builder(1024)
+    variables = []
+    for variable, aggregation, series in (
+        (Variable.weather_code, None, daily["weather_code"]),
+        (Variable.temperature, Aggregation.maximum, daily["temperature_2m_max"]),
+        (Variable.temperature, Aggregation.minimum, daily["temperature_2m_min"])
+    ):
+        values = builder.CreateNumpyVector(np.asarray([series[i] for i in index], dtype=np.float32))
+        builder.StartObject(12)
+        builder.PrependUOffsetTRelativeSlot(3, values, 0)
+        builder.PrependUint8Slot(0, variable, 0)
+        if aggregation is not None:
+            builder.PrependUint8Slot(6, aggregation, 0)
+        variables.append(builder.EndObject())
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    variables_vector = builder.EndVector()
+
+    # Daily time steps are local midnights expressed in UTC.
+    start = (first.toordinal() - date(1970, 1, 1).toordinal()) * 86400 - utc_offset_seconds
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, start + days * 86400, 0)
+    builder.PrependInt32Slot(2, 86400, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    daily_table = builder.EndObject()
+
+    builder.StartObject(14)
+    builder.PrependFloat32Slot(0, lat, 0.0)
+    builder.PrependFloat32Slot(1, lon, 0.0)
+    builder.PrependInt32Slot(6, utc_offset_seconds, 0)
+    builder.PrependUOffsetTRelativeSlot(10, daily_table, 0)
+    builder.Finish(builder.EndObject())
+    message = bytes(builder.Output())
+    return len(message).to_bytes(4, "little") + message
+
+
+class Upstreams:
+    """Answers requests to Gemini, Nominatim, Open-Meteo, Amadeus and Supabase from fixtures.
+
+    `profiles` overrides DEFAULT_PROFILES per upstream, e.g.
+    {"gemini": {"error_rate": 0.05}}; `latency_scale` multiplies every delay.
+    Supabase's REST API is emulated over in-memory tables, with row-level
+    security on `user_id` taken from the caller's JWT.
+    """
+
+    def __init__(self, supabase_url, profiles=None, latency_scale=1.0, seed=None, fixtures_dir=FIXTURES_DIR):
+        self.supabase_host = httpx.URL(supabase_url).host
+        self.profiles = {name: {**profile, **(profiles or {}).get(name, {})} for name, profile in DEFAULT_PROFILES.items()}
+        self.latency_scale = latency_scale
+        self.gemini = load_fixture("gemini", fixtures_dir)
+        self.places = load_fixture("nominatim", fixtures_dir)
+        self.weather = load_fixture("open_meteo", fixtures_dir)
+        self.amadeus = load_fixture("amadeus", fixtures_dir)
+        self.tables = {}
+        self._next_id = 1
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {name: {"calls": 0, "errors": 0, "seconds": 0.0} for name in DEFAULT_PROFILES}
+
+    # --- Latency and Errors ---
+    def _delay(self, name, days=0):
+        profile = self.profiles[name]
+        with self._lock:
+            spread = math.exp(self._random.gauss(0, profile["jitter"]))
+        return (profile["latency"] * spread + profile.get("per_day", 0) * days) * self.latency_scale
+
+    def _chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def answer(self, request):
+        """Returns the Reply for one httpx request."""
+        host = request.url.host
+        name = "supabase" if host == self.supabase_host else HOSTS.get(host)
+        if name is None:
+            raise httpx.ConnectError(f"No stand-in for {host}", request=request)
+
+        if self._chance(self.profiles[name]["error_rate"]):
+            reply = _json_reply(name, 503, {"error": "injected failure"}, self._delay(name))
+        else:
+            reply = getattr(self, f"_{name}")(request)
+        with self._lock:
+            stats = self.calls[name]
+            stats["calls"] += 1
+            stats["errors"] += reply.status >= 500
+            stats["seconds"] += sum(delay for delay, _ in reply.parts)
+        return reply
+
+    # --- Gemini ---
+    def _day(self, day_number):
+        templates = self.gemini["days"]
+        day = copy.deepcopy(templates[(day_number - 1) % len(templates)])
+        day["day"] = day_number
+        if self._chance(self.profiles["gemini"]["invalid_day_rate"]):
+            del day["afternoon"]
+        return day
+
+    def _gemini(self, request):
+        body = json.loads(request.content)
+        prompt = body["contents"][0]["parts"][0]["text"]
+        # The answer covers whatever the prompt asks for: one day, a segment or the whole trip.
+        single = re.search(r"Only day (\d+) is needed now", prompt)
+        segment = re.search(r"Plan only days (\d+) to (\d+)", prompt)
+        if single:
+            day_numbers = [int(single.group(1))]
+        elif segment:
+            day_numbers = list(range(int(segment.group(1)), int(segment.group(2)) + 1))
+        else:
+            day_numbers = list(range(1, int(re.search(r"a (\d+)-day trip", prompt).group(1)) + 1))
+        days = [json.dumps(self._day(day_number), ensure_ascii=False) for day_number in day_numbers]
+
+        structured = "generationConfig" in body
+        if single:
+            text = days[0]
+        else:
+            text = "[" + ",".join(days) + "]"
+        if not structured:
+            text = f"```json\n{text}\n```"
+        usage = {
+            "promptTokenCount": len(prompt) // 4,
+            "candidatesTokenCount": self.gemini["usage_per_day"]["candidatesTokenCount"] * len(days)
+        }
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+
+        def candidate(fragment):
+            return {"content": {"parts": [{"text": fragment}], "role": "model"}, "index": 0}
+
+        if request.url.path.endswith(":streamGenerateContent"):
+            # One SSE event per day, each after that day's generation time.
+            ends = []
+            for day in days:
+                ends.append(text.index(day, ends[-1] if ends else 0) + len(day))
+            ends[-1] = len(text)
+            fragments = [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+            parts = []
+            for i, fragment in enumerate(fragments):
+                event = {"candidates": [candidate(fragment)], "modelVersion": self.gemini["model_version"]}
+                if i == len(fragments) - 1:
+                    event["candidates"][0]["finishReason"] = "STOP"
+                    event["usageMetadata"] = usage
+                delay = self._delay("gemini", 1) if i == 0 else self.profiles["gemini"]["per_day"] * self.latency_scale
+                parts.append((delay, f"data: {json.dumps(event)}\r\n\r\n".encode()))
+            return Reply("gemini", 200, {"Content-Type": "text/event-stream"}, parts)
+
+        response = {
+            "candidates": [{**candidate(text), "finishReason": "STOP"}],
+            "usageMetadata": usage,
+            "modelVersion": self.gemini["model_version"]
+        }
+        return _json_reply("gemini", 200, response, self._delay("gemini", len(days)))
+
+    # --- Nominatim ---
+    def _nominatim(self, request):
+        query = " ".join(request.url.params.get("q", "").casefold().split())
+        place = self.places.get(query)
+        if place is None:
+            place = self._synthesized_place(query)
+        return _json_reply("nominatim", 200, [place], self._delay("nominatim"))
+
+    def _synthesized_place(self, query):
+        """A stable made-up result near the query's last known part, for names with no recording."""
+        parts = query.split(", ")
+        anchor = next((self.places[", ".join(parts[i:])] for i in range(1, len(parts)) if ", ".join(parts[i:]) in self.places),
+                      {"lat": "20.5937", "lon": "78.9629"})
+        seed = zlib.crc32(query.encode())
+        lat = float(anchor["lat"]) + ((seed & 0xFFFF) / 0xFFFF - 0.5) * 0.2
+        lon = float(anchor["lon"]) + ((seed >> 16) / 0xFFFF - 0.5) * 0.2
+        return {
+            "place_id": seed, "osm_type": "node", "osm_id": seed, "lat": f"{lat:.7f}", "lon": f"{lon:.7f}",
+            "class": "tourism", "type": "attraction", "place_rank": 30, "importance": 0.1,
+            "name": parts[0].title(), "display_name": ", ".join(part.title() for part in parts),
+            "boundingbox": [f"{lat - 0.001:.7f}", f"{lat + 0.001:.7f}", f"{lon - 0.001:.7f}", f"{lon + 0.001:.7f}"]
+        }
+
+    # --- Open-Meteo ---
+    def _open_meteo(self, request):
+        params = request.url.params
+        latitudes = [float(value) for value in params["latitude"].split(",")]
+        longitudes = [float(value) for value in params["longitude"].split(",")]
+        body = b"".join(
+            forecast_message(lat, lon, params["start_date"], params["end_date"],
+                             self.weather["daily"], self.weather["utc_offset_seconds"])
+            for lat, lon in zip(latitudes, longitudes)
+        )
+        return Reply("open_meteo", 200, {"Content-Type": "application/octet-stream"},
+                     [(self._delay("open_meteo"), body)])
+
+    # --- Amadeus ---
+    def _amadeus(self, request):
+        path = request.url.path
+        delay = self._delay("amadeus")
+        content_type = "application/vnd.amadeus+json"
+        if path.endswith("/security/oauth2/token"):
+            return _json_reply("amadeus", 200, self.amadeus["token"], delay, "application/json")
+        if path.endswith("/reference-data/locations"):
+            return _json_reply("amadeus", 200, self.amadeus["locations"], delay, content_type)
+        if path.endswith("/shopping/flight-offers"):
+            params = request.url.params
+            offers = copy.deepcopy(self.amadeus["flight_offers"])
+            for offer in offers["data"]:
+                segment = offer["itineraries"][0]["segments"][0]
+                segment["departure"]["iataCode"] = params.get("originLocationCode")
+                segment["arrival"]["iataCode"] = params.get("destinationLocationCode")
+                segment["departure"]["at"] = f"{params.get('departureDate')}T06:35:00"
+                segment["arrival"]["at"] = f"{params.get('departureDate')}T08:00:00"
+            return _json_reply("amadeus", 200, offers, delay, content_type)
+        return _json_reply("amadeus", 404, {"errors": [{"status": 404, "title": "RESOURCE NOT FOUND"}]}, delay, content_type)
+
+    # --- Supabase ---
+    def seed(self, table, rows):
+        """Adds rows to an in-memory table; ids are assigned like a serial column."""
+        with self._lock:
+            stored = []
+            for row in rows:
+                stored.append({**row, "id": self._next_id})
+                self._next_id += 1
+            self.tables.setdefault(table, []).extend(stored)
+            return stored
+
+    def _supabase(self, request):
+        delay = self._delay("supabase")
+        match = re.match(r"/rest/v1/(\w+)$", request.url.path)
+        if not match:
+            # Access tokens are verified locally in the bench, so Auth is never needed.
+            return _json_reply("supabase", 404, {"msg": f"No stand-in for {request.url.path}"}, delay)
+        token = request.headers.get("Authorization", "").split(" ")[-1]
+        try:
+            user_id = jwt.decode(token, options={"verify_signature": False}).get("sub")
+        except jwt.DecodeError:
+            user_id = None
+        status, rows = self._rest(request, match.group(1), user_id)
+        return _json_reply("supabase", status, rows, delay)
+
+    def _rest(self, request, table, user_id):
+        params = request.url.params
+        filters = []
+        for column, condition in params.multi_items():
+            if column not in REST_RESERVED_PARAMS:
+                operator, _, value = condition.partition(".")
+                filters.append((column, REST_OPERATORS[operator], value))
+
+        def visible(row):
+            if row.get("user_id") not in (None, user_id):
+                return False
+            for column, compare, value in filters:
+                current = row.get(column)
+                if current is None or not compare(current, type(current)(value)):
+                    return False
+            return True
+
+        with self._lock:
+            rows = self.tables.setdefault(table, [])
+            if request.method == "POST":
+                payload = json.loads(request.content)
+                created = []
+                for row in payload if isinstance(payload, list) else [payload]:
+                    created.append({**row, "id": self._next_id})
+                    self._next_id += 1
+                rows.extend(created)
+                return 201, created
+            matched = [row for row in rows if visible(row)]
+            if request.method == "PATCH":
+                changes = json.loads(request.content)
+                for row in matched:
+                    row.update(changes)
+                return 200, matched
+            if request.method == "DELETE":
+                self.tables[table] = [row for row in rows if not any(row is gone for gone in matched)]
+                return 200, matched
+
+            for order in reversed(params.get("order", "").split(",") if params.get("order") else []):
+                column, _, direction = order.partition(".")
+                matched.sort(key=lambda row: row.get(column), reverse=direction.startswith("desc"))
+            if params.get("limit"):
+                matched = matched[:int(params["limit"])]
+            columns = [column.strip() for column in params.get("select", "*").split(",")]
+            if "*" not in columns:
+                matched = [{column: row.get(column) for column in columns} for row in matched]
+            return 200, copy.deepcopy(matched)
+
+
+class ReplayTransport(httpx.BaseTransport):
+    """Sync httpx transport over Upstreams; sleeps for each part's delay like a slow server would."""
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+
+    def handle_request(self, request):
+        request.read()
+        reply = self.upstreams.answer(request)
+        if len(reply.parts) == 1:
+            delay, body = reply.parts[0]
+            time.sleep(delay)
+            return httpx.Response(reply.status, headers=reply.headers, content=body)
+
+        def body():
+            for delay, chunk in reply.parts:
+                time.sleep(delay)
+                yield chunk
+        return httpx.Response(reply.status, headers=reply.headers, content=body())
+
+
+class AsyncReplayTransport(httpx.AsyncBaseTransport):
+    """asyncio form of ReplayTransport, for AsyncOutboundHTTP."""
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        reply = self.upstreams.answer(request)
+        if len(reply.parts) == 1:
+            delay, body = reply.parts[0]
+            await asyncio.sleep(delay)
+            return httpx.Response(reply.status, headers=reply.headers, content=body)
+
+        async def body():
+            for delay, chunk in reply.parts:
+                await asyncio.sleep(delay)
+                yield chunk
+        return httpx.Response(reply.status, headers=reply.headers, content=body())
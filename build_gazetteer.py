@@ -0,0 +1,128 @@
+# build_gazetteer.py
+"""Builds the offline gazetteer index read by gazetteer.py.
+
+Usage:
+    python build_gazetteer.py data/gazetteer IN.txt [more files...]
+
+Inputs can be GeoNames dumps (e.g. IN.txt or cities15000.txt from
+https://download.geonames.org/export/dump/, plain or .zip) or CSV/TSV
+extracts with a header row containing name, lat and lon columns and an
+optional population column, such as Overpass `[out:csv(name, ::lat, ::lon)]`
+output or an `osmium export` converted to CSV.
+
+Then set GAZETTEER_PATH=data/gazetteer to use it.
+"""
+import argparse
+import csv
+import io
+import os
+import zipfile
+import numpy as np
+from gazetteer import FILES, normalize_name, name_grams
+
+# GeoNames feature classes worth indexing for POIs: populated places, spots
+# and buildings, parks and areas, water, terrain (beaches, hills), roads.
+DEFAULT_FEATURE_CLASSES = "PSLHTRV"
+
+
+def open_text(path):
+    if path.endswith(".zip"):
+        archive = zipfile.ZipFile(path)
+        member = next(name for name in archive.namelist() if name.endswith((".txt", ".csv", ".tsv")))
+        return io.TextIOWrapper(archive.open(member), encoding="utf-8")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_geonames(path, feature_classes, alternate_names):
+    """Yields (display name, indexed name, lat, lon, population) from a GeoNames dump."""
+    with open_text(path) as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 15 or columns[6] not in feature_classes:
+                continue
+            name, lat, lon = columns[1], float(columns[4]), float(columns[5])
+            population = float(columns[14] or 0)
+            variants = {name, columns[2]}
+            if alternate_names and columns[3]:
+                variants.update(columns[3].split(","))
+            for variant in variants:
+                if variant:
+                    yield name, variant, lat, lon, population
+
+
+def read_csv(path):
+    """Yields (display name, indexed name, lat, lon, population) from a CSV/TSV extract."""
+    with open_text(path) as f:
+        sample = f.read(4096)
+        f.seek(0)
+        reader = csv.DictReader(f, dialect=csv.Sniffer().sniff(sample, delimiters=",\t;"))
+        for row in reader:
+            row = {key.lstrip("@:").lower(): value for key, value in row.items() if key}
+            if not row.get("name") or not row.get("lat") or not row.get("lon"):
+                continue
+            yield row["name"], row["name"], float(row["lat"]), float(row["lon"]), float(row.get("population") or 0)
+
+
+def is_geonames(path):
+    with open_text(path) as f:
+        first = f.readline()
+    return first.count("\t") >= 14 and first.split("\t")[0].isdigit()
+
+
+def build(output_dir, paths, feature_classes=DEFAULT_FEATURE_CLASSES, alternate_names=False):
+    records = {}
+    for path in paths:
+        rows = read_geonames(path, feature_classes, alternate_names) if is_geonames(path) else read_csv(path)
+        for display_name, indexed_name, lat, lon, population in rows:
+            key = normalize_name(indexed_name)
+            if not key:
+                continue
+            # The same name at (almost) the same spot in several sources is one place.
+            records.setdefault((key, round(lat, 3), round(lon, 3)), (display_name, lat, lon, population))
+    print(f"Indexing {len(records)} names")
+
+    keys = list(records)
+    order = sorted(range(len(keys)), key=lambda i: records[keys[i]][1])
+    coords = np.array([records[keys[i]][1:3] for i in order], dtype=np.float32).reshape(-1, 2)
+    rank = np.array([records[keys[i]][3] for i in order], dtype=np.float32)
+
+    encoded = [records[keys[i]][0].encode("utf-8") for i in order]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+
+    gram_lists = [name_grams(keys[i][0]) for i in order]
+    gram_counts = np.array([len(grams) for grams in gram_lists], dtype=np.uint16)
+    all_grams = np.fromiter((gram for grams in gram_lists for gram in grams), dtype=np.uint32, count=int(gram_counts.sum()))
+    all_rows = np.repeat(np.arange(len(gram_lists), dtype=np.int32), gram_counts)
+    by_gram = np.lexsort((all_rows, all_grams))
+    all_grams, all_rows = all_grams[by_gram], all_rows[by_gram]
+    gram_keys, gram_starts = np.unique(all_grams, return_index=True)
+    gram_offsets = np.append(gram_starts, len(all_grams)).astype(np.int64)
+
+    os.makedirs(output_dir, exist_ok=True)
+    arrays = {
+        "coords": coords,
+        "rank": rank,
+        "gram_counts": gram_counts,
+        "name_offsets": name_offsets,
+        "gram_keys": gram_keys,
+        "gram_offsets": gram_offsets,
+        "gram_postings": all_rows
+    }
+    for key, array in arrays.items():
+        np.save(os.path.join(output_dir, FILES[key]), array)
+    with open(os.path.join(output_dir, FILES["names"]), "wb") as f:
+        f.write(b"".join(encoded))
+    print(f"Wrote {len(coords)} places and {len(gram_keys)} trigrams to {output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline gazetteer index.")
+    parser.add_argument("output_dir")
+    parser.add_argument("inputs", nargs="+", help="GeoNames dumps or CSV/TSV extracts")
+    parser.add_argument("--feature-classes", default=DEFAULT_FEATURE_CLASSES,
+                        help=f"GeoNames feature classes to keep (default {DEFAULT_FEATURE_CLASSES})")
+    parser.add_argument("--alternate-names", action="store_true",
+                        help="Also index GeoNames alternate names (larger index, better recall)")
+    args = parser.parse_args()
+    build(args.output_dir, args.inputs, args.feature_classes, args.alternate_names)
@@ -0,0 +1,147 @@
+# cache.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+metrics.describe("travel_cache_hits_total", "counter", "Local cache keys found.", ["cache"])
+metrics.describe("travel_cache_misses_total", "counter", "Local cache keys not found or expired.", ["cache"])
+
+
+class SQLiteCache:
+    """Small persistent key/value store on local disk with per-entry expiry.
+
+    Several namespaces can share one SQLite file. Values are stored as JSON, so
+    anything json.dumps accepts (including None, used for negative results)
+    can be cached. Hit and miss counters are kept per instance.
+
+    With `max_entries` set, reads record an access time and writes evict the
+    least recently used entries of the namespace beyond that limit.
+    """
+
+    def __init__(self, path, namespace, max_entries=None):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT,"
+                " expires_at REAL NOT NULL, last_access REAL NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entries)")]
+            if "last_access" not in columns:
+                # Cache files written before LRU support lack the access column.
+                self._conn.execute("ALTER TABLE entries ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+            self._conn.commit()
+        metrics.register_collector(self._metric_samples)
+
+    def _metric_samples(self):
+        return [
+            ("travel_cache_hits_total", (self.namespace,), self.hits),
+            ("travel_cache_misses_total", (self.namespace,), self.misses)
+        ]
+
+    def get(self, key, record=True):
+        """Returns (found, value) for a single key."""
+        result = self.get_many([key], record)
+        if key in result:
+            return True, result[key]
+        return False, None
+
+    def get_many(self, keys, record=True):
+        """Returns a dict of the keys that are present and not expired.
+
+        With `record` False the read is internal: it counts neither as a hit
+        or miss nor as an access for LRU eviction.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite limits the number of bound parameters, so query in slices.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM entries WHERE namespace = ? AND expires_at > ?"
+                    f" AND key IN ({placeholders})",
+                    [self.namespace, now] + chunk
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = json.loads(value)
+            if not record:
+                return found
+            if self.max_entries and found:
+                hit_keys = list(found)
+                for i in range(0, len(hit_keys), 500):
+                    chunk = hit_keys[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    self._conn.execute(
+                        f"UPDATE entries SET last_access = ? WHERE namespace = ? AND key IN ({placeholders})",
+                        [now, self.namespace] + chunk
+                    )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value, ttl):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items, ttl):
+        """Stores every key/value pair in `items` for `ttl` seconds."""
+        now = time.time()
+        rows = [(self.namespace, key, json.dumps(value), now + ttl, now) for key, value in items.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            if self.max_entries:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        """Drops expired entries, then the least recently used ones over max_entries."""
+        self._conn.execute(
+            "DELETE FROM entries WHERE namespace = ? AND expires_at <= ?", (self.namespace, now)
+        )
+        self._conn.execute(
+            "DELETE FROM entries WHERE namespace = ? AND key IN ("
+            " SELECT key FROM entries WHERE namespace = ? ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries)
+        )
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, time.time())
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            # Recent writes live in the WAL until the next checkpoint, so count it too.
+            "file_size_bytes": sum(os.path.getsize(path) for path in (self.path, self.path + "-wal")
+                                   if os.path.exists(path))
+        }
@@ -1,13 +1,10 @@
 # config.py
 import os
 from dotenv import load_dotenv
-from supabase import create_client, Client
 from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
 import openmeteo_requests
-import requests_cache
-from retry_requests import retry
 from amadeus import Client as AmadeusClient  # ✅ Correct
+from http_client import OutboundHTTP, AsyncOutboundHTTP, GeopyAdapter, amadeus_transport
 
 
 # Load environment variables from .env file
@@ -20,23 +17,156 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 AMADEUS_API_KEY = os.environ.get("AMADEUS_API_KEY")
 AMADEUS_API_SECRET = os.environ.get("AMADEUS_API_SECRET")
 
+# --- Auth Settings ---
+# With the project's JWT secret (or a JWKS-signed project) access tokens are verified locally.
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET")
+JWT_AUDIENCE = os.environ.get("JWT_AUDIENCE", "authenticated")
+JWKS_CACHE_SECONDS = int(os.environ.get("JWKS_CACHE_SECONDS", 600))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 1024))
+
+# --- Geocoding Scheduler ---
+# Lookups that miss the cache are queued and run by GEOCODE_WORKERS threads.
+# Each provider has a token bucket in GEOCODE_BUCKET_PATH that every process
+# on the host draws from, so workers together stay within the provider's policy.
+GEOCODE_WORKERS = int(os.environ.get("GEOCODE_WORKERS", 4))
+GEOCODE_BUCKET_PATH = os.environ.get("GEOCODE_BUCKET_PATH", ".geocode_cache.sqlite")
+# The public Nominatim usage policy allows at most one request per second.
+NOMINATIM_RATE_PER_SECOND = float(os.environ.get("NOMINATIM_RATE_PER_SECOND", 1))
+# Optional self-hosted Nominatim (e.g. "nominatim.internal:8080"), tried before the public one.
+NOMINATIM_SELF_HOSTED_DOMAIN = os.environ.get("NOMINATIM_SELF_HOSTED_DOMAIN")
+NOMINATIM_SELF_HOSTED_SCHEME = os.environ.get("NOMINATIM_SELF_HOSTED_SCHEME", "http")
+NOMINATIM_SELF_HOSTED_RATE_PER_SECOND = float(os.environ.get("NOMINATIM_SELF_HOSTED_RATE_PER_SECOND", 20))
+
+# Optional offline gazetteer built with build_gazetteer.py. POIs are matched
+# inside the destination's bounding box, widened to at least this radius.
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH")
+GAZETTEER_RADIUS_KM = float(os.environ.get("GAZETTEER_RADIUS_KM", 30))
+# Trigram similarity (0-1) a name must reach to count as a match.
+GAZETTEER_MIN_SCORE = float(os.environ.get("GAZETTEER_MIN_SCORE", 0.75))
+# Destination search boxes kept in memory, least recently used dropped first.
+GAZETTEER_BBOX_CACHE_SIZE = int(os.environ.get("GAZETTEER_BBOX_CACHE_SIZE", 1024))
+
+# --- Local Cache Settings ---
+GEOCODE_CACHE_PATH = os.environ.get("GEOCODE_CACHE_PATH", ".geocode_cache.sqlite")
+GEOCODE_CACHE_TTL_SECONDS = int(os.environ.get("GEOCODE_CACHE_TTL_SECONDS", 90 * 24 * 3600))
+# "Not found" answers are kept for a shorter time in case OSM data gets fixed.
+GEOCODE_NEGATIVE_TTL_SECONDS = int(os.environ.get("GEOCODE_NEGATIVE_TTL_SECONDS", 24 * 3600))
+AMADEUS_CACHE_PATH = os.environ.get("AMADEUS_CACHE_PATH", ".amadeus_cache.sqlite")
+IATA_CACHE_TTL_SECONDS = int(os.environ.get("IATA_CACHE_TTL_SECONDS", 180 * 24 * 3600))
+IATA_NEGATIVE_TTL_SECONDS = int(os.environ.get("IATA_NEGATIVE_TTL_SECONDS", 24 * 3600))
+FLIGHT_OFFER_TTL_SECONDS = int(os.environ.get("FLIGHT_OFFER_TTL_SECONDS", 15 * 60))
+WEATHER_CACHE_PATH = os.environ.get("WEATHER_CACHE_PATH", ".weather_cache.sqlite")
+# One entry per grid cell and day; the oldest are evicted past this many.
+WEATHER_CACHE_MAX_ENTRIES = int(os.environ.get("WEATHER_CACHE_MAX_ENTRIES", 50000))
+WEATHER_GRID_DEGREES = float(os.environ.get("WEATHER_GRID_DEGREES", 0.1))
+# Forecast models are re-run every few hours and published with some delay.
+WEATHER_MODEL_UPDATE_HOURS = int(os.environ.get("WEATHER_MODEL_UPDATE_HOURS", 6))
+WEATHER_MODEL_LAG_HOURS = float(os.environ.get("WEATHER_MODEL_LAG_HOURS", 2))
+# Open-Meteo forecasts reach this many days ahead, today included; later days are never requested.
+WEATHER_FORECAST_DAYS = int(os.environ.get("WEATHER_FORECAST_DAYS", 16))
+# Attach a forecast for each activity's own coordinates, not just the destination.
+ACTIVITY_WEATHER = os.environ.get("ACTIVITY_WEATHER", "false").lower() in ("1", "true", "yes")
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+PLAN_CACHE_PATH = os.environ.get("PLAN_CACHE_PATH", ".plan_cache.sqlite")
+PLAN_CACHE_TTL_SECONDS = int(os.environ.get("PLAN_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+PLAN_CACHE_MAX_ENTRIES = int(os.environ.get("PLAN_CACHE_MAX_ENTRIES", 5000))
+# Budgets whose maximum is within this factor of each other can share a cached plan.
+PLAN_CACHE_BUDGET_BAND_RATIO = float(os.environ.get("PLAN_CACHE_BUDGET_BAND_RATIO", 1.5))
+
+# --- Pipeline Concurrency ---
+PIPELINE_STAGE_WORKERS = int(os.environ.get("PIPELINE_STAGE_WORKERS", 16))
+PIPELINE_CALL_WORKERS = int(os.environ.get("PIPELINE_CALL_WORKERS", 32))
+WEATHER_STAGE_TIMEOUT = float(os.environ.get("WEATHER_STAGE_TIMEOUT", 15))
+TRANSPORT_STAGE_TIMEOUT = float(os.environ.get("TRANSPORT_STAGE_TIMEOUT", 30))
+FLIGHT_SEARCH_TIMEOUT = float(os.environ.get("FLIGHT_SEARCH_TIMEOUT", 20))
+
+# --- Batch Trip Generation ---
+# Most trips accepted by one POST /trips/batch, and how many of them are generated at once.
+BATCH_MAX_TRIPS = int(os.environ.get("BATCH_MAX_TRIPS", 20))
+BATCH_TRIP_WORKERS = int(os.environ.get("BATCH_TRIP_WORKERS", 4))
+
+# --- Trip Generation Jobs ---
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_MAX_LENGTH = int(os.environ.get("JOB_QUEUE_MAX_LENGTH", 50))
+JOB_RESULT_TTL_SECONDS = int(os.environ.get("JOB_RESULT_TTL_SECONDS", 3600))
+# Job status and results are kept here so any worker process on the host can answer a poll.
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", ".jobs.sqlite")
+# Jobs save their trip with the caller's access token, so it must stay valid at least this long to queue one.
+JOB_MIN_TOKEN_SECONDS = int(os.environ.get("JOB_MIN_TOKEN_SECONDS", 900))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", 10))
+# Job callbacks are signed with this key (X-Webhook-Signature) and are refused while it is unset.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Optional comma-separated callback hosts. Without it any https host with only public addresses is accepted.
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+
+# --- Outbound HTTP ---
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 20))
+HTTP_MAX_KEEPALIVE_PER_HOST = int(os.environ.get("HTTP_MAX_KEEPALIVE_PER_HOST", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+# LLM generation legitimately takes tens of seconds, so it gets its own read timeout.
+GEMINI_READ_TIMEOUT = float(os.environ.get("GEMINI_READ_TIMEOUT", 120))
+
+# --- Itinerary Generation ---
+# Ask Gemini for JSON matching the itinerary schema instead of free text.
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+# Attempts to regenerate a single missing or invalid day before keeping what the model gave.
+STRUCTURED_DAY_RETRIES = int(os.environ.get("STRUCTURED_DAY_RETRIES", 2))
+# Trips longer than this many days are generated in concurrent segments and merged.
+GENERATION_CHUNK_DAYS = int(os.environ.get("GENERATION_CHUNK_DAYS", 7))
+# Planning figures for segment sizes: typical output per day and the most one answer should hold.
+GENERATION_OUTPUT_TOKENS_PER_DAY = int(os.environ.get("GENERATION_OUTPUT_TOKENS_PER_DAY", 600))
+GENERATION_MAX_OUTPUT_TOKENS = int(os.environ.get("GENERATION_MAX_OUTPUT_TOKENS", 8192))
+
+# --- Metrics ---
+# Prometheus metrics are always served on /metrics. This also adds a
+# Server-Timing header with the time spent in each pipeline stage to API responses.
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# --- ASGI Serving Mode ---
+# Threads for the blocking SDK calls (geocoding, Amadeus, weather decode) the async app offloads.
+ASGI_BLOCKING_THREADS = int(os.environ.get("ASGI_BLOCKING_THREADS", 64))
+
 # --- API Client Initialization ---
 
-# Supabase
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# One pooled keep-alive HTTP layer shared by every upstream call
+_http_settings = dict(
+    max_connections_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+    max_keepalive_per_host=HTTP_MAX_KEEPALIVE_PER_HOST,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+    retries=HTTP_RETRIES
+)
+outbound = OutboundHTTP(**_http_settings)
+# Its asyncio twin, used by the ASGI serving mode (asgi.py)
+async_outbound = AsyncOutboundHTTP(**_http_settings)
+
+# Supabase: there is deliberately no module-global client holding a session.
+# db.py provides request-scoped PostgREST access and per-call Auth clients.
 
 # Geopy for OpenStreetMap Geocoding
-geolocator = Nominatim(user_agent="ai-travel-planner")
-geocode_ratelimited = RateLimiter(geolocator.geocode, min_delay_seconds=1)
+geolocator = Nominatim(
+    user_agent="ai-travel-planner",
+    timeout=HTTP_READ_TIMEOUT,
+    adapter_factory=lambda proxies, ssl_context: GeopyAdapter(outbound, proxies=proxies, ssl_context=ssl_context)
+)
+# Request pacing is done by the scheduler in geoscheduler.py, not per call site.
+self_hosted_geolocator = Nominatim(
+    user_agent="ai-travel-planner",
+    domain=NOMINATIM_SELF_HOSTED_DOMAIN,
+    scheme=NOMINATIM_SELF_HOSTED_SCHEME,
+    timeout=HTTP_READ_TIMEOUT,
+    adapter_factory=lambda proxies, ssl_context: GeopyAdapter(outbound, proxies=proxies, ssl_context=ssl_context)
+) if NOMINATIM_SELF_HOSTED_DOMAIN else None
 
 # Amadeus for Flights
 amadeus = AmadeusClient(
     client_id=AMADEUS_API_KEY,
-    client_secret=AMADEUS_API_SECRET
+    client_secret=AMADEUS_API_SECRET,
+    http=amadeus_transport(outbound)
 ) if AMADEUS_API_KEY and AMADEUS_API_SECRET else None
 
 # OpenMeteo for Weather
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-openmeteo = openmeteo_requests.Client(session=retry_session)
\ No newline at end of file
+# Retries and connection reuse come from the shared outbound layer
+openmeteo = openmeteo_requests.Client(session=outbound)
@@ -0,0 +1,112 @@
+# db.py
+from gotrue import AsyncGoTrueClient, SyncGoTrueClient
+from postgrest._async.request_builder import AsyncRequestBuilder
+from postgrest._sync.request_builder import SyncRequestBuilder
+from config import outbound, async_outbound, SUPABASE_URL, SUPABASE_KEY
+import metrics
+
+REST_URL = f"{SUPABASE_URL}/rest/v1"
+AUTH_URL = f"{SUPABASE_URL}/auth/v1"
+
+
+class _BearerSession:
+    """The one method PostgREST request builders need from an httpx client.
+
+    Requests go through the shared, pooled outbound layer with the caller's
+    JWT added per call, so no client-wide headers or session state is ever
+    changed and concurrent users cannot see each other's credentials.
+    """
+
+    http = outbound
+
+    def __init__(self, access_token):
+        self.headers = {
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {access_token or SUPABASE_KEY}",
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+        }
+
+    def request(self, method, path, json=None, params=None, headers=None):
+        merged = {**self.headers, **dict(headers or {})}
+        # Writes are not retried: a retried insert could create the row twice.
+        read = method in ("GET", "HEAD")
+        with metrics.span("db_read" if read else "db_write"):
+            return self.http.request(method, f"{REST_URL}{path}", json=json, params=params,
+                                     headers=merged, retries=None if read else 0)
+
+
+class _AsyncBearerSession(_BearerSession):
+    """Same as _BearerSession over the asyncio outbound layer."""
+
+    http = async_outbound
+
+    async def request(self, method, path, json=None, params=None, headers=None):
+        merged = {**self.headers, **dict(headers or {})}
+        read = method in ("GET", "HEAD")
+        with metrics.span("db_read" if read else "db_write"):
+            return await self.http.request(method, f"{REST_URL}{path}", json=json, params=params,
+                                           headers=merged, retries=None if read else 0)
+
+
+class UserDB:
+    """PostgREST access bound to one user's access token, so RLS sees that user.
+
+    Cheap to create: build one per request with user_db(token). Without a
+    token requests are made with the anon key only.
+    """
+
+    def __init__(self, access_token=None):
+        self._session = _BearerSession(access_token)
+
+    def table(self, name):
+        return SyncRequestBuilder(self._session, f"/{name}")
+
+
+def user_db(access_token):
+    return UserDB(access_token)
+
+
+class AsyncUserDB:
+    """asyncio form of UserDB: `await db.table('trips').select('*').execute()`."""
+
+    def __init__(self, access_token=None):
+        self._session = _AsyncBearerSession(access_token)
+
+    def table(self, name):
+        return AsyncRequestBuilder(self._session, f"/{name}")
+
+
+def async_user_db(access_token):
+    return AsyncUserDB(access_token)
+
+
+# Stateless client for requests that are not made on behalf of a signed-in user.
+service_db = UserDB()
+
+
+def auth_client():
+    """Returns a fresh Supabase Auth client that keeps no session between calls.
+
+    sign_in/sign_up/sign_out on the old module-global client changed session
+    state shared by every request; a throwaway client per call avoids that
+    while still reusing the pooled connections to Supabase.
+    """
+    return SyncGoTrueClient(
+        url=AUTH_URL,
+        headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+        persist_session=False,
+        auto_refresh_token=False,
+        http_client=outbound.client_for(AUTH_URL)
+    )
+
+
+def async_auth_client():
+    """asyncio form of auth_client()."""
+    return AsyncGoTrueClient(
+        url=AUTH_URL,
+        headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+        persist_session=False,
+        auto_refresh_token=False,
+        http_client=async_outbound.client_for(AUTH_URL)
+    )
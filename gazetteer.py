@@ -0,0 +1,125 @@
+# gazetteer.py
+import os
+import re
+import unicodedata
+import zlib
+import numpy as np
+from geopy.location import Location
+
+# Files written by build_gazetteer.py into one directory. Rows are sorted by
+# latitude, so a bounding box maps to one contiguous row range, and every
+# postings list is sorted by row.
+FILES = {
+    "coords": "coords.npy",                # float32 (N, 2): lat, lon
+    "rank": "rank.npy",                    # float32 (N,): population or other importance, for ties
+    "gram_counts": "gram_counts.npy",      # uint16 (N,): distinct trigrams per name
+    "name_offsets": "name_offsets.npy",    # int64 (N + 1,): slices of names.bin
+    "names": "names.bin",                  # UTF-8 display names, concatenated
+    "gram_keys": "gram_keys.npy",          # uint32 (G,): sorted trigram hashes
+    "gram_offsets": "gram_offsets.npy",    # int64 (G + 1,): slices of gram_postings
+    "gram_postings": "gram_postings.npy"   # int32: row ids per trigram
+}
+
+
+def normalize_name(name):
+    """Lower-cases, strips accents and punctuation and sorts the words.
+
+    Sorting makes the match insensitive to word order: "Fort Aguada" and
+    "Aguada Fort" both become "aguada fort".
+    """
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    return " ".join(sorted(re.findall(r"\w+", text)))
+
+
+def name_grams(name):
+    """Distinct trigram hashes of a normalized name, padded so short words still count."""
+    padded = f"  {name} "
+    return sorted({zlib.crc32(padded[i:i + 3].encode()) for i in range(len(padded) - 2)})
+
+
+class Gazetteer:
+    """Fuzzy place-name lookup over a memory-mapped index built by build_gazetteer.py.
+
+    Names are compared by the Dice coefficient of their trigram sets, which
+    tolerates word order, small spelling differences and extra words such as
+    "Beach" or "Church".
+    """
+
+    def __init__(self, path):
+        def load(key):
+            # Plain ndarray views of the mapping: same pages, without np.memmap's per-slice overhead.
+            return np.asarray(np.load(os.path.join(path, FILES[key]), mmap_mode="r"))
+        self.coords = load("coords")
+        self.rank = load("rank")
+        self.gram_counts = load("gram_counts")
+        self.name_offsets = load("name_offsets")
+        self.names = np.asarray(np.memmap(os.path.join(path, FILES["names"]), dtype=np.uint8, mode="r"))
+        self.gram_keys = load("gram_keys")
+        self.gram_offsets = load("gram_offsets")
+        self.gram_postings = load("gram_postings")
+        # Latitudes are read for every lookup, so keep that one column in memory.
+        self.latitudes = np.ascontiguousarray(self.coords[:, 0])
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def name(self, row):
+        start, end = self.name_offsets[row], self.name_offsets[row + 1]
+        return bytes(self.names[start:end]).decode("utf-8")
+
+    def search(self, query, bbox, min_score):
+        """Best match for `query` inside bbox (south, north, west, east), or None.
+
+        Returns (name, lat, lon, score).
+        """
+        grams = np.array(name_grams(normalize_name(query)), dtype=np.uint32)
+        if not len(grams):
+            return None
+        south, north, west, east = bbox
+        # Probes must have the arrays' dtypes, or searchsorted converts the whole array each call.
+        first_row = np.searchsorted(self.latitudes, np.float32(south), side="left")
+        last_row = np.searchsorted(self.latitudes, np.float32(north), side="right")
+        if first_row >= last_row:
+            return None
+
+        positions = np.searchsorted(self.gram_keys, grams)
+        known = positions < len(self.gram_keys)
+        known[known] = self.gram_keys[positions[known]] == grams[known]
+        band = np.array((first_row, last_row), dtype=self.gram_postings.dtype)
+        postings = []
+        for position in positions[known]:
+            rows = self.gram_postings[self.gram_offsets[position]:self.gram_offsets[position + 1]]
+            # Postings are sorted by row, so the bbox latitude band is one slice of them.
+            start, end = np.searchsorted(rows, band)
+            if start < end:
+                postings.append(rows[start:end])
+        if not postings:
+            return None
+
+        rows, shared = np.unique(np.concatenate(postings), return_counts=True)
+        longitudes = self.coords[rows, 1]
+        if west <= east:
+            inside = (longitudes >= west) & (longitudes <= east)
+        else:
+            # The box crosses the antimeridian.
+            inside = (longitudes >= west) | (longitudes <= east)
+        rows, shared = rows[inside], shared[inside]
+        if not len(rows):
+            return None
+
+        scores = 2 * shared / (len(grams) + self.gram_counts[rows].astype(np.float64))
+        best = np.lexsort((-self.rank[rows], -scores))[0]
+        if scores[best] < min_score:
+            return None
+        row = rows[best]
+        lat, lon = self.coords[row]
+        return self.name(row), float(lat), float(lon), float(scores[best])
+
+    def geocode(self, query, bbox, min_score):
+        """search() as a geopy Location, so it can stand in for a geocoder answer."""
+        match = self.search(query, bbox, min_score)
+        if match is None:
+            return None
+        name, lat, lon, score = match
+        return Location(name, (lat, lon), {"source": "gazetteer", "score": round(score, 3)})
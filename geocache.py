@@ -0,0 +1,159 @@
+# geocache.py
+import math
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from geopy.location import Location
+from cache import SQLiteCache
+from geoscheduler import scheduler, GeocodeProvider, PRIORITY_DESTINATION, PRIORITY_POI
+from config import (
+    GEOCODE_CACHE_PATH,
+    GEOCODE_CACHE_TTL_SECONDS,
+    GEOCODE_NEGATIVE_TTL_SECONDS,
+    GAZETTEER_PATH,
+    GAZETTEER_RADIUS_KM,
+    GAZETTEER_MIN_SCORE,
+    GAZETTEER_BBOX_CACHE_SIZE
+)
+
+_store = SQLiteCache(GEOCODE_CACHE_PATH, "geocode")
+
+# Counts of lookups that actually went out to the geocoder (true misses).
+upstream_calls = 0
+_calls_lock = threading.Lock()
+
+
+def normalize_query(query):
+    """Normalizes a place name so trivially different spellings share a cache entry.
+
+    "  Baga beach ,Goa " and "Baga Beach, Goa" both become "baga beach, goa".
+    """
+    text = unicodedata.normalize("NFKC", query or "").casefold()
+    text = re.sub(r"[^\w\s,]", " ", text)
+    parts = [" ".join(part.split()) for part in text.split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+def _to_location(entry):
+    if entry is None:
+        return None
+    return Location(entry["address"], (entry["lat"], entry["lng"]), {})
+
+
+def _from_location(location):
+    if location is None:
+        return None
+    entry = {"address": location.address, "lat": location.latitude, "lng": location.longitude}
+    # Nominatim's [south, north, west, east]; lets the gazetteer search POIs inside a destination.
+    if isinstance(location.raw, dict) and location.raw.get("boundingbox"):
+        entry["bbox"] = [float(value) for value in location.raw["boundingbox"]]
+    return entry
+
+
+def geocode_many(queries, priority=PRIORITY_POI):
+    """Resolves many place names at once.
+
+    Cached answers (including cached "not found" results) are served from disk
+    in a single query; the remaining names are queued on the geocoding
+    scheduler together and resolved as its rate limits allow. Returns a dict
+    mapping each original query to a geopy Location or None.
+    """
+    global upstream_calls
+    keys = {query: normalize_query(query) for query in queries}
+    cached = _store.get_many([key for key in keys.values() if key])
+
+    futures = {}
+    for key in dict.fromkeys(keys.values()):
+        if key and key not in cached:
+            futures[key] = scheduler.submit(key, priority)
+    with _calls_lock:
+        upstream_calls += len(futures)
+
+    resolved = {}
+    for key, future in futures.items():
+        try:
+            location = future.result()
+        except Exception as e:
+            # Transient geocoder errors are not cached so the next trip can retry.
+            print(f"Geocoding failed for '{key}': {e}")
+            resolved[key] = None
+            continue
+        entry = _from_location(location)
+        resolved[key] = entry
+        ttl = GEOCODE_CACHE_TTL_SECONDS if entry else GEOCODE_NEGATIVE_TTL_SECONDS
+        _store.set(key, entry, ttl)
+
+    cached.update(resolved)
+    return {query: _to_location(cached.get(key)) for query, key in keys.items()}
+
+
+def geocode(query, priority=PRIORITY_DESTINATION):
+    """Cached, scheduled geocoding of a single place name.
+
+    Single lookups are usually the trip destination, which everything else
+    waits on, so they go ahead of queued POI batches by default.
+    """
+    return geocode_many([query], priority)[query]
+
+
+# --- Offline Gazetteer ---
+# LRU of destination key -> search box, filled from geocoder worker threads.
+_destination_bboxes = OrderedDict()
+_bboxes_lock = threading.Lock()
+
+
+def _destination_bbox(destination_key):
+    """Search box around an already geocoded destination, or None if it is not cached."""
+    with _bboxes_lock:
+        if destination_key in _destination_bboxes:
+            _destination_bboxes.move_to_end(destination_key)
+            return _destination_bboxes[destination_key]
+    # Probing for the destination is not a cache lookup of its own, so it stays out of the hit/miss stats.
+    found, entry = _store.get(destination_key, record=False)
+    if not found or not entry:
+        return None
+    lat, lng = entry["lat"], entry["lng"]
+    lat_delta = GAZETTEER_RADIUS_KM / 111.32
+    lng_delta = lat_delta / max(math.cos(math.radians(lat)), 0.01)
+    south, north, west, east = lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+    if entry.get("bbox"):
+        bbox_south, bbox_north, bbox_west, bbox_east = entry["bbox"]
+        south, north = min(south, bbox_south), max(north, bbox_north)
+        west, east = min(west, bbox_west), max(east, bbox_east)
+    bbox = (south, north, west, east)
+    with _bboxes_lock:
+        _destination_bboxes[destination_key] = bbox
+        while len(_destination_bboxes) > GAZETTEER_BBOX_CACHE_SIZE:
+            _destination_bboxes.popitem(last=False)
+    return bbox
+
+
+def _gazetteer_geocode(key):
+    """Resolves "poi name, destination" keys from the local index.
+
+    The destination is the longest trailing part of the key that is already
+    in the cache (it is always geocoded before the trip's POIs); the match is
+    restricted to its surroundings. Bare names are left to the other providers.
+    """
+    parts = key.split(", ")
+    for i in range(1, len(parts)):
+        bbox = _destination_bbox(", ".join(parts[i:]))
+        if bbox:
+            return _gazetteer.geocode(", ".join(parts[:i]), bbox, GAZETTEER_MIN_SCORE)
+    return None
+
+
+if GAZETTEER_PATH:
+    from gazetteer import Gazetteer
+    _gazetteer = Gazetteer(GAZETTEER_PATH)
+    print(f"Loaded offline gazetteer with {len(_gazetteer)} names from {GAZETTEER_PATH}")
+    scheduler.add_provider(GeocodeProvider("gazetteer", _gazetteer_geocode, inline=True), first=True)
+
+
+def stats():
+    result = _store.stats()
+    with _calls_lock:
+        result["upstream_calls"] = upstream_calls
+    result["scheduler"] = scheduler.stats()
+    return result
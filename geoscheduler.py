@@ -0,0 +1,288 @@
+# geoscheduler.py
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import metrics
+from config import (
+    geolocator,
+    self_hosted_geolocator,
+    GEOCODE_WORKERS,
+    GEOCODE_BUCKET_PATH,
+    NOMINATIM_RATE_PER_SECOND,
+    NOMINATIM_SELF_HOSTED_RATE_PER_SECOND
+)
+
+# Lower runs first. The trip's destination blocks everything after it, while
+# POIs are only needed to put pins on the map.
+PRIORITY_DESTINATION = 0
+PRIORITY_POI = 10
+
+
+class TokenBucket:
+    """Rate limit shared by every process that uses the same SQLite file.
+
+    Tokens refill at `rate` per second up to `capacity`. The bucket state is
+    read and updated inside one write transaction, so concurrent workers and
+    processes never take the same token twice.
+    """
+
+    def __init__(self, path, name, rate, capacity=1):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # Autocommit mode, so the transaction below is opened explicitly.
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets ("
+                " name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _try_take(self):
+        """Takes a token if one is available; otherwise returns the seconds until one is."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                tokens = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+                wait_seconds = 0 if tokens >= 1 else (1 - tokens) / self.rate
+                if not wait_seconds:
+                    tokens -= 1
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                    (self.name, tokens, now)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait_seconds
+
+    def acquire(self):
+        """Blocks until a token is taken; returns the seconds spent waiting."""
+        waited = 0
+        while True:
+            wait_seconds = self._try_take()
+            if not wait_seconds:
+                return waited
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+
+class GeocodeProvider:
+    """A geocoding backend: `geocode(query)` returns a geopy Location or None.
+
+    `rate_per_second` of None means the provider needs no pacing. Inline
+    providers (in-process indexes that answer in microseconds) are asked on
+    the caller's thread before anything is queued, so their hits never wait
+    behind rate-limited lookups.
+    """
+
+    def __init__(self, name, geocode, rate_per_second=None, bucket_path=GEOCODE_BUCKET_PATH, inline=False):
+        self.name = name
+        self.geocode = geocode
+        self.inline = inline
+        self.bucket = TokenBucket(bucket_path, name, rate_per_second) if rate_per_second else None
+        self.calls = 0
+        self.found = 0
+        self.errors = 0
+        self.rate_wait_seconds = 0.0
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "found": self.found,
+            "errors": self.errors,
+            "rate_wait_seconds": round(self.rate_wait_seconds, 3)
+        }
+
+
+class GeocodeScheduler:
+    """Runs geocoding lookups from a priority queue on a few worker threads.
+
+    Identical queries that are queued or running at the same time share one
+    lookup. Each lookup tries the providers in order and returns the first
+    location found. When none found it and one of them failed with an error,
+    that error is raised, so the caller does not cache a "not found" that
+    may only have been an outage.
+    """
+
+    def __init__(self, providers, workers):
+        self.providers = list(providers)
+        self._heap = []
+        self._pending = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self.submitted = 0
+        self.coalesced = 0
+        self.resolved_inline = 0
+        self.started = 0
+        self.completed = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self._completed_at = deque(maxlen=10000)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"geocode-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def add_provider(self, provider, first=False):
+        """Registers another provider, by default after the existing ones."""
+        with self._condition:
+            if first:
+                self.providers.insert(0, provider)
+            else:
+                self.providers.append(provider)
+
+    def _lookup_inline(self, query):
+        for provider in [provider for provider in self.providers if provider.inline]:
+            try:
+                provider.calls += 1
+                location = provider.geocode(query)
+            except Exception as e:
+                provider.errors += 1
+                print(f"Geocoder '{provider.name}' failed for '{query}': {e}")
+                continue
+            if location:
+                provider.found += 1
+                return location
+        return None
+
+    def submit(self, query, priority=PRIORITY_POI):
+        """Queues a lookup and returns a Future for its Location (or None)."""
+        location = self._lookup_inline(query)
+        if location:
+            future = Future()
+            future.set_result(location)
+            with self._condition:
+                self.submitted += 1
+                self.resolved_inline += 1
+            return future
+
+        with self._condition:
+            self.submitted += 1
+            pending = self._pending.get(query)
+            if pending:
+                self.coalesced += 1
+                future, queued_priority, _ = pending
+                if priority < queued_priority and not future.running():
+                    # A more urgent caller now waits on it: queue it again at the higher priority.
+                    self._pending[query] = (future, priority, pending[2])
+                    heapq.heappush(self._heap, (priority, next(self._sequence), query))
+                    self._condition.notify()
+                return future
+            future = Future()
+            self._pending[query] = (future, priority, time.perf_counter())
+            heapq.heappush(self._heap, (priority, next(self._sequence), query))
+            self._condition.notify()
+            return future
+
+    def _next(self):
+        with self._condition:
+            while True:
+                while not self._heap:
+                    self._condition.wait()
+                _, _, query = heapq.heappop(self._heap)
+                pending = self._pending.get(query)
+                # Entries left behind by a priority upgrade are skipped.
+                if not pending or pending[0].running() or pending[0].done():
+                    continue
+                future, _, queued_at = pending
+                future.set_running_or_notify_cancel()
+                wait_seconds = time.perf_counter() - queued_at
+                self.started += 1
+                self.queue_wait_total += wait_seconds
+                self.queue_wait_max = max(self.queue_wait_max, wait_seconds)
+                return query, future
+
+    def _lookup(self, query):
+        error = None
+        for provider in [provider for provider in self.providers if not provider.inline]:
+            try:
+                if provider.bucket:
+                    provider.rate_wait_seconds += provider.bucket.acquire()
+                provider.calls += 1
+                location = provider.geocode(query)
+            except Exception as e:
+                provider.errors += 1
+                print(f"Geocoder '{provider.name}' failed for '{query}': {e}")
+                error = e
+                continue
+            if location:
+                provider.found += 1
+                return location
+        if error:
+            raise error
+        return None
+
+    def _work(self):
+        while True:
+            query, future = self._next()
+            try:
+                future.set_result(self._lookup(query))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._condition:
+                    del self._pending[query]
+                    self.completed += 1
+                    self._completed_at.append(time.time())
+
+    def stats(self):
+        with self._condition:
+            now = time.time()
+            return {
+                "in_flight": len(self._pending),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "resolved_inline": self.resolved_inline,
+                "completed": self.completed,
+                "lookups_last_minute": sum(1 for t in self._completed_at if t > now - 60),
+                "queue_wait_avg_seconds": round(self.queue_wait_total / self.started, 3) if self.started else None,
+                "queue_wait_max_seconds": round(self.queue_wait_max, 3),
+                "providers": {provider.name: provider.stats() for provider in self.providers}
+            }
+
+
+_providers = []
+if self_hosted_geolocator:
+    _providers.append(GeocodeProvider("nominatim-self-hosted", self_hosted_geolocator.geocode, NOMINATIM_SELF_HOSTED_RATE_PER_SECOND))
+_providers.append(GeocodeProvider("nominatim", geolocator.geocode, NOMINATIM_RATE_PER_SECOND))
+
+scheduler = GeocodeScheduler(_providers, GEOCODE_WORKERS)
+
+
+# --- Metrics ---
+metrics.describe("travel_geocode_in_flight", "gauge", "Geocoding lookups queued or running.")
+metrics.describe("travel_geocode_lookups_total", "counter",
+                 "Geocoding lookups submitted, and how many were coalesced, resolved inline or completed by a worker.", ["event"])
+metrics.describe("travel_geocode_provider_calls_total", "counter", "Lookups sent to each geocoding provider.", ["provider"])
+metrics.describe("travel_geocode_provider_errors_total", "counter", "Lookups a geocoding provider failed.", ["provider"])
+metrics.describe("travel_geocode_rate_wait_seconds_total", "counter", "Time spent waiting for a provider's rate limit.", ["provider"])
+
+
+def _metric_samples():
+    stats = scheduler.stats()
+    samples = [("travel_geocode_in_flight", (), stats["in_flight"])]
+    samples += [("travel_geocode_lookups_total", (event,), stats[event])
+                for event in ("submitted", "coalesced", "resolved_inline", "completed")]
+    for name, provider in stats["providers"].items():
+        samples += [
+            ("travel_geocode_provider_calls_total", (name,), provider["calls"]),
+            ("travel_geocode_provider_errors_total", (name,), provider["errors"]),
+            ("travel_geocode_rate_wait_seconds_total", (name,), provider["rate_wait_seconds"])
+        ]
+    return samples
+
+
+metrics.register_collector(_metric_samples)
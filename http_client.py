@@ -0,0 +1,257 @@
+# http_client.py
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+import httpx
+from geopy.adapters import AdapterHTTPError, BaseSyncAdapter
+from geopy.exc import GeocoderParseError, GeocoderServiceError, GeocoderTimedOut, GeocoderUnavailable
+import metrics
+
+try:
+    import h2  # noqa: F401 -- httpx only negotiates HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class _RetryPolicy:
+    """Pool limits, timeouts and backoff shared by the sync and async layers."""
+
+    def __init__(self, max_connections_per_host=20, max_keepalive_per_host=10, connect_timeout=5.0,
+                 read_timeout=30.0, retries=3, backoff_base=0.25, backoff_max=8.0, http2=True, transport=None):
+        self.limits = httpx.Limits(max_connections=max_connections_per_host,
+                                   max_keepalive_connections=max_keepalive_per_host)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http2 = http2 and HTTP2_AVAILABLE
+        # An httpx transport to send through instead of the network (bench/ replays recorded
+        # upstreams this way). Set it before the first request: clients are created per host on first use.
+        self.transport = transport
+        self._clients = {}
+
+    def _new_client(self):
+        raise NotImplementedError
+
+    def client_for(self, url):
+        """Returns the pooled httpx client for the host of `url`."""
+        parts = urlsplit(str(url))
+        host = (parts.scheme, parts.netloc)
+        client = self._clients.get(host)
+        if client is None:
+            client = self._clients.setdefault(host, self._new_client())
+        return client
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self.timeout
+        if isinstance(timeout, httpx.Timeout):
+            return timeout
+        # A plain number overrides the read timeout but keeps the connect timeout.
+        return httpx.Timeout(timeout, connect=self.timeout.connect)
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class OutboundHTTP(_RetryPolicy):
+    """Shared outbound HTTP layer for every upstream service.
+
+    Keeps one pooled, keep-alive httpx client per host (so each host gets its
+    own connection limit and slow upstreams cannot starve the others), applies
+    explicit connect/read timeouts and retries transient failures with
+    exponential backoff and full jitter.
+
+    The get/post/close methods mirror requests.Session closely enough for
+    openmeteo_requests.Client to use an instance as its session.
+    """
+
+    def _new_client(self):
+        return httpx.Client(limits=self.limits, timeout=self.timeout, http2=self.http2, transport=self.transport)
+
+    def request(self, method, url, *, timeout=None, retries=None, **kwargs):
+        """Sends a request, retrying connection errors and 429/5xx answers."""
+        retries = self.retries if retries is None else retries
+        client = self.client_for(url)
+        host = urlsplit(str(url)).netloc
+        for attempt in range(retries + 1):
+            try:
+                with metrics.upstream_call(host) as call:
+                    response = client.request(method, url, timeout=self._timeout(timeout), **kwargs)
+                    call.status = response.status_code
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            time.sleep(self._backoff(attempt, response))
+
+    def get(self, url, params=None, **kwargs):
+        kwargs.pop('verify', None)  # TLS verification is configured per client, not per call
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        kwargs.pop('verify', None)
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    @contextmanager
+    def stream(self, method, url, *, timeout=None, **kwargs):
+        """Streams a response body. Only the initial connection is retried."""
+        client = self.client_for(url)
+        host = urlsplit(str(url)).netloc
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.upstream_call(host) as call, \
+                        client.stream(method, url, timeout=self._timeout(timeout), **kwargs) as response:
+                    call.status = response.status_code
+                    if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                        wait_seconds = self._backoff(attempt, response)
+                    else:
+                        yield response
+                        return
+            except httpx.ConnectError:
+                if attempt == self.retries:
+                    raise
+                wait_seconds = self._backoff(attempt)
+            time.sleep(wait_seconds)
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+
+
+class AsyncOutboundHTTP(_RetryPolicy):
+    """asyncio counterpart of OutboundHTTP, used by the ASGI serving mode."""
+
+    def _new_client(self):
+        return httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2, transport=self.transport)
+
+    async def request(self, method, url, *, timeout=None, retries=None, **kwargs):
+        """Sends a request, retrying connection errors and 429/5xx answers."""
+        retries = self.retries if retries is None else retries
+        client = self.client_for(url)
+        host = urlsplit(str(url)).netloc
+        for attempt in range(retries + 1):
+            try:
+                with metrics.upstream_call(host) as call:
+                    response = await client.request(method, url, timeout=self._timeout(timeout), **kwargs)
+                    call.status = response.status_code
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            await asyncio.sleep(self._backoff(attempt, response))
+
+    async def get(self, url, params=None, **kwargs):
+        return await self.request('GET', url, params=params, **kwargs)
+
+    async def post(self, url, data=None, json=None, **kwargs):
+        return await self.request('POST', url, data=data, json=json, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, *, timeout=None, **kwargs):
+        """Streams a response body. Only the initial connection is retried."""
+        client = self.client_for(url)
+        host = urlsplit(str(url)).netloc
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.upstream_call(host) as call:
+                    async with client.stream(method, url, timeout=self._timeout(timeout), **kwargs) as response:
+                        call.status = response.status_code
+                        if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                            wait_seconds = self._backoff(attempt, response)
+                        else:
+                            yield response
+                            return
+            except httpx.ConnectError:
+                if attempt == self.retries:
+                    raise
+                wait_seconds = self._backoff(attempt)
+            await asyncio.sleep(wait_seconds)
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+class GeopyAdapter(BaseSyncAdapter):
+    """Lets geopy geocoders send their requests through OutboundHTTP."""
+
+    def __init__(self, http, *, proxies=None, ssl_context=None):
+        super().__init__(proxies=proxies, ssl_context=ssl_context)
+        self.http = http
+
+    def get_text(self, url, *, timeout, headers):
+        return self._request(url, timeout=timeout, headers=headers).text
+
+    def get_json(self, url, *, timeout, headers):
+        response = self._request(url, timeout=timeout, headers=headers)
+        try:
+            return response.json()
+        except ValueError:
+            raise GeocoderParseError(f"Could not deserialize using deserializer:\n{response.text}")
+
+    def _request(self, url, *, timeout, headers):
+        try:
+            response = self.http.get(url, timeout=timeout, headers=headers)
+        except httpx.TimeoutException:
+            raise GeocoderTimedOut("Service timed out")
+        except httpx.TransportError as e:
+            raise GeocoderUnavailable(str(e))
+        except Exception as e:
+            raise GeocoderServiceError(str(e))
+        if response.status_code >= 400:
+            raise AdapterHTTPError(
+                f"Non-successful status code {response.status_code}",
+                status_code=response.status_code,
+                headers=response.headers,
+                text=response.text
+            )
+        return response
+
+
+class _AmadeusResponse:
+    """The subset of urllib's HTTPResponse that the Amadeus SDK reads."""
+
+    def __init__(self, response):
+        self.status = response.status_code
+        self.code = response.status_code
+        self._response = response
+
+    def getheaders(self):
+        return list(self._response.headers.items())
+
+    def info(self):
+        # httpx headers are case-insensitive, which the SDK's 'Content-Type' lookup relies on.
+        return self._response.headers
+
+    def read(self):
+        return self._response.content
+
+
+def amadeus_transport(http):
+    """Returns a urlopen-compatible function for the Amadeus SDK's `http` option."""
+    def send(http_request):
+        response = http.request(
+            http_request.get_method(),
+            http_request.full_url,
+            headers=dict(http_request.header_items()),
+            content=http_request.data
+        )
+        return _AmadeusResponse(response)
+    return send
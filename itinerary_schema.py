@@ -0,0 +1,112 @@
+# itinerary_schema.py
+from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+# --- Validation Models ---
+# Extra keys the model adds (dates, themes, ...) are kept as they are.
+
+
+class EstimatedCost(BaseModel):
+    amount: float
+    currency: str
+
+
+class Activity(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    name: str = Field(min_length=1)
+    description: List[str]
+    estimated_cost: Optional[EstimatedCost] = None
+    local_cuisine_suggestion: Optional[str] = None
+    special_event: Optional[str] = None
+    image_search_term: Optional[str] = None
+
+    @field_validator("description", mode="before")
+    @classmethod
+    def description_as_list(cls, value):
+        # Without a schema the model sometimes answers with one sentence instead of bullet points.
+        return [value] if isinstance(value, str) else value
+
+
+class DayPlan(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    day: int
+    morning: Activity
+    afternoon: Activity
+    evening: Activity
+
+
+# --- Gemini Response Schemas ---
+# The OpenAPI subset accepted by generationConfig.responseSchema, mirroring the
+# models above. propertyOrdering keeps the fields in prompt order.
+ACTIVITY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "name": {"type": "STRING"},
+        "description": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "estimated_cost": {
+            "type": "OBJECT",
+            "properties": {"amount": {"type": "NUMBER"}, "currency": {"type": "STRING"}},
+            "required": ["amount", "currency"]
+        },
+        "local_cuisine_suggestion": {"type": "STRING"},
+        "special_event": {"type": "STRING", "nullable": True},
+        "image_search_term": {"type": "STRING"}
+    },
+    "required": ["name", "description", "estimated_cost", "local_cuisine_suggestion", "image_search_term"],
+    "propertyOrdering": ["name", "description", "estimated_cost", "local_cuisine_suggestion", "special_event", "image_search_term"]
+}
+
+DAY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "day": {"type": "INTEGER"},
+        "morning": ACTIVITY_SCHEMA,
+        "afternoon": ACTIVITY_SCHEMA,
+        "evening": ACTIVITY_SCHEMA
+    },
+    "required": ["day", "morning", "afternoon", "evening"],
+    "propertyOrdering": ["day", "morning", "afternoon", "evening"]
+}
+
+ITINERARY_SCHEMA = {"type": "ARRAY", "items": DAY_SCHEMA}
+
+
+def validate_day(raw, day_number):
+    """Validates one day object. Returns (day dict, None) or (None, what is wrong with it)."""
+    if not isinstance(raw, dict):
+        return None, f"Day {day_number} is missing."
+    try:
+        # Days are numbered by position, whatever number the model gave them.
+        plan = DayPlan.model_validate({**raw, "day": day_number})
+    except ValidationError as e:
+        problems = "; ".join(
+            f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()[:5]
+        )
+        return None, f"Day {day_number} was invalid ({problems})."
+    return plan.model_dump(), None
+
+
+def validate_itinerary(items, duration, first_day=1):
+    """Validates every day of a parsed answer in one pass.
+
+    `items` should hold `duration` days numbered from `first_day`. Returns
+    (days, problems): `days` has one validated dict or None per day, and
+    `problems` maps the number of each day that has to be regenerated to the
+    reason, to pass on to the model.
+    """
+    days = []
+    problems = {}
+    for i in range(duration):
+        day_number = first_day + i
+        day, problem = validate_day(items[i] if i < len(items) else None, day_number)
+        days.append(day)
+        if problem:
+            problems[day_number] = problem
+    return days, problems
+
+
+def fallback_day(raw, day_number):
+    """What is kept for a day that stayed invalid after regeneration: whatever the model gave, numbered."""
+    return {**raw, "day": day_number} if isinstance(raw, dict) else {"day": day_number}
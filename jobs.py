@@ -0,0 +1,198 @@
+# jobs.py
+import hashlib
+import hmac
+import ipaddress
+import json
+import queue
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+import metrics
+from cache import SQLiteCache
+from config import (
+    outbound, JOB_WORKERS, JOB_QUEUE_MAX_LENGTH, JOB_RESULT_TTL_SECONDS, JOB_STORE_PATH,
+    WEBHOOK_TIMEOUT, WEBHOOK_SECRET, WEBHOOK_ALLOWED_HOSTS
+)
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room left; callers should retry later."""
+
+
+class InvalidCallback(Exception):
+    """Raised for a callback_url the server will not call; the message is safe to show the client."""
+
+
+def check_callback_url(url):
+    """Refuses callback URLs that could make the server call into its own network.
+
+    Only https is accepted. With WEBHOOK_ALLOWED_HOSTS set the host must be on
+    it; otherwise every address the host resolves to must be public, so
+    loopback, private, link-local (cloud metadata) and reserved ranges are out.
+    """
+    if not WEBHOOK_SECRET:
+        raise InvalidCallback("Callbacks are not enabled on this server")
+    parts = urlsplit(url if isinstance(url, str) else "")
+    if parts.scheme != "https" or not parts.hostname:
+        raise InvalidCallback("callback_url must be an https URL")
+    host = parts.hostname.lower()
+    if WEBHOOK_ALLOWED_HOSTS:
+        if host not in WEBHOOK_ALLOWED_HOSTS:
+            raise InvalidCallback(f"Callback host '{host}' is not allowed")
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise InvalidCallback(f"Callback host '{host}' does not resolve")
+    for address in addresses:
+        if not ipaddress.ip_address(address.split("%")[0]).is_global:
+            raise InvalidCallback(f"Callback host '{host}' resolves to a non-public address")
+
+
+def sign_callback(body, timestamp):
+    """HMAC-SHA256 of "<timestamp>.<body>" with WEBHOOK_SECRET, as sent in X-Webhook-Signature."""
+    message = timestamp.encode() + b"." + body
+    return "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+class Job:
+    def __init__(self, user_id, fn, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.fn = fn
+        self.callback_url = callback_url
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuilds a job saved by JobQueue for reporting; it carries no function to run."""
+        job = cls(record["user_id"], None)
+        job.id = record["job_id"]
+        for field in ("status", "result", "error", "created_at", "started_at", "finished_at"):
+            setattr(job, field, record[field])
+        return job
+
+
+# Jobs that never finish (their process died) stop being reported after this long.
+UNFINISHED_JOB_TTL_SECONDS = 24 * 3600
+
+
+class JobQueue:
+    """Job queue drained by a fixed pool of worker threads.
+
+    The queue is bounded: submit() raises QueueFull instead of letting
+    requests pile up, which gives clients backpressure via a 503. Jobs run in
+    the process that accepted them, but their status and results are saved
+    in a SQLite store at `store_path`, so with several worker processes a
+    poll can land on any of them. Finished jobs are kept for `result_ttl`
+    seconds.
+    """
+
+    def __init__(self, workers, max_length, result_ttl, store_path):
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_length)
+        self._store = SQLiteCache(store_path, "jobs")
+        self._workers = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, user_id, fn, callback_url=None):
+        """Queues fn() for `user_id`. Raises InvalidCallback for an unsafe callback_url and QueueFull when busy."""
+        if callback_url is not None:
+            check_callback_url(callback_url)
+        job = Job(user_id, fn, callback_url)
+        self._store.purge_expired()
+        # Saved before it is queued, so a worker's "running" update cannot be overwritten.
+        self._save(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._store.set(job.id, None, 0)
+            raise QueueFull("Too many trips are being generated right now. Please retry shortly.")
+        return job
+
+    def get(self, job_id, user_id):
+        """Returns the job only if it belongs to `user_id`."""
+        # Polls are not cache lookups, so they stay out of the cache hit/miss stats.
+        found, record = self._store.get(job_id, record=False)
+        if not found or not record or record["user_id"] != user_id:
+            return None
+        return Job.from_record(record)
+
+    def _save(self, job):
+        ttl = self.result_ttl if job.finished_at else UNFINISHED_JOB_TTL_SECONDS
+        self._store.set(job.id, {"user_id": job.user_id, **job.to_dict()}, ttl)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            self._save(job)
+            try:
+                job.result = job.fn()
+                job.status = "succeeded"
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            job.finished_at = time.time()
+            job.fn = None
+            try:
+                self._save(job)
+            except Exception as e:
+                # E.g. a result json cannot encode; pollers still learn that the job ended.
+                print(f"Could not save job {job.id}: {e}")
+                job.status, job.result, job.error = "failed", None, f"Could not save the result: {e}"
+                self._save(job)
+            if job.callback_url:
+                self._notify(job)
+            self._queue.task_done()
+
+    def _notify(self, job):
+        """POSTs the finished job to its callback_url, signed so the receiver can verify it came from us."""
+        try:
+            # Checked again at send time: the host's DNS may have changed since the job was queued.
+            check_callback_url(job.callback_url)
+            body = json.dumps(job.to_dict()).encode()
+            timestamp = str(int(time.time()))
+            headers = {
+                'Content-Type': 'application/json',
+                'X-Webhook-Timestamp': timestamp,
+                'X-Webhook-Signature': sign_callback(body, timestamp)
+            }
+            response = outbound.request('POST', job.callback_url, content=body, headers=headers,
+                                        timeout=WEBHOOK_TIMEOUT, retries=1)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Webhook for job {job.id} to {job.callback_url} failed: {e}")
+
+
+trip_jobs = JobQueue(JOB_WORKERS, JOB_QUEUE_MAX_LENGTH, JOB_RESULT_TTL_SECONDS, JOB_STORE_PATH)
+
+metrics.describe("travel_job_queue_depth", "gauge", "Trip generation jobs waiting for a worker.")
+metrics.register_collector(lambda: [("travel_job_queue_depth", (), trip_jobs.depth())])
@@ -0,0 +1,76 @@
+# jsonstream.py
+import json
+
+
+class JSONArrayStreamParser:
+    """Incrementally extracts the elements of a top-level JSON array.
+
+    Text is fed in arbitrary fragments (e.g. as tokens arrive from the LLM).
+    Anything before the opening '[' — such as a ```json fence — is ignored.
+    Every call to feed() returns the objects that were completed by that
+    fragment, so each day of an itinerary is available as soon as its closing
+    brace has been generated. Only the bytes since the last complete element
+    are kept, so the work per fragment stays proportional to its size.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element_start = None
+
+    def feed(self, text):
+        completed = []
+        if self._finished:
+            return completed
+        self._buffer += text
+
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+
+            if not self._started:
+                if ch == '[':
+                    self._started = True
+                    self._depth = 1
+                self._pos += 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 1:
+                    self._element_start = self._pos
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1 and self._element_start is not None:
+                    element = self._buffer[self._element_start:self._pos + 1]
+                    try:
+                        value = json.loads(element)
+                    except json.JSONDecodeError as e:
+                        print(f"Skipping malformed streamed element: {e}")
+                        value = None
+                    if isinstance(value, dict):
+                        completed.append(value)
+                    self._element_start = None
+                    # Drop what has been consumed so the buffer stays small.
+                    self._buffer = self._buffer[self._pos + 1:]
+                    self._pos = 0
+                    continue
+                if self._depth == 0:
+                    self._finished = True
+                    break
+            self._pos += 1
+
+        return completed
@@ -0,0 +1,248 @@
+# metrics.py
+import bisect
+import functools
+import threading
+import time
+from contextvars import ContextVar
+
+# In-process counters, gauges and latency histograms, served in the Prometheus
+# text format on /metrics. Recording takes one short lock and no I/O, so spans
+# can wrap every stage and upstream call. Module state is per process: with
+# several worker processes, Prometheus scrapes and sums each of them.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from cache hits up to long LLM generations.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metric:
+    def __init__(self, name, kind, help_text, labels):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        # Label values -> number; for histograms -> [per-bucket counts, sum, count].
+        self.values = {}
+
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+def describe(name, kind, help_text, labels=()):
+    """Declares a metric. `kind` is 'counter', 'gauge' or 'histogram'."""
+    with _lock:
+        return _metrics.setdefault(name, _Metric(name, kind, help_text, tuple(labels)))
+
+
+def _add(metric, label_values, value):
+    metric.values[label_values] = metric.values.get(label_values, 0) + value
+
+
+def _observe(metric, label_values, seconds):
+    entry = metric.values.get(label_values)
+    if entry is None:
+        entry = metric.values[label_values] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+    entry[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+    entry[1] += seconds
+    entry[2] += 1
+
+
+def inc(name, label_values=(), value=1):
+    """Adds to a counter, or to a gauge (a negative value lowers it)."""
+    metric = _metrics[name]
+    with _lock:
+        _add(metric, label_values, value)
+
+
+def observe(name, label_values, seconds):
+    metric = _metrics[name]
+    with _lock:
+        _observe(metric, label_values, seconds)
+
+
+def register_collector(collect):
+    """Adds a function called on every scrape that returns (name, label values, value) samples.
+
+    Used for numbers a module already keeps (cache hits, queue lengths), so
+    nothing extra is recorded on the hot path. The names must be declared
+    with describe().
+    """
+    _collectors.append(collect)
+
+
+# --- Built-in Metrics ---
+STAGE_SECONDS = describe("travel_stage_seconds", "histogram", "Duration of pipeline stages.", ["stage"])
+STAGE_IN_FLIGHT = describe("travel_stage_in_flight", "gauge", "Pipeline stages currently running.", ["stage"])
+STAGE_ERRORS = describe("travel_stage_errors_total", "counter", "Pipeline stages that raised.", ["stage"])
+UPSTREAM_SECONDS = describe("travel_upstream_request_seconds", "histogram",
+                            "Duration of single upstream HTTP attempts (streams until closed).", ["host"])
+UPSTREAM_REQUESTS = describe("travel_upstream_requests_total", "counter",
+                             "Upstream HTTP attempts by response status, or 'error' when none arrived.", ["host", "status"])
+UPSTREAM_IN_FLIGHT = describe("travel_upstream_in_flight", "gauge", "Upstream HTTP attempts currently open.", ["host"])
+HTTP_SECONDS = describe("travel_http_request_seconds", "histogram",
+                        "Duration of API requests, until the last byte of streamed responses.", ["method", "route"])
+HTTP_REQUESTS = describe("travel_http_requests_total", "counter", "API requests by status.", ["method", "route", "status"])
+HTTP_IN_FLIGHT = describe("travel_http_requests_in_flight", "gauge", "API requests currently being served.")
+
+
+# --- Spans ---
+# The stages recorded for the current request, for its Server-Timing header.
+# Tasks started through pipeline.submit() and asyncio carry it along.
+_request_timings = ContextVar("request_timings", default=None)
+
+
+class span:
+    """Times a block as pipeline stage `stage`: `with metrics.span("weather"): ...`"""
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        with _lock:
+            _add(STAGE_IN_FLIGHT, (self.stage,), 1)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        label_values = (self.stage,)
+        with _lock:
+            _add(STAGE_IN_FLIGHT, label_values, -1)
+            _observe(STAGE_SECONDS, label_values, elapsed)
+            if exc_type is not None:
+                _add(STAGE_ERRORS, label_values, 1)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((self.stage, elapsed))
+        return False
+
+
+def timed(stage):
+    """Decorator form of span for functions that run as one stage."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class upstream_call:
+    """Times one HTTP attempt to `host`. Set .status to the response status inside the block."""
+
+    __slots__ = ("host", "status", "started")
+
+    def __init__(self, host):
+        self.host = host
+        self.status = None
+
+    def __enter__(self):
+        with _lock:
+            _add(UPSTREAM_IN_FLIGHT, (self.host,), 1)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        with _lock:
+            _add(UPSTREAM_IN_FLIGHT, (self.host,), -1)
+            _observe(UPSTREAM_SECONDS, (self.host,), elapsed)
+            _add(UPSTREAM_REQUESTS, (self.host, "error" if self.status is None else str(self.status)), 1)
+        return False
+
+
+# --- Requests ---
+def start_request():
+    """Counts an API request as in flight and starts collecting its stages. Returns the start time."""
+    _request_timings.set([])
+    with _lock:
+        _add(HTTP_IN_FLIGHT, (), 1)
+    return time.perf_counter()
+
+
+def finish_request(method, route, status, started):
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _add(HTTP_IN_FLIGHT, (), -1)
+        _observe(HTTP_SECONDS, (method, route), elapsed)
+        _add(HTTP_REQUESTS, (method, route, str(status)), 1)
+
+
+def server_timing(started):
+    """Server-Timing header value for the current request, e.g. 'llm;dur=2310.4, total;dur=2731.0'.
+
+    Stages that ran several times are summed, with the count in desc. Stages
+    running in parallel overlap, so their sum can exceed the total.
+    """
+    totals = {}
+    for stage, seconds in _request_timings.get() or ():
+        entry = totals.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+    parts = [
+        f"{stage};dur={seconds * 1000:.1f}" + (f';desc="{count}x"' if count > 1 else "")
+        for stage, (seconds, count) in totals.items()
+    ]
+    parts.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+    return ", ".join(parts)
+
+
+# --- Exposition ---
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    collected = {}
+    for collect in list(_collectors):
+        try:
+            for name, label_values, value in collect():
+                collected.setdefault(name, []).append((tuple(label_values), value))
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+
+    with _lock:
+        snapshot = [
+            (metric, [(label_values, [list(value[0]), value[1], value[2]] if metric.kind == "histogram" else value)
+                      for label_values, value in metric.values.items()])
+            for metric in _metrics.values()
+        ]
+
+    lines = []
+    for metric, samples in snapshot:
+        samples += collected.get(metric.name, [])
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for label_values, value in samples:
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_labels(metric.labels, label_values)} {_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{metric.name}_bucket{_labels(metric.labels, label_values, le)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.labels, label_values)} {_number(total)}")
+            lines.append(f"{metric.name}_count{_labels(metric.labels, label_values)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,79 @@
+# pipeline.py
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from config import PIPELINE_STAGE_WORKERS, PIPELINE_CALL_WORKERS, BATCH_TRIP_WORKERS
+
+# Two pools so that a stage running in the stage pool can fan out its own
+# sub-calls without waiting on a slot it is itself occupying.
+stage_pool = ThreadPoolExecutor(max_workers=PIPELINE_STAGE_WORKERS, thread_name_prefix="stage")
+call_pool = ThreadPoolExecutor(max_workers=PIPELINE_CALL_WORKERS, thread_name_prefix="upstream")
+# Whole trips of a batch request. Its size bounds how many generate at once
+# across all batches; each trip still fans out into the two pools above.
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_TRIP_WORKERS, thread_name_prefix="batch")
+
+
+class StageResult:
+    """Outcome of one task run by run_parallel."""
+
+    def __init__(self, value=None, error=None, elapsed=0.0):
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f"StageResult(ok={self.ok}, elapsed={self.elapsed:.3f})"
+
+
+def _timed(fn):
+    started = time.perf_counter()
+    value = fn()
+    return value, time.perf_counter() - started
+
+
+def submit(fn, pool=None):
+    """Starts fn() in the background and returns a future of (value, elapsed)."""
+    # Runs in a copy of the caller's context, so metrics spans inside fn still
+    # count towards the request that started it.
+    return (pool or stage_pool).submit(contextvars.copy_context().run, _timed, fn)
+
+
+def collect(futures, timeouts=None, default_timeout=None):
+    """Waits for futures started with submit() and returns {name: StageResult}.
+
+    A task that raises or runs past its timeout is reported through
+    StageResult.error instead of raising, so callers can decide how to
+    degrade. Timeouts are counted from the call to collect(). Timed-out
+    tasks keep running in their pool; their result is simply ignored.
+    """
+    timeouts = timeouts or {}
+    started = time.perf_counter()
+    results = {}
+    for name, future in futures.items():
+        timeout = timeouts.get(name, default_timeout)
+        remaining = None if timeout is None else max(0.0, timeout - (time.perf_counter() - started))
+        done, _ = wait([future], timeout=remaining)
+        if not done:
+            future.cancel()
+            results[name] = StageResult(error=TimeoutError(f"Stage '{name}' timed out after {timeout}s"),
+                                        elapsed=time.perf_counter() - started)
+            continue
+        try:
+            value, elapsed = future.result()
+            results[name] = StageResult(value=value, elapsed=elapsed)
+        except Exception as e:
+            results[name] = StageResult(error=e, elapsed=time.perf_counter() - started)
+    return results
+
+
+def run_parallel(tasks, timeouts=None, default_timeout=None, pool=None):
+    """Runs independent zero-argument callables concurrently.
+
+    `tasks` maps a stage name to a callable. Returns {name: StageResult}.
+    """
+    futures = {name: submit(fn, pool) for name, fn in tasks.items()}
+    return collect(futures, timeouts=timeouts, default_timeout=default_timeout)
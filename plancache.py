@@ -0,0 +1,110 @@
+# plancache.py
+import copy
+import hashlib
+import json
+import math
+import threading
+from datetime import datetime, timedelta
+import metrics
+from cache import SQLiteCache
+from geocache import normalize_query
+from config import (
+    PLAN_CACHE_ENABLED,
+    PLAN_CACHE_PATH,
+    PLAN_CACHE_TTL_SECONDS,
+    PLAN_CACHE_MAX_ENTRIES,
+    PLAN_CACHE_BUDGET_BAND_RATIO
+)
+
+_store = SQLiteCache(PLAN_CACHE_PATH, "plan", max_entries=PLAN_CACHE_MAX_ENTRIES)
+_lock = threading.Lock()
+
+# Seconds of Gemini generation that cache hits avoided.
+saved_llm_seconds = 0.0
+
+# WMO weather codes grouped by whether they change what activities make sense.
+_WET_CODES = set(range(51, 68)) | set(range(80, 83)) | set(range(95, 100))
+
+
+def budget_band(budget):
+    """Buckets a budget geometrically, e.g. 20k-40k INR and 22k-38k INR share a band."""
+    if not budget or not budget.get('max'):
+        return None
+    try:
+        budget_max = float(budget['max'])
+    except (TypeError, ValueError):
+        return None
+    if budget_max <= 0:
+        return None
+    band = math.floor(math.log(budget_max) / math.log(PLAN_CACHE_BUDGET_BAND_RATIO))
+    return f"{budget.get('currency') or ''}:{band}"
+
+
+def weather_bucket(weather_data):
+    """Coarse summary of the forecast: the share of wet days, in quarters."""
+    if not weather_data:
+        return None
+    wet_days = sum(1 for day in weather_data if day.get('weather_code') in _WET_CODES)
+    return round(4 * wet_days / len(weather_data))
+
+
+def plan_cache_key(main_location, duration, budget, interests, current_location, weather_data):
+    """Builds the cache key from the trip parameters that shape the generated plan.
+
+    The destination is canonicalized through its geocode (about 1 km grid) so
+    "Goa", "goa, india" and "Goa, India" share plans.
+    """
+    parts = {
+        "destination": [round(main_location.latitude, 2), round(main_location.longitude, 2)],
+        "duration": duration,
+        "budget": budget_band(budget),
+        "interests": sorted({str(interest).strip().casefold() for interest in interests or []}),
+        "origin": normalize_query(current_location),
+        "weather": weather_bucket(weather_data)
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def lookup(key, start_date, weather_data):
+    """Returns a cached itinerary re-dated to `start_date` with fresh weather, or None."""
+    global saved_llm_seconds
+    if not PLAN_CACHE_ENABLED:
+        return None
+    found, entry = _store.get(key)
+    if not found:
+        return None
+    with _lock:
+        saved_llm_seconds += entry["llm_seconds"]
+
+    itinerary = copy.deepcopy(entry["itinerary"])
+    first_day = datetime.strptime(start_date, "%Y-%m-%d")
+    for i, day_plan in enumerate(itinerary):
+        if 'date' in day_plan:
+            day_plan['date'] = (first_day + timedelta(days=i)).strftime("%Y-%m-%d")
+        if i < len(weather_data): day_plan['weather'] = weather_data[i]
+    return itinerary
+
+
+def store(key, itinerary, llm_seconds):
+    """Caches an itinerary without its weather, day-level or per activity, which is re-attached on every hit."""
+    if not PLAN_CACHE_ENABLED:
+        return
+    stripped = []
+    for day_plan in itinerary:
+        day_plan = {
+            field: {name: value for name, value in activity.items() if name != 'weather'} if isinstance(activity, dict) else activity
+            for field, activity in day_plan.items() if field != 'weather'
+        }
+        stripped.append(day_plan)
+    _store.set(key, {"itinerary": stripped, "llm_seconds": llm_seconds}, PLAN_CACHE_TTL_SECONDS)
+
+
+def stats():
+    result = _store.stats()
+    result["saved_llm_seconds"] = round(saved_llm_seconds, 1)
+    return result
+
+
+metrics.describe("travel_plan_cache_saved_llm_seconds_total", "counter",
+                 "Generation time saved by serving plans from the cache.")
+metrics.register_collector(lambda: [("travel_plan_cache_saved_llm_seconds_total", (), saved_llm_seconds)])
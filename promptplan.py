@@ -0,0 +1,125 @@
+# promptplan.py
+import math
+import threading
+from collections import deque
+import metrics
+from config import GENERATION_CHUNK_DAYS, GENERATION_OUTPUT_TOKENS_PER_DAY, GENERATION_MAX_OUTPUT_TOKENS
+
+# --- Compact Prompt Context ---
+# WMO weather interpretation codes as returned by Open-Meteo.
+WMO_WEATHER = {
+    0: "clear", 1: "mostly clear", 2: "partly cloudy", 3: "overcast",
+    45: "fog", 48: "fog",
+    51: "light drizzle", 53: "drizzle", 55: "heavy drizzle", 56: "freezing drizzle", 57: "freezing drizzle",
+    61: "light rain", 63: "rain", 65: "heavy rain", 66: "freezing rain", 67: "freezing rain",
+    71: "light snow", 73: "snow", 75: "heavy snow", 77: "snow grains",
+    80: "showers", 81: "showers", 82: "heavy showers", 85: "snow showers", 86: "snow showers",
+    95: "thunderstorm", 96: "thunderstorm, hail", 99: "thunderstorm, hail"
+}
+
+
+def weather_table(weather_data):
+    """One short line per day instead of the JSON rows: '2025-01-01|light rain|31.2/24.0'."""
+    if not weather_data:
+        return "not available"
+    return "\n".join(
+        f"{day['date']}|{WMO_WEATHER.get(day['weather_code'], 'code ' + str(day['weather_code']))}|{day['temp_max']}/{day['temp_min']}"
+        for day in weather_data
+    )
+
+
+def transport_summary(recommendation):
+    """The transport recommendation as one line, e.g. 'Flight, ~9200 INR round trip. Cheapest flight ...'."""
+    summary = recommendation.get('mode') or "Not available"
+    cost = recommendation.get('estimated_cost_round_trip')
+    if cost:
+        summary += f", ~{cost['amount']:.0f} {cost['currency']} round trip"
+    if recommendation.get('details'):
+        summary += f". {recommendation['details']}"
+    return summary
+
+
+# --- Token Budgeting ---
+def estimate_tokens(text):
+    """Rough token count for English prose and JSON (about four characters per token)."""
+    return math.ceil(len(text) / 4)
+
+
+def estimate_output_tokens(days):
+    return days * GENERATION_OUTPUT_TOKENS_PER_DAY
+
+
+def plan_segments(duration):
+    """Splits a trip into (first_day, last_day) ranges that are generated by separate, concurrent requests.
+
+    A segment holds at most GENERATION_CHUNK_DAYS days and no more than fit in
+    GENERATION_MAX_OUTPUT_TOKENS; segments are as even as possible, so a
+    15-day trip with 7-day chunks becomes 5 + 5 + 5 rather than 7 + 7 + 1.
+    """
+    if duration < 1:
+        raise Exception(f"A trip must last at least one day, got {duration}")
+    per_segment = max(1, min(GENERATION_CHUNK_DAYS, GENERATION_MAX_OUTPUT_TOKENS // GENERATION_OUTPUT_TOKENS_PER_DAY))
+    count = math.ceil(duration / per_segment)
+    size, longer = divmod(duration, count)
+    segments = []
+    first_day = 1
+    for i in range(count):
+        last_day = first_day + size - 1 + (1 if i < longer else 0)
+        segments.append((first_day, last_day))
+        first_day = last_day + 1
+    return segments
+
+
+# --- Generation Records ---
+_records = deque(maxlen=200)
+_lock = threading.Lock()
+_totals = {"chunks": 0, "input_tokens": 0, "output_tokens": 0, "seconds": 0.0}
+
+
+def record(first_day, last_day, prompt, seconds, usage=None):
+    """Records one generation request: estimated and (when Gemini reports them) actual tokens, and latency."""
+    usage = usage or {}
+    entry = {
+        "days": f"{first_day}-{last_day}",
+        "input_tokens_estimate": estimate_tokens(prompt),
+        "output_tokens_estimate": estimate_output_tokens(last_day - first_day + 1),
+        "input_tokens": usage.get("promptTokenCount"),
+        "output_tokens": usage.get("candidatesTokenCount"),
+        "seconds": round(seconds, 3)
+    }
+    print(f"Generated days {entry['days']} in {entry['seconds']}s "
+          f"(tokens in/out: {entry['input_tokens'] or '~' + str(entry['input_tokens_estimate'])}"
+          f"/{entry['output_tokens'] or '~' + str(entry['output_tokens_estimate'])})")
+    with _lock:
+        _records.append(entry)
+        _totals["chunks"] += 1
+        _totals["input_tokens"] += entry["input_tokens"] or entry["input_tokens_estimate"]
+        _totals["output_tokens"] += entry["output_tokens"] or entry["output_tokens_estimate"]
+        _totals["seconds"] += seconds
+
+
+def stats():
+    with _lock:
+        chunks = _totals["chunks"]
+        return {
+            **{key: round(value, 3) for key, value in _totals.items()},
+            "avg_seconds_per_chunk": round(_totals["seconds"] / chunks, 3) if chunks else None,
+            "recent": list(_records)[-20:]
+        }
+
+
+metrics.describe("travel_generation_requests_total", "counter", "Itinerary generation requests (one per segment).")
+metrics.describe("travel_generation_tokens_total", "counter",
+                 "Tokens used by itinerary generation, as reported by Gemini or else estimated.", ["direction"])
+
+
+def _metric_samples():
+    with _lock:
+        return [
+            ("travel_generation_requests_total", (), _totals["chunks"]),
+            ("travel_generation_tokens_total", ("input",), _totals["input_tokens"]),
+            ("travel_generation_tokens_total", ("output",), _totals["output_tokens"])
+        ]
+
+
+metrics.register_collector(_metric_samples)
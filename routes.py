@@ -1,8 +1,22 @@
 # routes.py
-from flask import request, jsonify, Blueprint
-from config import supabase
+import base64
+import hashlib
+import json
+from datetime import datetime
+from flask import request, jsonify, Blueprint, url_for, Response, stream_with_context
+from db import user_db, service_db, auth_client
+import geocache
+import plancache
+import amadeus_cache
+import weathercache
+import promptplan
+from jobs import trip_jobs, QueueFull, InvalidCallback
+from auth import authenticate, token_seconds_left
+from config import BATCH_MAX_TRIPS, JOB_MIN_TOKEN_SECONDS
 from services import (
     generate_itinerary_with_coords,
+    generate_itineraries_with_coords,
+    stream_itinerary_with_coords,
     get_flight_options,
     simulate_train_options
 )
@@ -10,14 +24,24 @@ from services import (
 # Create a Blueprint for API routes
 api = Blueprint('api', __name__, url_prefix='/api/v1')
 
-def get_user_from_token(request):
-    """Helper function to get user from JWT token in request header."""
+def bearer_token(request):
+    """Returns the JWT from the Authorization header, or None."""
     token = request.headers.get('Authorization')
     if not token or len(token.split(" ")) < 2:
+        return None
+    return token.split(" ")[1]
+
+def request_db(request):
+    """Database access scoped to the caller's JWT, so row-level security applies to this request only."""
+    return user_db(bearer_token(request))
+
+def get_user_from_token(request):
+    """Helper function to get user from JWT token in request header."""
+    token = bearer_token(request)
+    if not token:
         return None, {"msg": "Missing or invalid Authorization header"}
-    token = token.split(" ")[1]
     try:
-        user = supabase.auth.get_user(token)
+        user = authenticate(token)
         return user, None
     except Exception as e:
         return None, {"msg": f"Invalid token: {e}"}
@@ -29,7 +53,7 @@ def register():
     try:
         # Step 1: Let Supabase Auth handle the user creation securely.
         # This creates the user in auth.users
-        auth_response = supabase.auth.sign_up({
+        auth_response = auth_client().sign_up({
             "email": data['email'],
             "password": data['password']
         })
@@ -44,7 +68,9 @@ def register():
                 'preferences': data.get('preferences', {})
             }
             # Insert the profile data. This will link the user to the 'profiles' table.
-            supabase.table('profiles').insert(profile_data).execute()
+            # When sign-up returns a session (no email confirmation), insert as the new user.
+            db = user_db(auth_response.session.access_token) if auth_response.session else service_db
+            db.table('profiles').insert(profile_data).execute()
             
         return jsonify({"msg": "User created successfully. Please check your email to confirm if email verification is enabled."}), 201
     except Exception as e:
@@ -54,7 +80,7 @@ def register():
 def login():
     data = request.get_json()
     try:
-        user_response = supabase.auth.sign_in_with_password({
+        user_response = auth_client().sign_in_with_password({
             "email": data['email'],
             "password": data['password']
         })
@@ -72,13 +98,67 @@ def login():
 
 @api.route('/auth/logout', methods=['POST'])
 def logout():
+    token = bearer_token(request)
+    if not token:
+        return jsonify({"msg": "Missing or invalid Authorization header"}), 401
     try:
-        supabase.auth.sign_out()
+        # Revokes the caller's refresh tokens; nothing shared with other users is touched.
+        auth_client().admin.sign_out(token)
         return jsonify({"msg": "Logged out successfully"}), 200
     except Exception as e:
         return jsonify({"msg": f"Logout failed: {e}"}), 500
 
 # --- Trip Management Routes ---
+def build_trip_record(user_id, data, plan):
+    """Maps a validated trip request and its generated plan onto a `trips` row."""
+    # Determine the trip name. Use provided name, or fall back to destination.
+    # Ensure a name is always present because the database requires it (NOT NULL).
+    trip_name = data.get('name', data['destination']) 
+    if not trip_name: # Fallback if destination is also empty (shouldn't happen if required)
+        trip_name = "Untitled Trip"
+
+    return {
+        'user_id': user_id,
+        'name': trip_name,
+        'destination': data['destination'],
+        'start_date': data['start_date'],
+        'end_date': data['end_date'],
+        'budget': data.get('budget'),
+        'interests': data.get('interests', []), # This is a Python list, which supabase-py maps to TEXT[]
+        'itinerary': plan['itinerary']
+    }
+
+def generate_and_save_trip(db, user_id, data):
+    """Runs the full generation pipeline and stores the result. Shared by sync and job mode."""
+    # Generate itinerary using external service
+    plan = generate_itinerary_with_coords(
+        data['destination'],
+        data['start_date'],
+        data['end_date'],
+        data.get('budget'), # budget is optional
+        data.get('interests', []), # interests is optional, default to empty list (correct for TEXT[] in DB)
+        data['current_location']
+    )
+
+    trip_data = build_trip_record(user_id, data, plan)
+    print(f"Attempting to insert trip with user_id: {user_id} and name: '{trip_data['name']}'")
+
+    response = db.table('trips').insert(trip_data).execute()
+    return {"trip_id": response.data[0]['id'], "plan": plan}
+
+def wants_async(request):
+    """Job mode is requested with ?async=true or an RFC 7240 'Prefer: respond-async' header."""
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+def job_token_error(token):
+    """Jobs insert their trips with the caller's token, so it must not expire while the job waits or runs."""
+    seconds_left = token_seconds_left(token)
+    if seconds_left < JOB_MIN_TOKEN_SECONDS:
+        return {"msg": f"Access token expires in {max(0, int(seconds_left))}s; refresh the session before queueing a job"}
+    return None
+
 @api.route('/trips', methods=['POST'])
 def create_trip():
     user, error = get_user_from_token(request)
@@ -90,61 +170,263 @@ def create_trip():
     required_fields = ['destination', 'start_date', 'end_date', 'current_location']
     if not all(k in data for k in required_fields):
         return jsonify({"msg": f"Missing required fields. Required: {required_fields}"}), 400
+    dates_error = trip_dates_error(data)
+    if dates_error:
+        return jsonify({"msg": dates_error}), 400
+
+    user_id = user.user.id
+    db = request_db(request)
+    if wants_async(request):
+        error = job_token_error(bearer_token(request))
+        if error: return jsonify(error), 401
+        try:
+            job = trip_jobs.submit(user_id, lambda: generate_and_save_trip(db, user_id, data), data.get('callback_url'))
+        except InvalidCallback as e:
+            return jsonify({"msg": str(e)}), 400
+        except QueueFull as e:
+            return jsonify({"msg": str(e)}), 503, {'Retry-After': '30'}
+        return jsonify({
+            "msg": "Trip generation queued",
+            "job_id": job.id,
+            "status_url": url_for('api.get_job', job_id=job.id)
+        }), 202, {'Location': url_for('api.get_job', job_id=job.id)}
 
     try:
-        # Generate itinerary using external service
-        plan = generate_itinerary_with_coords(
-            data['destination'],
-            data['start_date'],
-            data['end_date'],
-            data.get('budget'), # budget is optional
-            data.get('interests', []), # interests is optional, default to empty list (correct for TEXT[] in DB)
-            data['current_location']
-        )
-        
-        # Determine the trip name. Use provided name, or fall back to destination.
-        # Ensure a name is always present because the database requires it (NOT NULL).
-        trip_name = data.get('name', data['destination']) 
-        if not trip_name: # Fallback if destination is also empty (shouldn't happen if required)
-            trip_name = "Untitled Trip"
-
-        trip_data = {
-            'user_id': user.user.id,
-            'name': trip_name,
-            'destination': data['destination'],
-            'start_date': data['start_date'],
-            'end_date': data['end_date'],
-            'budget': data.get('budget'),
-            'interests': data.get('interests', []), # This is a Python list, which supabase-py maps to TEXT[]
-            'itinerary': plan['itinerary']
-        }
-        
-        print(f"Attempting to insert trip with user_id: {user.user.id} and name: '{trip_name}'")
-        
-        response = supabase.table('trips').insert(trip_data).execute()
-        
+        result = generate_and_save_trip(db, user_id, data)
         return jsonify({
             "msg": "Trip created successfully", 
-            "trip_id": response.data[0]['id'],
-            "plan": plan
+            "trip_id": result['trip_id'],
+            "plan": result['plan']
         }), 201
     except Exception as e:
         # It's good practice to log the full exception for debugging in production
         print(f"Error creating trip: {e}")
         return jsonify({"msg": f"Failed to create trip: {str(e)}"}), 500
 
+REQUIRED_TRIP_FIELDS = ['destination', 'start_date', 'end_date', 'current_location']
+
+def trip_dates_error(data):
+    """Returns why the trip's start_date/end_date are unusable, or None if they form a valid range."""
+    try:
+        start = datetime.strptime(str(data['start_date']), "%Y-%m-%d")
+        end = datetime.strptime(str(data['end_date']), "%Y-%m-%d")
+    except ValueError:
+        return "start_date and end_date must be dates in YYYY-MM-DD format"
+    if end < start:
+        return "end_date must not be before start_date"
+    return None
+
+def batch_trips(data):
+    """Returns (trips, error message) for a POST /trips/batch body.
+
+    Fields under `defaults` apply to every trip that does not set them, e.g.
+    the same dates and origin for several candidate destinations.
+    """
+    if not isinstance(data, dict):
+        return None, "Request body must be a JSON object"
+    trips = data.get('trips')
+    if not isinstance(trips, list) or not trips:
+        return None, "'trips' must be a non-empty list of trips"
+    if len(trips) > BATCH_MAX_TRIPS:
+        return None, f"At most {BATCH_MAX_TRIPS} trips can be created in one batch"
+    defaults = data.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        return None, "'defaults' must be an object"
+    for i, trip in enumerate(trips):
+        if not isinstance(trip, dict):
+            return None, f"Trip {i} must be an object"
+    trips = [{**defaults, **trip} for trip in trips]
+    for i, trip in enumerate(trips):
+        if not all(k in trip for k in REQUIRED_TRIP_FIELDS):
+            return None, f"Trip {i} is missing required fields. Required: {REQUIRED_TRIP_FIELDS}"
+        dates_error = trip_dates_error(trip)
+        if dates_error:
+            return None, f"Trip {i}: {dates_error}"
+    return trips, None
+
+def batch_records(user_id, trips, results):
+    """Indexes of the generated trips of a batch and their `trips` rows, for one bulk insert.
+
+    `results` holds the plan, or the exception that stopped it, of every trip.
+    """
+    generated = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+    return generated, [build_trip_record(user_id, trips[i], results[i]) for i in generated]
+
+def batch_result(results, generated, inserted):
+    """Response body of a batch: one entry per trip, in request order, with its trip_id and plan or its error.
+
+    `inserted` is the rows returned by the bulk insert, or the exception it raised.
+    """
+    entries = [{"index": i, "error": f"Failed to create trip: {result}"} for i, result in enumerate(results)]
+    if isinstance(inserted, Exception):
+        for i in generated:
+            entries[i] = {"index": i, "error": f"Failed to save trip: {inserted}"}
+    else:
+        for i, row in zip(generated, inserted):
+            entries[i] = {"index": i, "trip_id": row['id'], "plan": results[i]}
+    created = sum(1 for entry in entries if 'trip_id' in entry)
+    return {"msg": f"Created {created} of {len(results)} trips", "created": created, "failed": len(results) - created, "trips": entries}
+
+def batch_status(result):
+    """201 when every trip was created, 207 when only some were, 500 when none were."""
+    if not result['failed']:
+        return 201
+    return 207 if result['created'] else 500
+
+def generate_and_save_trips(db, user_id, trips):
+    """Runs the batch pipeline and stores all generated trips with a single insert. Shared by sync and job mode."""
+    results = [result.value if result.ok else result.error for result in generate_itineraries_with_coords(trips)]
+    generated, records = batch_records(user_id, trips, results)
+    inserted = []
+    if records:
+        print(f"Attempting to insert {len(records)} trips with user_id: {user_id}")
+        try:
+            inserted = db.table('trips').insert(records).execute().data
+        except Exception as e:
+            print(f"Error saving trip batch: {e}")
+            inserted = e
+    return batch_result(results, generated, inserted)
+
+@api.route('/trips/batch', methods=['POST'])
+def create_trip_batch():
+    """Creates many trips at once, sharing geocoding, weather and flight searches between them."""
+    user, error = get_user_from_token(request)
+    if error: return jsonify(error), 401
+    data = request.get_json()
+    trips, error = batch_trips(data)
+    if error: return jsonify({"msg": error}), 400
+
+    user_id = user.user.id
+    db = request_db(request)
+    if wants_async(request):
+        error = job_token_error(bearer_token(request))
+        if error: return jsonify(error), 401
+        try:
+            job = trip_jobs.submit(user_id, lambda: generate_and_save_trips(db, user_id, trips), data.get('callback_url'))
+        except InvalidCallback as e:
+            return jsonify({"msg": str(e)}), 400
+        except QueueFull as e:
+            return jsonify({"msg": str(e)}), 503, {'Retry-After': '30'}
+        return jsonify({
+            "msg": "Trip batch generation queued",
+            "job_id": job.id,
+            "status_url": url_for('api.get_job', job_id=job.id)
+        }), 202, {'Location': url_for('api.get_job', job_id=job.id)}
+
+    result = generate_and_save_trips(db, user_id, trips)
+    return jsonify(result), batch_status(result)
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@api.route('/trips/stream', methods=['POST'])
+def create_trip_stream():
+    """Same as POST /trips, but streams the plan day by day as Server-Sent Events."""
+    user, error = get_user_from_token(request)
+    if error: return jsonify(error), 401
+    data = request.get_json()
+
+    required_fields = ['destination', 'start_date', 'end_date', 'current_location']
+    if not all(k in data for k in required_fields):
+        return jsonify({"msg": f"Missing required fields. Required: {required_fields}"}), 400
+    dates_error = trip_dates_error(data)
+    if dates_error:
+        return jsonify({"msg": dates_error}), 400
+    user_id = user.user.id
+    db = request_db(request)
+
+    def events():
+        try:
+            plan = None
+            for event, payload in stream_itinerary_with_coords(
+                data['destination'],
+                data['start_date'],
+                data['end_date'],
+                data.get('budget'),
+                data.get('interests', []),
+                data['current_location']
+            ):
+                if event == 'plan':
+                    plan = payload
+                else:
+                    yield sse_event(event, payload)
+
+            trip_data = build_trip_record(user_id, data, plan)
+            response = db.table('trips').insert(trip_data).execute()
+            yield sse_event('done', {"msg": "Trip created successfully", "trip_id": response.data[0]['id']})
+        except Exception as e:
+            print(f"Error streaming trip: {e}")
+            yield sse_event('error', {"msg": f"Failed to create trip: {str(e)}"})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    user, error = get_user_from_token(request)
+    if error: return jsonify(error), 401
+
+    job = trip_jobs.get(job_id, user.user.id)
+    if not job:
+        return jsonify({"msg": "Job not found or not authorized"}), 404
+    return jsonify(job.to_dict()), 200
+
+# Columns returned by GET /trips unless ?fields= asks for others. The large
+# itinerary and transport blobs are only loaded when explicitly requested.
+TRIP_SUMMARY_FIELDS = ['id', 'name', 'destination', 'start_date', 'end_date', 'budget', 'interests']
+TRIP_FIELDS = TRIP_SUMMARY_FIELDS + ['user_id', 'itinerary', 'transport_recommendation']
+TRIPS_PAGE_DEFAULT = 20
+TRIPS_PAGE_MAX = 100
+
+def encode_cursor(trip_id):
+    return base64.urlsafe_b64encode(json.dumps({"id": trip_id}).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return int(json.loads(base64.urlsafe_b64decode(padded))['id'])
+
 @api.route('/trips', methods=['GET'])
 def get_trips():
     user, error = get_user_from_token(request)
     if error: return jsonify(error), 401
+
+    limit = min(max(request.args.get('limit', TRIPS_PAGE_DEFAULT, type=int), 1), TRIPS_PAGE_MAX)
+    fields = TRIP_SUMMARY_FIELDS
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in TRIP_FIELDS]
+        if unknown:
+            return jsonify({"msg": f"Unknown fields: {unknown}. Allowed: {TRIP_FIELDS}"}), 400
+        if 'id' not in fields:
+            fields = ['id'] + fields # The cursor is built from the id
+    cursor = request.args.get('cursor')
+    try:
+        cursor_id = decode_cursor(cursor) if cursor else None
+    except (ValueError, KeyError, TypeError):
+        return jsonify({"msg": "Invalid cursor"}), 400
     
     try:
-        # RLS will ensure only the user's own trips are returned
-        response = supabase.table('trips').select('*').execute()
-        return jsonify(response.data), 200
+        # RLS will ensure only the user's own trips are returned.
+        # Keyset pagination on id: newest first, one extra row tells us if there is a next page.
+        query = request_db(request).table('trips').select(','.join(fields)).order('id', desc=True).limit(limit + 1)
+        if cursor_id is not None:
+            query = query.lt('id', cursor_id)
+        response = query.execute()
     except Exception as e:
         return jsonify({"msg": f"Failed to retrieve trips: {e}"}), 500
 
+    trips = response.data[:limit]
+    result = jsonify(trips)
+    if len(response.data) > limit:
+        next_cursor = encode_cursor(trips[-1]['id'])
+        next_args = {**request.args.to_dict(), 'cursor': next_cursor}
+        result.headers['X-Next-Cursor'] = next_cursor
+        result.headers['Link'] = f'<{url_for("api.get_trips", **next_args)}>; rel="next"'
+    # Lets clients revalidate with If-None-Match and get a bodiless 304 when nothing changed.
+    result.set_etag(hashlib.sha256(result.get_data()).hexdigest()[:32])
+    result.headers['Cache-Control'] = 'private, no-cache'
+    return result.make_conditional(request)
+
 @api.route('/trips/<int:trip_id>', methods=['GET'])
 def get_trip(trip_id):
     user, error = get_user_from_token(request)
@@ -152,7 +434,7 @@ def get_trip(trip_id):
     
     try:
         # RLS will ensure only the user's own trip is returned
-        response = supabase.table('trips').select('*').eq('id', trip_id).execute()
+        response = request_db(request).table('trips').select('*').eq('id', trip_id).execute()
         if not response.data:
             return jsonify({"msg": "Trip not found or not authorized"}), 404
         return jsonify(response.data[0]), 200
@@ -171,7 +453,7 @@ def update_trip(trip_id):
             data['name'] = "Untitled Trip" # Prevent setting name to empty string if it's NOT NULL
 
         # RLS will ensure only the user's own trip can be updated
-        response = supabase.table('trips').update(data).eq('id', trip_id).eq('user_id', user.user.id).execute()
+        response = request_db(request).table('trips').update(data).eq('id', trip_id).eq('user_id', user.user.id).execute()
         if not response.data:
             return jsonify({"msg": "Trip not found or not authorized"}), 404
         return jsonify({"msg": "Trip updated successfully", "trip": response.data[0]}), 200
@@ -185,7 +467,7 @@ def delete_trip(trip_id):
     
     try:
         # RLS will ensure only the user's own trip can be deleted
-        response = supabase.table('trips').delete().eq('id', trip_id).eq('user_id', user.user.id).execute()
+        response = request_db(request).table('trips').delete().eq('id', trip_id).eq('user_id', user.user.id).execute()
         if not response.data:
             return jsonify({"msg": "Trip not found or not authorized"}), 404
         return jsonify({"msg": "Trip deleted successfully"}), 200
@@ -205,7 +487,8 @@ def get_flights_standalone():
     date = request.args.get('date')
     if not all([origin, destination, date]):
         return jsonify({"msg": "Missing required query parameters: origin, destination, date"}), 400
-    flight_options = get_flight_options(origin, destination, date)
+    adults = request.args.get('adults', 1, type=int)
+    flight_options = get_flight_options(origin, destination, date, adults)
     return jsonify(flight_options)
 
 @api.route('/transport/trains', methods=['GET'])
@@ -233,4 +516,19 @@ def get_trains_standalone():
             'itinerary': plan['itinerary'],
             # Add this line to save the transport recommendation
             'transport_recommendation': plan['transport_recommendation']
-        }
\ No newline at end of file
+        }
+
+
+# --- Operational Routes ---
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Hit/miss counters of the local caches, used to tune TTLs and bucketing."""
+    user, error = get_user_from_token(request)
+    if error: return jsonify(error), 401
+    return jsonify({
+        "geocode": geocache.stats(),
+        "plan": plancache.stats(),
+        "amadeus": amadeus_cache.stats(),
+        "weather": weathercache.stats(),
+        "generation": promptplan.stats()
+    }), 200
@@ -1,56 +1,100 @@
 # services.py
 import json
-import requests
-from datetime import datetime
-from config import geocode_ratelimited, openmeteo, amadeus, GEMINI_API_KEY
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from config import (
+    openmeteo, amadeus, outbound, GEMINI_API_KEY, GEMINI_READ_TIMEOUT,
+    WEATHER_STAGE_TIMEOUT, TRANSPORT_STAGE_TIMEOUT, FLIGHT_SEARCH_TIMEOUT, ACTIVITY_WEATHER,
+    STRUCTURED_OUTPUT, STRUCTURED_DAY_RETRIES
+)
+from geocache import geocode, geocode_many, PRIORITY_DESTINATION
+from weathercache import cached_forecast, cached_forecasts
+from amadeus_cache import resolve_iata, search_flight_offers
+from pipeline import call_pool, stage_pool, batch_pool, collect, run_parallel, submit
+from jsonstream import JSONArrayStreamParser
+from promptplan import weather_table, transport_summary, plan_segments
+from itinerary_schema import ITINERARY_SCHEMA, DAY_SCHEMA, validate_day, validate_itinerary, fallback_day
+import metrics
+import plancache
+import promptplan
 
+OPEN_METEO_FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+@metrics.timed("weather")
 def get_weather_forecast(lat, lon, start_date, end_date):
     """Fetches weather forecast for the given location and duration."""
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": lat, "longitude": lon,
-        "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min"],
-        "timezone": "auto", "start_date": start_date, "end_date": end_date
-    }
-    responses = openmeteo.weather_api(url, params=params)
-    response = responses[0]
+    return cached_forecast(lat, lon, start_date, end_date, fetch_weather_forecasts)
+
+@metrics.timed("weather")
+def get_weather_forecasts(locations):
+    """Batch form of get_weather_forecast for many (lat, lon, start_date, end_date) tuples."""
+    return cached_forecasts(locations, fetch_weather_forecasts)
+
+def _decode_daily_forecast(response):
+    """Turns one FlatBuffers response into forecast rows with array operations."""
     daily = response.Daily()
-    daily_weather_code = daily.Variables(0).ValuesAsNumpy()
-    daily_temp_max = daily.Variables(1).ValuesAsNumpy()
-    daily_temp_min = daily.Variables(2).ValuesAsNumpy()
-    time_points = range(daily.Time(), daily.TimeEnd(), daily.Interval())
-
-    forecast = []
-    for i, time in enumerate(time_points):
-        forecast.append({
-            "date": datetime.fromtimestamp(time).strftime("%Y-%m-%d"),
-            "weather_code": int(daily_weather_code[i]),
-            "temp_max": float(round(daily_temp_max[i], 1)),
-            "temp_min": float(round(daily_temp_min[i], 1))
-        })
-    return forecast
-
-def get_flight_options(origin_city, destination_city, travel_date):
+    # Daily timestamps are local midnights expressed in UTC; shift them back to
+    # the location's own calendar before taking the date.
+    times = np.arange(daily.Time(), daily.TimeEnd(), daily.Interval(), dtype=np.int64) + response.UtcOffsetSeconds()
+    dates = times.astype('datetime64[s]').astype('datetime64[D]').astype(str)
+    weather_codes = daily.Variables(0).ValuesAsNumpy().astype(np.int64)
+    temp_max = np.round(daily.Variables(1).ValuesAsNumpy().astype(np.float64), 1)
+    temp_min = np.round(daily.Variables(2).ValuesAsNumpy().astype(np.float64), 1)
+    return dates, weather_codes, temp_max, temp_min
+
+def fetch_weather_forecasts(locations):
+    """Requests daily forecasts for many locations from Open-Meteo, bypassing the cache.
+
+    Open-Meteo takes one date range per request, so locations are grouped by
+    their range and each group is fetched with one call. A failed call only
+    leaves its own group without a forecast.
+    """
+    groups = {}
+    for i, (_, _, start_date, end_date) in enumerate(locations):
+        groups.setdefault((start_date, end_date), []).append(i)
+
+    forecasts = [[] for _ in locations]
+    for (start_date, end_date), indexes in groups.items():
+        params = {
+            "latitude": ",".join(str(locations[i][0]) for i in indexes),
+            "longitude": ",".join(str(locations[i][1]) for i in indexes),
+            "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min"],
+            "timezone": "auto", "start_date": start_date, "end_date": end_date
+        }
+        try:
+            responses = openmeteo.weather_api(OPEN_METEO_FORECAST_URL, params=params)
+        except Exception as e:
+            print(f"Weather request for {start_date}..{end_date} failed: {e}")
+            continue
+        for i, response in zip(indexes, responses):
+            dates, weather_codes, temp_max, temp_min = _decode_daily_forecast(response)
+            forecasts[i] = [
+                {"date": date, "weather_code": code, "temp_max": high, "temp_min": low}
+                for date, code, high, low in zip(dates.tolist(), weather_codes.tolist(), temp_max.tolist(), temp_min.tolist())
+            ]
+    return forecasts
+
+def get_flight_options(origin_city, destination_city, travel_date, adults=1):
     """Fetches real-time flight options from Amadeus."""
     if not amadeus:
         return {"error": "Amadeus API client not configured."}
     try:
-        origin_airports = amadeus.reference_data.locations.get(keyword=origin_city, subType='CITY,AIRPORT').data
-        if not origin_airports: return None
-        origin_iata = origin_airports[0]['iataCode']
-
-        dest_airports = amadeus.reference_data.locations.get(keyword=destination_city, subType='CITY,AIRPORT').data
-        if not dest_airports: return None
-        dest_iata = dest_airports[0]['iataCode']
-
-        response = amadeus.shopping.flight_offers_search.get(
-            originLocationCode=origin_iata,
-            destinationLocationCode=dest_iata,
-            departureDate=travel_date,
-            adults=1,
-            max=1 # We only need the cheapest option for comparison
-        )
-        return response.data
+        origin_iata = resolve_iata(origin_city)
+        if not origin_iata: return None
+
+        dest_iata = resolve_iata(destination_city)
+        if not dest_iata: return None
+
+        return search_flight_offers(origin_iata, dest_iata, travel_date, adults)
+    except Exception as e:
+        print(f"Amadeus Error: {e}")
+        return None
+
+def get_flight_options_by_iata(origin_iata, dest_iata, travel_date, adults=1):
+    """Same as get_flight_options for callers that already resolved the IATA codes."""
+    try:
+        return search_flight_offers(origin_iata, dest_iata, travel_date, adults)
     except Exception as e:
         print(f"Amadeus Error: {e}")
         return None
@@ -63,18 +107,79 @@ def simulate_train_options(origin_city, destination_city, travel_date):
         {"train_name": "Shatabdi Express", "price": {"amount": "2200", "currency": "INR"}}
     ]
 
-def get_transport_recommendation(origin, destination, start_date, end_date, budget):
-    """Analyzes transport options and recommends the best one based on budget."""
-    recommendation = {
+def default_transport_recommendation():
+    return {
         "mode": "Not available",
         "estimated_cost_round_trip": None,
         "details": "Could not determine a suitable travel option."
     }
 
+@metrics.timed("transport")
+def get_transport_recommendation(origin, destination, start_date, end_date, budget):
+    """Analyzes transport options and recommends the best one based on budget."""
     # --- Flight Analysis ---
-    onward_flights = get_flight_options(origin, destination, start_date)
-    return_flights = get_flight_options(destination, origin, end_date)
-    
+    # Each city is resolved once for both legs, then the onward and return
+    # searches, which are independent, run side by side.
+    onward_flights = return_flights = None
+    if amadeus:
+        codes = run_parallel({
+            "origin": lambda: resolve_iata(origin),
+            "destination": lambda: resolve_iata(destination)
+        }, default_timeout=FLIGHT_SEARCH_TIMEOUT, pool=call_pool)
+        origin_iata, dest_iata = codes["origin"].value, codes["destination"].value
+        if origin_iata and dest_iata:
+            flights = run_parallel({
+                "onward": lambda: get_flight_options_by_iata(origin_iata, dest_iata, start_date),
+                "return": lambda: get_flight_options_by_iata(dest_iata, origin_iata, end_date)
+            }, default_timeout=FLIGHT_SEARCH_TIMEOUT, pool=call_pool)
+            for leg, result in flights.items():
+                if not result.ok: print(f"Flight search ({leg}) failed: {result.error}")
+            onward_flights = flights["onward"].value
+            return_flights = flights["return"].value
+        else:
+            print(f"Could not resolve IATA codes for {origin} / {destination}: {codes}")
+    return recommend_transport(origin, destination, start_date, budget, onward_flights, return_flights)
+
+
+@metrics.timed("transport")
+def get_transport_recommendations(trips):
+    """Batch form of get_transport_recommendation for many trip requests.
+
+    Every city is resolved to an IATA code once and every distinct flight leg
+    (from, to, date) is searched once, however many trips share it. Returns
+    one recommendation per trip, in order.
+    """
+    flights = {}
+    routes = [(None, None)] * len(trips)
+    if amadeus:
+        cities = dict.fromkeys(city for trip in trips for city in (trip['current_location'], trip['destination']))
+        codes = run_parallel({city: (lambda city=city: resolve_iata(city)) for city in cities},
+                             default_timeout=FLIGHT_SEARCH_TIMEOUT, pool=call_pool)
+        legs = {}
+        for i, trip in enumerate(trips):
+            origin_iata, dest_iata = codes[trip['current_location']].value, codes[trip['destination']].value
+            if not (origin_iata and dest_iata):
+                print(f"Could not resolve IATA codes for {trip['current_location']} / {trip['destination']}")
+                continue
+            routes[i] = (origin_iata, dest_iata, trip['start_date']), (dest_iata, origin_iata, trip['end_date'])
+            legs.update(dict.fromkeys(routes[i]))
+        flights = run_parallel({leg: (lambda leg=leg: get_flight_options_by_iata(*leg)) for leg in legs},
+                               default_timeout=FLIGHT_SEARCH_TIMEOUT, pool=call_pool)
+        for leg, result in flights.items():
+            if not result.ok: print(f"Flight search {leg} failed: {result.error}")
+
+    recommendations = []
+    for trip, (onward, back) in zip(trips, routes):
+        onward_flights = flights[onward].value if onward else None
+        return_flights = flights[back].value if back else None
+        recommendations.append(recommend_transport(trip['current_location'], trip['destination'], trip['start_date'],
+                                                   trip.get('budget'), onward_flights, return_flights))
+    return recommendations
+
+
+def recommend_transport(origin, destination, start_date, budget, onward_flights, return_flights):
+    """Picks flight or train from the flight search results of both legs, based on budget."""
+    recommendation = default_transport_recommendation()
     flight_cost = None
     if onward_flights and return_flights:
         onward_price = float(onward_flights[0]['price']['total'])
@@ -89,7 +194,7 @@ def get_transport_recommendation(origin, destination, start_date, end_date, budg
         train_cost = float(trains[0]['price']['amount']) * 2
 
     # --- Decision Logic ---
-    budget_max = float(budget.get('max', 0))
+    budget_max = float((budget or {}).get('max', 0))
     
     if train_cost and flight_cost:
         if train_cost < (flight_cost * 0.7) and train_cost <= budget_max:
@@ -107,28 +212,147 @@ def get_transport_recommendation(origin, destination, start_date, end_date, budg
     return recommendation
 
 
-def generate_itinerary_with_coords(destination, start_date, end_date, budget, interests, current_location):
-    """Generates a complete travel plan including transport recommendations."""
-    main_location = geocode_ratelimited(destination)
+GEMINI_MODEL_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20'
+PERIODS = ['morning', 'afternoon', 'evening']
+
+
+def gemini_headers():
+    # The key goes in a header so it never shows up in URLs, logs or proxies.
+    return {'Content-Type': 'application/json', 'x-goog-api-key': GEMINI_API_KEY}
+
+
+def gemini_request_body(prompt, response_schema=None):
+    body = {"contents": [{"parts": [{"text": prompt}]}]}
+    if response_schema and STRUCTURED_OUTPUT:
+        # Constrained decoding: the answer is JSON of this shape, with no prose or fences around it.
+        body["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": response_schema}
+    return body
+
+
+def gemini_response_text(response_json):
+    """Returns the answer text of a generateContent response."""
+    if 'candidates' not in response_json or not response_json['candidates']:
+        raise ValueError("Gemini API response is missing 'candidates'.")
+    return response_json['candidates'][0]['content']['parts'][0]['text']
+
+
+def gemini_sse_fragments(line):
+    """Returns the text fragments carried by one line of a streamGenerateContent SSE response."""
+    if not line or not line.startswith('data:'):
+        return []
+    chunk = json.loads(line[len('data:'):])
+    return [
+        part['text']
+        for candidate in chunk.get('candidates', [])[:1]
+        for part in candidate.get('content', {}).get('parts', [])
+        if part.get('text')
+    ]
+
+
+def prepare_trip_context(destination, start_date, end_date, budget, current_location):
+    """Geocodes the destination and gathers weather and transport for the prompt.
+
+    Returns (main_location, weather_data, transport_recommendation).
+    """
+    # Transport does not depend on the destination's coordinates, so it starts
+    # right away and overlaps with geocoding and the weather fetch.
+    transport_future = submit(lambda: get_transport_recommendation(current_location, destination, start_date, end_date, budget))
+
+    with metrics.span("geocode"):
+        main_location = geocode(destination)
     if not main_location:
         raise Exception(f"Could not find coordinates for destination: {destination}")
 
-    weather_data = get_weather_forecast(main_location.latitude, main_location.longitude, start_date, end_date)
-    transport_recommendation = get_transport_recommendation(current_location, destination, start_date, end_date, budget)
+    weather_future = submit(lambda: get_weather_forecast(main_location.latitude, main_location.longitude, start_date, end_date))
+    stages = collect(
+        {"weather": weather_future, "transport": transport_future},
+        timeouts={"weather": WEATHER_STAGE_TIMEOUT, "transport": TRANSPORT_STAGE_TIMEOUT}
+    )
+
+    # A failed side stage degrades the plan instead of failing the whole trip.
+    weather_data = stages["weather"].value if stages["weather"].ok else []
+    if not stages["weather"].ok: print(f"Weather stage failed: {stages['weather'].error}")
+    transport_recommendation = stages["transport"].value if stages["transport"].ok else default_transport_recommendation()
+    if not stages["transport"].ok: print(f"Transport stage failed: {stages['transport'].error}")
 
-    weather_prompt_string = json.dumps(weather_data)
-    transport_prompt_string = json.dumps(transport_recommendation)
-    duration = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    return main_location, weather_data, transport_recommendation
+
+
+def prepare_batch_context(trips):
+    """Batch form of prepare_trip_context for many trip requests, sharing their upstream work.
+
+    Each distinct destination is geocoded once, all forecasts come from one
+    batched weather call and transport is planned by get_transport_recommendations.
+    Returns a (main_location, weather_data, transport_recommendation) tuple per
+    trip, with main_location None when the destination could not be found.
+    """
+    transport_future = submit(lambda: get_transport_recommendations(trips))
+
+    with metrics.span("geocode"):
+        destinations = geocode_many(list(dict.fromkeys(trip['destination'] for trip in trips)), priority=PRIORITY_DESTINATION)
+    locations = [destinations.get(trip['destination']) for trip in trips]
+
+    located = [(location.latitude, location.longitude, trip['start_date'], trip['end_date'])
+               for trip, location in zip(trips, locations) if location]
+    weather_future = submit(lambda: get_weather_forecasts(located))
+    stages = collect(
+        {"weather": weather_future, "transport": transport_future},
+        timeouts={"weather": WEATHER_STAGE_TIMEOUT, "transport": TRANSPORT_STAGE_TIMEOUT}
+    )
+
+    forecasts = iter(stages["weather"].value if stages["weather"].ok else [])
+    if not stages["weather"].ok: print(f"Weather stage failed: {stages['weather'].error}")
+    transport = stages["transport"].value if stages["transport"].ok else [default_transport_recommendation()] * len(trips)
+    if not stages["transport"].ok: print(f"Transport stage failed: {stages['transport'].error}")
+
+    return [
+        (location, next(forecasts, []) if location else [], transport_recommendation)
+        for location, transport_recommendation in zip(locations, transport)
+    ]
+
+
+def trip_duration(start_date, end_date):
+    return (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+
+
+def build_itinerary_prompt(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation, segment=None):
+    """The generation prompt for the whole trip, or for days segment=(first_day, last_day) of it.
+
+    Context is encoded compactly (weather as a table, transport as one line)
+    so the prompt stays small even for long trips.
+    """
+    duration = trip_duration(start_date, end_date)
+    first_day, last_day = segment or (1, duration)
+    budget = budget or {}
+
+    if segment:
+        segment_start = (datetime.strptime(start_date, "%Y-%m-%d") + timedelta(days=first_day - 1)).strftime("%Y-%m-%d")
+        scope = (f"Plan only days {first_day} to {last_day}, starting on {segment_start}, and number them {first_day} to {last_day}. "
+                 f"The other days are planned separately, so choose places that suit this part of the stay.")
+        travel = []
+        if first_day == 1:
+            travel.append(f"the travel from {current_location} to {destination} on day 1")
+        if last_day == duration:
+            travel.append(f"the return journey on day {duration}")
+        travel_line = f"Please incorporate {' and '.join(travel)} into the itinerary." if travel else ""
+        segment_budget = float(budget.get('max') or 0) * (last_day - first_day + 1) / duration
+        cost_scope = f"about {segment_budget:.0f} {budget.get('currency')} for these days" if segment_budget else "the traveler's budget"
+    else:
+        scope = ""
+        travel_line = f"Please incorporate the travel from {current_location} to {destination} on the first day and the return journey on the last day into the itinerary."
+        cost_scope = "the traveler's budget"
 
     # START: Modified Prompt for point-based descriptions
     prompt = f"""
     Act as an expert travel agent. Create a detailed itinerary for a {duration}-day trip from {current_location} to {destination}, starting on {start_date}.
     The traveler's budget is between {budget.get('min')} and {budget.get('max')} {budget.get('currency')}. Their interests are {', '.join(interests)}.
-    
-    Based on analysis, here is the recommended mode of transport: {transport_prompt_string}.
-    Please incorporate the travel from {current_location} to {destination} on the first day and the return journey on the last day into the itinerary.
+    {scope}
 
-    Here is the weather forecast: {weather_prompt_string}. Use this to suggest weather-appropriate activities.
+    Recommended transport: {transport_summary(transport_recommendation)}
+    {travel_line}
+
+    Weather forecast (date|sky|max/min °C), use it to suggest weather-appropriate activities:
+{weather_table(weather_data[first_day - 1:last_day])}
     
     For each day, provide suggestions for 'morning', 'afternoon', and 'evening' in that specific order. For each suggestion, provide:
     1. A "name" of a real, geocodable point of interest.
@@ -138,54 +362,364 @@ def generate_itinerary_with_coords(destination, start_date, end_date, budget, in
     5. A "special_event" (null if none).
     6. An "image_search_term", which is a simple, descriptive phrase for a stock photo (e.g., "Goa beach sunset", "historic church Goa").
 
-    The sum of all 'estimated_cost' amounts must fall within the traveler's budget.
+    The sum of all 'estimated_cost' amounts must fall within {cost_scope}.
     Provide the output as a valid JSON array.
     """
     # END: Modified Prompt
+    return prompt
+
+
+def parse_itinerary_text(response_text):
+    """Extracts the JSON itinerary array from Gemini's text answer."""
+    json_start = response_text.find('```json')
+    json_end = response_text.rfind('```')
     
-    headers = {'Content-Type': 'application/json'}
-    data = {"contents": [{"parts": [{"text": prompt}]}]}
-    response = requests.post(f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={GEMINI_API_KEY}', headers=headers, data=json.dumps(data))
+    if json_start != -1 and json_end != -1 and json_start < json_end:
+        cleaned_response = response_text[json_start + len('```json'):json_end].strip()
+    else:
+        cleaned_response = response_text.strip()
+        if not STRUCTURED_OUTPUT:
+            print("Warning: JSON markdown fences not found, attempting to parse entire response text.")
+        
+    if not cleaned_response:
+        raise ValueError("Gemini API returned an empty or unparseable text response.")
+    
+    return json.loads(cleaned_response)
+
+
+@metrics.timed("parse")
+def parse_itinerary_items(response_text):
+    """Returns the day objects in Gemini's answer.
+
+    If the answer as a whole is not valid JSON (typically cut off at the
+    output token limit), the days that were complete are salvaged instead of
+    throwing the generation away.
+    """
+    try:
+        items = parse_itinerary_text(response_text)
+    except (json.JSONDecodeError, ValueError) as e:
+        items = JSONArrayStreamParser().feed(response_text)
+        print(f"Itinerary JSON was invalid ({e}); salvaged {len(items)} complete days.")
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list) or not items:
+        raise ValueError("Gemini API response contained no itinerary days.")
+    return items
+
+
+def build_day_prompt(prompt, day_number, problem):
+    return f"""{prompt}
+    Only day {day_number} is needed now. {problem}
+    Return just that day as a single JSON object with "day": {day_number}, not an array.
+    """
+
+
+def generate_gemini(prompt, response_schema=None):
+    """Sends one generateContent request. Returns (answer text, usageMetadata)."""
+    with metrics.span("llm"):
+        response = outbound.post(f'{GEMINI_MODEL_URL}:generateContent', headers=gemini_headers(),
+                                 json=gemini_request_body(prompt, response_schema), timeout=GEMINI_READ_TIMEOUT)
 
     if response.status_code != 200:
         raise Exception(f"Failed to generate itinerary from Gemini. Status: {response.status_code}, Response: {response.text}")
 
     try:
         response_json = response.json()
-        if 'candidates' not in response_json or not response_json['candidates']:
-            raise ValueError("Gemini API response is missing 'candidates'.")
-        
-        response_text = response_json['candidates'][0]['content']['parts'][0]['text']
-        
-        json_start = response_text.find('```json')
-        json_end = response_text.rfind('```')
-        
-        if json_start != -1 and json_end != -1 and json_start < json_end:
-            cleaned_response = response_text[json_start + len('```json'):json_end].strip()
-        else:
-            cleaned_response = response_text.strip()
-            print("Warning: JSON markdown fences not found, attempting to parse entire response text.")
-            
-        if not cleaned_response:
-            raise ValueError("Gemini API returned an empty or unparseable text response.")
-        
-        itinerary = json.loads(cleaned_response)
-
+        return gemini_response_text(response_json), response_json.get('usageMetadata', {})
     except (json.JSONDecodeError, KeyError, IndexError, ValueError) as e:
         print(f"--- FAILED TO PARSE GEMINI RESPONSE ---\nError: {e}\nRaw Response: {response.text}\n------------------------------------")
         raise Exception("Could not parse the itinerary from the AI.")
 
-    for i, day_plan in enumerate(itinerary):
+
+def generate_gemini_text(prompt, response_schema=None):
+    return generate_gemini(prompt, response_schema)[0]
+
+
+def regenerate_day(prompt, day_number, problem):
+    """Asks the model for one day again, up to STRUCTURED_DAY_RETRIES times. Returns the validated day."""
+    for _ in range(STRUCTURED_DAY_RETRIES):
+        print(f"Regenerating day {day_number}: {problem}")
+        try:
+            raw = parse_itinerary_items(generate_gemini_text(build_day_prompt(prompt, day_number, problem), DAY_SCHEMA))[0]
+        except Exception as e:
+            problem = f"The previous answer for it could not be used ({e})."
+            continue
+        day, problem = validate_day(raw, day_number)
+        if day:
+            return day
+    raise Exception(f"Day {day_number} stayed invalid after {STRUCTURED_DAY_RETRIES} attempts: {problem}")
+
+
+def complete_itinerary(items, duration, prompt, first_day=1):
+    """Validates the parsed days once and regenerates only the missing or invalid ones, concurrently."""
+    days, problems = validate_itinerary(items, duration, first_day)
+    if problems:
+        results = run_parallel(
+            {day_number: (lambda day_number=day_number: regenerate_day(prompt, day_number, problems[day_number]))
+             for day_number in problems},
+            default_timeout=GEMINI_READ_TIMEOUT * STRUCTURED_DAY_RETRIES,
+            pool=call_pool
+        )
+        for day_number, result in results.items():
+            i = day_number - first_day
+            if result.ok:
+                days[i] = result.value
+            else:
+                print(result.error)
+                days[i] = fallback_day(items[i] if i < len(items) else None, day_number)
+    return days
+
+
+def generate_days(prompt, first_day, last_day):
+    """Generates, validates and repairs days first_day..last_day with one request, recording tokens and latency."""
+    started = time.perf_counter()
+    response_text, usage = generate_gemini(prompt, ITINERARY_SCHEMA)
+    try:
+        items = parse_itinerary_items(response_text)
+    except ValueError as e:
+        print(f"--- FAILED TO PARSE GEMINI RESPONSE ---\nError: {e}\nRaw Response: {response_text}\n------------------------------------")
+        raise Exception("Could not parse the itinerary from the AI.")
+    days = complete_itinerary(items, last_day - first_day + 1, prompt, first_day)
+    promptplan.record(first_day, last_day, prompt, time.perf_counter() - started, usage)
+    return days
+
+
+def generate_segments(segment_prompts):
+    """Generates the segments of a long trip concurrently and returns their days merged in order."""
+    results = run_parallel(
+        {segment: (lambda segment=segment: generate_days(segment_prompts[segment], *segment)) for segment in segment_prompts},
+        default_timeout=GEMINI_READ_TIMEOUT * (1 + STRUCTURED_DAY_RETRIES),
+        pool=stage_pool
+    )
+    failed = {segment: result.error for segment, result in results.items() if not result.ok}
+    if failed:
+        raise Exception(f"Could not generate days {', '.join(f'{first}-{last}' for first, last in failed)}: {next(iter(failed.values()))}")
+    return [day for segment in segment_prompts for day in results[segment].value]
+
+
+def segment_prompts(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation):
+    """Prompts keyed by (first_day, last_day); a single whole-trip prompt unless the trip is long."""
+    segments = plan_segments(trip_duration(start_date, end_date))
+    return {
+        segment: build_itinerary_prompt(destination, start_date, end_date, budget, interests, current_location, weather_data,
+                                        transport_recommendation, segment if len(segments) > 1 else None)
+        for segment in segments
+    }
+
+
+def attach_weather_and_locations(days, weather_data, destination, first_day_index=0, start_date=None):
+    """Adds the day's weather and geocoded coordinates for each period, in place.
+
+    `first_day_index` is the position of days[0] within the whole trip, so
+    callers that enrich the itinerary piece by piece pick the right weather.
+    With ACTIVITY_WEATHER enabled and `start_date` given, every located
+    activity also gets the forecast for its own coordinates.
+    """
+    # Resolve every POI in one batch so cached names skip the rate limiter.
+    poi_queries = []
+    for day_plan in days:
+        for period in PERIODS:
+            if period in day_plan and day_plan[period] and 'name' in day_plan[period]:
+                poi_queries.append(f"{day_plan[period]['name']}, {destination}")
+    with metrics.span("poi_geocode"):
+        poi_locations = geocode_many(poi_queries)
+
+    located = []
+    for i, day_plan in enumerate(days, start=first_day_index):
         if i < len(weather_data): day_plan['weather'] = weather_data[i]
-        for period in ['morning', 'afternoon', 'evening']:
+        for period in PERIODS:
             if period in day_plan and day_plan[period] and 'name' in day_plan[period]:
                 location_name = day_plan[period]['name']
-                try:
-                    location = geocode_ratelimited(f"{location_name}, {destination}")
-                    if location: day_plan[period]['location'] = {'name': location_name, 'lat': location.latitude, 'lng': location.longitude}
-                    else: day_plan[period]['location'] = None
-                except Exception as e:
-                    print(f"Could not geocode {location_name}: {e}")
-                    day_plan[period]['location'] = None
+                location = poi_locations.get(f"{location_name}, {destination}")
+                if location:
+                    day_plan[period]['location'] = {'name': location_name, 'lat': location.latitude, 'lng': location.longitude}
+                    located.append((i, day_plan[period]))
+                else: day_plan[period]['location'] = None
+
+    if ACTIVITY_WEATHER and start_date and located:
+        attach_activity_weather(located, start_date)
+    return days
+
+
+def lookup_cached_itinerary(cache_key, start_date, weather_data):
+    """plancache.lookup plus fresh per-activity forecasts when ACTIVITY_WEATHER is on, or None on a miss."""
+    itinerary = plancache.lookup(cache_key, start_date, weather_data)
+    if itinerary is None or not ACTIVITY_WEATHER:
+        return itinerary
+    located = [
+        (i, day_plan[period])
+        for i, day_plan in enumerate(itinerary)
+        for period in PERIODS
+        if isinstance(day_plan.get(period), dict) and day_plan[period].get('location')
+    ]
+    if located:
+        attach_activity_weather(located, start_date)
+    return itinerary
+
+
+def attach_activity_weather(located, start_date):
+    """Adds per-activity forecasts for (day_index, activity) pairs with one batched weather call."""
+    first_day = datetime.strptime(start_date, "%Y-%m-%d")
+    locations = []
+    for i, activity in located:
+        date = (first_day + timedelta(days=i)).strftime("%Y-%m-%d")
+        locations.append((activity['location']['lat'], activity['location']['lng'], date, date))
+    try:
+        forecasts = get_weather_forecasts(locations)
+    except Exception as e:
+        print(f"Activity weather failed: {e}")
+        return
+    for (_, activity), forecast in zip(located, forecasts):
+        activity['weather'] = forecast[0] if forecast else None
+
+
+def generate_itinerary_with_coords(destination, start_date, end_date, budget, interests, current_location):
+    """Generates a complete travel plan including transport recommendations."""
+    context = prepare_trip_context(destination, start_date, end_date, budget, current_location)
+    return generate_itinerary_from_context(destination, start_date, end_date, budget, interests, current_location, *context)
+
+
+def generate_itinerary_from_context(destination, start_date, end_date, budget, interests, current_location,
+                                    main_location, weather_data, transport_recommendation):
+    """The rest of generate_itinerary_with_coords once prepare_trip_context has run."""
+    cache_key = plancache.plan_cache_key(main_location, trip_duration(start_date, end_date), budget, interests, current_location, weather_data)
+    cached_itinerary = lookup_cached_itinerary(cache_key, start_date, weather_data)
+    if cached_itinerary is not None:
+        return {"itinerary": cached_itinerary, "transport_recommendation": transport_recommendation}
+
+    prompts = segment_prompts(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation)
+    llm_started = time.perf_counter()
+    if len(prompts) == 1:
+        (first_day, last_day), prompt = next(iter(prompts.items()))
+        itinerary = generate_days(prompt, first_day, last_day)
+    else:
+        itinerary = generate_segments(prompts)
+
+    llm_seconds = time.perf_counter() - llm_started
+    attach_weather_and_locations(itinerary, weather_data, destination, start_date=start_date)
+    plancache.store(cache_key, itinerary, llm_seconds)
     
     return {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+
+
+def generate_itineraries_with_coords(trips):
+    """Batch form of generate_itinerary_with_coords for many validated trip requests.
+
+    The context of all trips is prepared together by prepare_batch_context,
+    then the trips are generated on the batch pool, at most BATCH_TRIP_WORKERS
+    at a time; identical trips (e.g. one per traveler of a group) are generated
+    once. Returns a StageResult per trip, in order, so one failed trip does not
+    fail the others.
+    """
+    keys = [batch_trip_key(trip) for trip in trips]
+    unique = {}
+    for key, trip in zip(keys, trips):
+        unique.setdefault(key, trip)
+    trips = list(unique.values())
+    contexts = prepare_batch_context(trips)
+
+    def generate(trip, context):
+        if not context[0]:
+            raise Exception(f"Could not find coordinates for destination: {trip['destination']}")
+        return generate_itinerary_from_context(trip['destination'], trip['start_date'], trip['end_date'], trip.get('budget'),
+                                               trip.get('interests', []), trip['current_location'], *context)
+
+    results = run_parallel(
+        {key: (lambda trip=trip, context=context: generate(trip, context)) for key, trip, context in zip(unique, trips, contexts)},
+        pool=batch_pool
+    )
+    return [results[key] for key in keys]
+
+
+def batch_trip_key(trip):
+    """The request fields that shape a generated plan; batch trips with the same key share one generation."""
+    return json.dumps([trip['destination'], trip['start_date'], trip['end_date'], trip.get('budget'),
+                       trip.get('interests', []), trip['current_location']], sort_keys=True, default=str)
+
+
+def stream_gemini_text(prompt):
+    """Yields text fragments from Gemini's streaming endpoint as they arrive."""
+    with metrics.span("llm"), outbound.stream('POST', f'{GEMINI_MODEL_URL}:streamGenerateContent', params={'alt': 'sse'},
+                                              headers=gemini_headers(), json=gemini_request_body(prompt, ITINERARY_SCHEMA),
+                                              timeout=GEMINI_READ_TIMEOUT) as response:
+        if response.status_code != 200:
+            response.read()
+            raise Exception(f"Failed to generate itinerary from Gemini. Status: {response.status_code}, Response: {response.text}")
+
+        for line in response.iter_lines():
+            yield from gemini_sse_fragments(line)
+
+
+def streamed_day(raw, day_number, prompt):
+    """Validates a day as it arrives from the stream, regenerating just that day if it is invalid."""
+    day, problem = validate_day(raw, day_number)
+    if day:
+        return day
+    try:
+        return regenerate_day(prompt, day_number, problem)
+    except Exception as e:
+        print(e)
+        return fallback_day(raw, day_number)
+
+
+def stream_itinerary_with_coords(destination, start_date, end_date, budget, interests, current_location):
+    """Streaming variant of generate_itinerary_with_coords.
+
+    Yields (event, payload) tuples: one 'transport' event, then a 'day' event
+    for every day as soon as its JSON object is complete in the model output
+    (already enriched with weather and coordinates), and finally a 'plan'
+    event with the same dict generate_itinerary_with_coords returns.
+    """
+    main_location, weather_data, transport_recommendation = prepare_trip_context(destination, start_date, end_date, budget, current_location)
+    yield 'transport', transport_recommendation
+
+    cache_key = plancache.plan_cache_key(main_location, trip_duration(start_date, end_date), budget, interests, current_location, weather_data)
+    itinerary = lookup_cached_itinerary(cache_key, start_date, weather_data)
+    if itinerary is not None:
+        for day_plan in itinerary:
+            yield 'day', day_plan
+        yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+        return
+
+    prompts = segment_prompts(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation)
+    llm_started = time.perf_counter()
+    if len(prompts) > 1:
+        # Long trips: all segments are generated at once and each is sent as soon as it and those before it are done.
+        futures = {segment: submit(lambda prompt=prompt, segment=segment: generate_days(prompt, *segment), pool=stage_pool)
+                   for segment, prompt in prompts.items()}
+        itinerary = []
+        for segment, future in futures.items():
+            days, _ = future.result()
+            attach_weather_and_locations(days, weather_data, destination, first_day_index=len(itinerary), start_date=start_date)
+            for day_plan in days:
+                itinerary.append(day_plan)
+                yield 'day', day_plan
+        plancache.store(cache_key, itinerary, time.perf_counter() - llm_started)
+        yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+        return
+
+    prompt = next(iter(prompts.values()))
+    duration = trip_duration(start_date, end_date)
+    parser = JSONArrayStreamParser()
+    itinerary = []
+    for fragment in stream_gemini_text(prompt):
+        for raw in parser.feed(fragment):
+            if len(itinerary) == duration:
+                continue
+            day_plan = streamed_day(raw, len(itinerary) + 1, prompt)
+            attach_weather_and_locations([day_plan], weather_data, destination, first_day_index=len(itinerary), start_date=start_date)
+            itinerary.append(day_plan)
+            yield 'day', day_plan
+
+    if not itinerary:
+        raise Exception("Could not parse the itinerary from the AI.")
+    if len(itinerary) < duration:
+        # The stream ended early: only the days it never reached are generated again.
+        missing = complete_itinerary(itinerary, duration, prompt)[len(itinerary):]
+        attach_weather_and_locations(missing, weather_data, destination, first_day_index=len(itinerary), start_date=start_date)
+        for day_plan in missing:
+            itinerary.append(day_plan)
+            yield 'day', day_plan
+    promptplan.record(1, duration, prompt, time.perf_counter() - llm_started)
+    plancache.store(cache_key, itinerary, time.perf_counter() - llm_started)
+    yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
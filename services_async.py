@@ -0,0 +1,294 @@
+# services_async.py
+import asyncio
+import json
+import time
+from config import (
+    async_outbound, GEMINI_READ_TIMEOUT, WEATHER_STAGE_TIMEOUT, TRANSPORT_STAGE_TIMEOUT, STRUCTURED_DAY_RETRIES,
+    BATCH_TRIP_WORKERS
+)
+from geocache import geocode
+from jsonstream import JSONArrayStreamParser
+from itinerary_schema import ITINERARY_SCHEMA, DAY_SCHEMA, validate_day, validate_itinerary, fallback_day
+from services import (
+    GEMINI_MODEL_URL,
+    gemini_headers,
+    gemini_request_body,
+    gemini_response_text,
+    gemini_sse_fragments,
+    get_weather_forecast,
+    get_transport_recommendation,
+    default_transport_recommendation,
+    prepare_batch_context,
+    batch_trip_key,
+    trip_duration,
+    segment_prompts,
+    build_day_prompt,
+    parse_itinerary_items,
+    attach_weather_and_locations,
+    lookup_cached_itinerary
+)
+import metrics
+import plancache
+import promptplan
+
+# asyncio versions of the trip generation entry points in services.py, used by
+# asgi.py. Gemini is called natively over async_outbound, so a request waiting
+# on the model holds no thread. Geocoding, Amadeus and Open-Meteo go through
+# synchronous SDKs and caches and run in the default thread pool instead.
+
+
+async def _stage(name, fn, timeout):
+    """Runs a blocking stage in a worker thread; returns (value, error) like a pipeline StageResult."""
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(fn), timeout), None
+    except asyncio.TimeoutError:
+        return None, f"{name} stage timed out after {timeout}s"
+    except Exception as e:
+        return None, str(e)
+
+
+async def prepare_trip_context(destination, start_date, end_date, budget, current_location):
+    """Async form of services.prepare_trip_context."""
+    transport_task = asyncio.create_task(_stage(
+        "transport",
+        lambda: get_transport_recommendation(current_location, destination, start_date, end_date, budget),
+        TRANSPORT_STAGE_TIMEOUT
+    ))
+
+    with metrics.span("geocode"):
+        main_location = await asyncio.to_thread(geocode, destination)
+    if not main_location:
+        transport_task.cancel()
+        raise Exception(f"Could not find coordinates for destination: {destination}")
+
+    weather_data, weather_error = await _stage(
+        "weather",
+        lambda: get_weather_forecast(main_location.latitude, main_location.longitude, start_date, end_date),
+        WEATHER_STAGE_TIMEOUT
+    )
+    transport_recommendation, transport_error = await transport_task
+
+    # A failed side stage degrades the plan instead of failing the whole trip.
+    if weather_error: print(f"Weather stage failed: {weather_error}")
+    if transport_error: print(f"Transport stage failed: {transport_error}")
+    return (
+        main_location,
+        weather_data if not weather_error else [],
+        transport_recommendation if not transport_error else default_transport_recommendation()
+    )
+
+
+async def generate_gemini(prompt, response_schema=None):
+    """Async form of services.generate_gemini."""
+    with metrics.span("llm"):
+        response = await async_outbound.post(f'{GEMINI_MODEL_URL}:generateContent', headers=gemini_headers(),
+                                             json=gemini_request_body(prompt, response_schema), timeout=GEMINI_READ_TIMEOUT)
+
+    if response.status_code != 200:
+        raise Exception(f"Failed to generate itinerary from Gemini. Status: {response.status_code}, Response: {response.text}")
+
+    try:
+        response_json = response.json()
+        return gemini_response_text(response_json), response_json.get('usageMetadata', {})
+    except (json.JSONDecodeError, KeyError, IndexError, ValueError) as e:
+        print(f"--- FAILED TO PARSE GEMINI RESPONSE ---\nError: {e}\nRaw Response: {response.text}\n------------------------------------")
+        raise Exception("Could not parse the itinerary from the AI.")
+
+
+async def generate_gemini_text(prompt, response_schema=None):
+    return (await generate_gemini(prompt, response_schema))[0]
+
+
+async def regenerate_day(prompt, day_number, problem):
+    """Async form of services.regenerate_day."""
+    for _ in range(STRUCTURED_DAY_RETRIES):
+        print(f"Regenerating day {day_number}: {problem}")
+        try:
+            raw = parse_itinerary_items(await generate_gemini_text(build_day_prompt(prompt, day_number, problem), DAY_SCHEMA))[0]
+        except Exception as e:
+            problem = f"The previous answer for it could not be used ({e})."
+            continue
+        day, problem = validate_day(raw, day_number)
+        if day:
+            return day
+    raise Exception(f"Day {day_number} stayed invalid after {STRUCTURED_DAY_RETRIES} attempts: {problem}")
+
+
+async def complete_itinerary(items, duration, prompt, first_day=1):
+    """Async form of services.complete_itinerary."""
+    days, problems = validate_itinerary(items, duration, first_day)
+    day_numbers = list(problems)
+    results = await asyncio.gather(
+        *[regenerate_day(prompt, day_number, problems[day_number]) for day_number in day_numbers],
+        return_exceptions=True
+    )
+    for day_number, result in zip(day_numbers, results):
+        i = day_number - first_day
+        if isinstance(result, Exception):
+            print(result)
+            days[i] = fallback_day(items[i] if i < len(items) else None, day_number)
+        else:
+            days[i] = result
+    return days
+
+
+async def generate_days(prompt, first_day, last_day):
+    """Async form of services.generate_days."""
+    started = time.perf_counter()
+    response_text, usage = await generate_gemini(prompt, ITINERARY_SCHEMA)
+    try:
+        items = parse_itinerary_items(response_text)
+    except ValueError as e:
+        print(f"--- FAILED TO PARSE GEMINI RESPONSE ---\nError: {e}\nRaw Response: {response_text}\n------------------------------------")
+        raise Exception("Could not parse the itinerary from the AI.")
+    days = await complete_itinerary(items, last_day - first_day + 1, prompt, first_day)
+    promptplan.record(first_day, last_day, prompt, time.perf_counter() - started, usage)
+    return days
+
+
+async def streamed_day(raw, day_number, prompt):
+    """Async form of services.streamed_day."""
+    day, problem = validate_day(raw, day_number)
+    if day:
+        return day
+    try:
+        return await regenerate_day(prompt, day_number, problem)
+    except Exception as e:
+        print(e)
+        return fallback_day(raw, day_number)
+
+
+async def generate_itinerary_with_coords(destination, start_date, end_date, budget, interests, current_location):
+    """Async form of services.generate_itinerary_with_coords."""
+    context = await prepare_trip_context(destination, start_date, end_date, budget, current_location)
+    return await generate_itinerary_from_context(destination, start_date, end_date, budget, interests, current_location, *context)
+
+
+async def generate_itinerary_from_context(destination, start_date, end_date, budget, interests, current_location,
+                                          main_location, weather_data, transport_recommendation):
+    """Async form of services.generate_itinerary_from_context."""
+    cache_key = plancache.plan_cache_key(main_location, trip_duration(start_date, end_date), budget, interests, current_location, weather_data)
+    cached_itinerary = await asyncio.to_thread(lookup_cached_itinerary, cache_key, start_date, weather_data)
+    if cached_itinerary is not None:
+        return {"itinerary": cached_itinerary, "transport_recommendation": transport_recommendation}
+
+    prompts = segment_prompts(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation)
+    llm_started = time.perf_counter()
+    # Long trips are split into segments that are generated concurrently, then merged in order.
+    segments = await asyncio.gather(*[generate_days(prompt, *segment) for segment, prompt in prompts.items()])
+    itinerary = [day for days in segments for day in days]
+
+    llm_seconds = time.perf_counter() - llm_started
+    await asyncio.to_thread(attach_weather_and_locations, itinerary, weather_data, destination, start_date=start_date)
+    await asyncio.to_thread(plancache.store, cache_key, itinerary, llm_seconds)
+
+    return {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+
+
+# Shared by all batch requests of this process, like services' batch_pool.
+_batch_slots = None
+
+
+async def generate_itineraries_with_coords(trips):
+    """Async form of services.generate_itineraries_with_coords.
+
+    Returns the plan dict or the exception raised for each trip, in order.
+    """
+    global _batch_slots
+    if _batch_slots is None:
+        _batch_slots = asyncio.Semaphore(BATCH_TRIP_WORKERS)
+    # The shared context stages are blocking SDK and cache calls, as in prepare_trip_context.
+    keys = [batch_trip_key(trip) for trip in trips]
+    unique = {}
+    for key, trip in zip(keys, trips):
+        unique.setdefault(key, trip)
+    contexts = await asyncio.to_thread(prepare_batch_context, list(unique.values()))
+
+    async def generate(trip, context):
+        if not context[0]:
+            raise Exception(f"Could not find coordinates for destination: {trip['destination']}")
+        async with _batch_slots:
+            return await generate_itinerary_from_context(trip['destination'], trip['start_date'], trip['end_date'], trip.get('budget'),
+                                                         trip.get('interests', []), trip['current_location'], *context)
+
+    results = await asyncio.gather(*[generate(trip, context) for trip, context in zip(unique.values(), contexts)], return_exceptions=True)
+    plans = dict(zip(unique, results))
+    return [plans[key] for key in keys]
+
+
+async def stream_gemini_text(prompt):
+    """Async form of services.stream_gemini_text."""
+    with metrics.span("llm"):
+        async with async_outbound.stream('POST', f'{GEMINI_MODEL_URL}:streamGenerateContent', params={'alt': 'sse'},
+                                         headers=gemini_headers(), json=gemini_request_body(prompt, ITINERARY_SCHEMA),
+                                         timeout=GEMINI_READ_TIMEOUT) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"Failed to generate itinerary from Gemini. Status: {response.status_code}, Response: {response.text}")
+
+            async for line in response.aiter_lines():
+                for fragment in gemini_sse_fragments(line):
+                    yield fragment
+
+
+async def stream_itinerary_with_coords(destination, start_date, end_date, budget, interests, current_location):
+    """Async form of services.stream_itinerary_with_coords; yields the same (event, payload) tuples."""
+    main_location, weather_data, transport_recommendation = await prepare_trip_context(destination, start_date, end_date, budget, current_location)
+    yield 'transport', transport_recommendation
+
+    cache_key = plancache.plan_cache_key(main_location, trip_duration(start_date, end_date), budget, interests, current_location, weather_data)
+    itinerary = await asyncio.to_thread(lookup_cached_itinerary, cache_key, start_date, weather_data)
+    if itinerary is not None:
+        for day_plan in itinerary:
+            yield 'day', day_plan
+        yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+        return
+
+    prompts = segment_prompts(destination, start_date, end_date, budget, interests, current_location, weather_data, transport_recommendation)
+    llm_started = time.perf_counter()
+    if len(prompts) > 1:
+        # Long trips: all segments are generated at once and each is sent as soon as it and those before it are done.
+        tasks = [asyncio.create_task(generate_days(prompt, *segment)) for segment, prompt in prompts.items()]
+        itinerary = []
+        try:
+            for task in tasks:
+                days = await task
+                await asyncio.to_thread(attach_weather_and_locations, days, weather_data, destination,
+                                        first_day_index=len(itinerary), start_date=start_date)
+                for day_plan in days:
+                    itinerary.append(day_plan)
+                    yield 'day', day_plan
+        finally:
+            for task in tasks:
+                task.cancel()
+        await asyncio.to_thread(plancache.store, cache_key, itinerary, time.perf_counter() - llm_started)
+        yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
+        return
+
+    prompt = next(iter(prompts.values()))
+    duration = trip_duration(start_date, end_date)
+    parser = JSONArrayStreamParser()
+    itinerary = []
+    async for fragment in stream_gemini_text(prompt):
+        for raw in parser.feed(fragment):
+            if len(itinerary) == duration:
+                continue
+            day_plan = await streamed_day(raw, len(itinerary) + 1, prompt)
+            await asyncio.to_thread(attach_weather_and_locations, [day_plan], weather_data, destination,
+                                    first_day_index=len(itinerary), start_date=start_date)
+            itinerary.append(day_plan)
+            yield 'day', day_plan
+
+    if not itinerary:
+        raise Exception("Could not parse the itinerary from the AI.")
+    if len(itinerary) < duration:
+        # The stream ended early: only the days it never reached are generated again.
+        missing = (await complete_itinerary(itinerary, duration, prompt))[len(itinerary):]
+        await asyncio.to_thread(attach_weather_and_locations, missing, weather_data, destination,
+                                first_day_index=len(itinerary), start_date=start_date)
+        for day_plan in missing:
+            itinerary.append(day_plan)
+            yield 'day', day_plan
+    promptplan.record(1, duration, prompt, time.perf_counter() - llm_started)
+    await asyncio.to_thread(plancache.store, cache_key, itinerary, time.perf_counter() - llm_started)
+    yield 'plan', {"itinerary": itinerary, "transport_recommendation": transport_recommendation}
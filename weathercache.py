@@ -0,0 +1,103 @@
+# weathercache.py
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from cache import SQLiteCache
+from config import (
+    WEATHER_CACHE_PATH,
+    WEATHER_CACHE_MAX_ENTRIES,
+    WEATHER_GRID_DEGREES,
+    WEATHER_MODEL_UPDATE_HOURS,
+    WEATHER_MODEL_LAG_HOURS,
+    WEATHER_FORECAST_DAYS
+)
+
+# One entry per (grid cell, day), so any sub-range of an earlier, wider
+# request is answered from disk without another call.
+_store = SQLiteCache(WEATHER_CACHE_PATH, "weather", max_entries=WEATHER_CACHE_MAX_ENTRIES)
+
+
+def snap(lat, lon):
+    """Snaps coordinates to the centre of their grid cell.
+
+    Forecast models have a resolution of a few km, so POIs and geocodes that
+    differ in the fourth decimal share one cache entry and one request.
+    """
+    def to_cell(value):
+        return round((math.floor(value / WEATHER_GRID_DEGREES) + 0.5) * WEATHER_GRID_DEGREES, 4)
+    return to_cell(lat), to_cell(lon)
+
+
+def date_range(start_date, end_date):
+    first = datetime.strptime(start_date, "%Y-%m-%d")
+    last = datetime.strptime(end_date, "%Y-%m-%d")
+    return [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((last - first).days + 1)]
+
+
+def seconds_until_next_model_run(now=None):
+    """Forecasts stay valid until the next model run is published.
+
+    Runs start every WEATHER_MODEL_UPDATE_HOURS (UTC) and become available
+    WEATHER_MODEL_LAG_HOURS later.
+    """
+    now = time.time() if now is None else now
+    period = WEATHER_MODEL_UPDATE_HOURS * 3600
+    lag = WEATHER_MODEL_LAG_HOURS * 3600
+    next_available = (math.floor((now - lag) / period) + 1) * period + lag
+    return max(60, next_available - now)
+
+
+def forecast_horizon():
+    """The last date Open-Meteo has a forecast for; requests reaching past it fail as a whole."""
+    return (datetime.now(timezone.utc) + timedelta(days=WEATHER_FORECAST_DAYS - 1)).strftime("%Y-%m-%d")
+
+
+def _key(cell, date):
+    return f"{cell[0]}|{cell[1]}|{date}"
+
+
+def cached_forecasts(locations, fetch_many):
+    """Returns the daily forecast for many (lat, lon, start_date, end_date) tuples.
+
+    Cached days are read in one query. The missing days of every grid cell
+    are then requested together through a single `fetch_many(locations)` call,
+    which takes and returns lists in the same order. Days past the forecast
+    horizon are left out, so a far-off trip gets a shorter (or no) forecast.
+    """
+    horizon = forecast_horizon()
+    wanted = []
+    for lat, lon, start_date, end_date in locations:
+        cell = snap(lat, lon)
+        wanted.append((cell, [date for date in date_range(start_date, end_date) if date <= horizon]))
+    cached = _store.get_many([_key(cell, date) for cell, dates in wanted for date in dates])
+
+    missing = {}
+    for cell, dates in wanted:
+        for date in dates:
+            if _key(cell, date) not in cached:
+                missing.setdefault(cell, set()).add(date)
+
+    if missing:
+        cells = list(missing)
+        to_fetch = [(cell[0], cell[1], min(missing[cell]), max(missing[cell])) for cell in cells]
+        fresh = {}
+        for (lat, lon, start_date, end_date), rows in zip(to_fetch, fetch_many(to_fetch)):
+            # Rows come back in date order, one per day of the requested range.
+            for date, row in zip(date_range(start_date, end_date), rows):
+                fresh[_key((lat, lon), date)] = row
+        _store.set_many(fresh, seconds_until_next_model_run())
+        cached.update(fresh)
+
+    return [
+        [cached[_key(cell, date)] for date in dates if _key(cell, date) in cached]
+        for cell, dates in wanted
+    ]
+
+
+def cached_forecast(lat, lon, start_date, end_date, fetch_many):
+    """Single-location form of cached_forecasts."""
+    return cached_forecasts([(lat, lon, start_date, end_date)], fetch_many)[0]
+
+
+def stats():
+    return _store.stats()